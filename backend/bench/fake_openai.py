@@ -0,0 +1,105 @@
+"""Minimal OpenAI-compatible chat completions server for offline benchmarks.
+
+    python backend/bench/fake_openai.py --port 8099 --ttft-ms 300 --tokens-per-sec 80
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8099/v1. Replies
+are canned text (with a mermaid block, so diagram extraction is exercised)
+delivered after the configured time to first token and at the configured
+token rate, with usage numbers in the OpenAI format.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY_WORDS = (
+    "Here is a structured explanation of the topic with a few examples and follow-up questions "
+    "to check your understanding before we move on to the next stage. "
+).split()
+MERMAID = "\n```mermaid\ngraph TD; Concept-->Example; Example-->Question\n```\n"
+
+settings = {"ttft": 0.3, "tokens_per_sec": 80.0, "completion_tokens": 120}
+app = FastAPI()
+
+
+def reply_tokens(count: int):
+    words = [REPLY_WORDS[i % len(REPLY_WORDS)] + " " for i in range(count)]
+    words.insert(min(len(words), 10), MERMAID)
+    return words
+
+
+def prompt_tokens(body: dict) -> int:
+    return sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4 + 1
+
+
+def usage(body: dict, completion: int) -> dict:
+    prompt = prompt_tokens(body)
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+def chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    tokens = reply_tokens(settings["completion_tokens"])
+    interval = 1.0 / settings["tokens_per_sec"] if settings["tokens_per_sec"] > 0 else 0.0
+
+    if not body.get("stream"):
+        await asyncio.sleep(settings["ttft"] + interval * len(tokens))
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": usage(body, len(tokens)),
+        })
+
+    async def events():
+        await asyncio.sleep(settings["ttft"])
+        yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+        for token in tokens:
+            yield chunk(completion_id, model, {"content": token})
+            if interval:
+                await asyncio.sleep(interval)
+        yield chunk(completion_id, model, {}, "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": [], "usage": usage(body, len(tokens))}
+            yield f"data: {json.dumps(payload)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="Delay before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0, help="0 sends all tokens at once")
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    args = parser.parse_args()
+    settings.update(ttft=args.ttft_ms / 1000, tokens_per_sec=args.tokens_per_sec, completion_tokens=args.completion_tokens)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""Offline load benchmark: fake OpenAI server + synthetic tree + mixed workload.
+
+    python backend/bench/run_bench.py --notes 50 --concurrency 16 --duration 30 \\
+        --mix list=15,content=20,search=10,ask=15,tutor=15,pux=10,merm=10,upload=5 \\
+        --json bench.json [--baseline previous.json --tolerance 0.2]
+
+Starts the fake model server and the app (uvicorn, from a scratch working
+directory holding the generated users/ tree), drives the mix for the given
+duration and reports per-operation p50/p95/p99 latency, overall RPS and the
+app's peak RSS. With --baseline it exits non-zero when an operation's p95
+regressed by more than --tolerance or errors appeared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path as PathlibPath
+
+import httpx
+import psutil
+
+import synth
+from storage import open_store
+
+BENCH_DIR = PathlibPath(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent
+DEFAULT_MIX = "list=15,content=20,search=10,ask=15,tutor=15,pux=10,merm=10,upload=5"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        op, _, weight = item.partition("=")
+        if op not in OPERATIONS:
+            raise SystemExit(f"Unknown operation '{op}', expected one of {', '.join(OPERATIONS)}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def wait_until_up(url: str, timeout: float = 30.0, ok: bool = False):
+    # ok: wait for a 2xx answer (a readiness probe), not just any answer
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(url)
+                if not ok or response.is_success:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise SystemExit(f"{url} did not come up within {timeout}s")
+
+
+class Workload:
+    def __init__(self, client: httpx.AsyncClient, tree: dict, rng: random.Random, stream_share: float, upload_kb: int):
+        self.client = client
+        self.tree = tree  # user -> {note: [subsection stems]}
+        self.rng = rng
+        self.stream_share = stream_share
+        self.upload_kb = upload_kb
+
+    def pick(self):
+        user = self.rng.choice(list(self.tree))
+        note = self.rng.choice(list(self.tree[user]))
+        return user, note
+
+    def query(self) -> str:
+        return " ".join(self.rng.choice(synth.VOCABULARY[:40]) for _ in range(self.rng.randint(3, 7)))
+
+    async def list(self):
+        user, _ = self.pick()
+        return await self.client.get(f"/users/{user}/notes")
+
+    async def content(self):
+        user, note = self.pick()
+        return await self.client.get(f"/users/{user}/notes/{note}/content")
+
+    async def search(self):
+        user, _ = self.pick()
+        return await self.client.get(f"/users/{user}/search", params={"q": self.query()})
+
+    async def ask(self):
+        user, note = self.pick()
+        body = {"query": self.query(), "contextLevel": 3, "includeDiagram": self.rng.random() < 0.5,
+                "includeContext": False, "stream": self.rng.random() < self.stream_share}
+        return await self.client.post(f"/users/{user}/notes/{note}/ask", json=body)
+
+    async def _chat(self, route: str):
+        user, note = self.pick()
+        body = {"query": self.query(), "stream": self.rng.random() < self.stream_share}
+        return await self.client.post(f"/users/{user}/notes/{note}/{route}", json=body)
+
+    async def tutor(self):
+        return await self._chat("tutor")
+
+    async def pux(self):
+        return await self._chat("pux")
+
+    async def merm(self):
+        user, note = self.pick()
+        stem = self.rng.choice(self.tree[user][note])
+        return await self.client.get(f"/users/{user}/notes/{note}/{stem}")
+
+    async def upload(self):
+        user, note = self.pick()
+        text = synth.text_of_size(self.rng, self.upload_kb * 1024)
+        files = {"file": (f"bench-{self.rng.getrandbits(48):x}.txt", text.encode(), "text/plain")}
+        return await self.client.post(f"/users/{user}/notes/{note}/upload", files=files)
+
+
+OPERATIONS = ("list", "content", "search", "ask", "tutor", "pux", "merm", "upload")
+
+
+async def drive(base_url: str, tree: dict, mix: dict, concurrency: int, duration: float, seed: int,
+                stream_share: float, upload_kb: int):
+    samples = {op: [] for op in mix}
+    errors = {op: 0 for op in mix}
+    ops, weights = list(mix), list(mix.values())
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0, limits=limits) as client:
+        async def worker(n: int):
+            workload = Workload(client, tree, random.Random(seed + n), stream_share, upload_kb)
+            while time.monotonic() < deadline:
+                op = workload.rng.choices(ops, weights)[0]
+                start = time.perf_counter()
+                try:
+                    response = await getattr(workload, op)()
+                    failed = response.status_code >= 400 or "event: error" in response.text
+                except httpx.HTTPError:
+                    failed = True
+                if failed:
+                    errors[op] += 1
+                else:
+                    samples[op].append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return samples, errors, elapsed
+
+
+def summarize(samples: dict, errors: dict, elapsed: float, peak_rss: int, config: dict) -> dict:
+    operations = {}
+    for op, values in samples.items():
+        operations[op] = {
+            "count": len(values),
+            "errors": errors[op],
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        }
+    total = sum(len(v) for v in samples.values())
+    return {
+        "config": config,
+        "elapsed_s": round(elapsed, 2),
+        "requests": total,
+        "errors": sum(errors.values()),
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+        "operations": operations,
+    }
+
+
+def print_report(report: dict):
+    print(f"\n{'operation':<10}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, stats in report["operations"].items():
+        print(f"{op:<10}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print(f"\n{report['requests']} requests in {report['elapsed_s']}s: {report['rps']} rps, "
+          f"{report['errors']} errors, peak RSS {report['peak_rss_mb']} MB")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for op, stats in report["operations"].items():
+        before = baseline.get("operations", {}).get(op)
+        if not before or not before["count"] or not stats["count"]:
+            continue
+        if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"{op}: p95 {stats['p95_ms']}ms vs baseline {before['p95_ms']}ms")
+        if stats["errors"] > before["errors"]:
+            problems.append(f"{op}: {stats['errors']} errors vs baseline {before['errors']}")
+    return problems
+
+
+async def sample_rss(process: psutil.Process, peak: list, stop: asyncio.Event):
+    # The app process and any workers it spawned (upload text extraction)
+    while not stop.is_set():
+        try:
+            rss = process.memory_info().rss + sum(c.memory_info().rss for c in process.children(recursive=True))
+            peak[0] = max(peak[0], rss)
+        except psutil.Error:
+            pass
+        await asyncio.sleep(0.1)
+
+
+def build_tree(workdir: PathlibPath, args, db_url: str) -> dict:
+    users = synth.generate(workdir / "users", args.storage, db_url, args.users, args.notes, args.subsections,
+                           args.chat_turns, args.uploads, args.upload_kb, args.seed)
+    store = open_store(workdir / "users", args.storage, db_url)
+    try:
+        # Subsection stems for the merm route, which appends ".md" itself
+        return {
+            user: {note: [name[:-3] for name in store.list_subsections(user, note)] for note in store.list_notes(user)}
+            for user in users
+        }
+    finally:
+        store.close()
+
+
+async def run(args):
+    workdir = PathlibPath(args.workdir or tempfile.mkdtemp(prefix="notes-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    db_url = args.db_url or f"sqlite:///{workdir / 'notes.db'}"
+    print(f"Generating {args.users} users x {args.notes} notes in {workdir}")
+    tree = build_tree(workdir, args, db_url)
+
+    fake_port, app_port = free_port(), free_port()
+    fake = subprocess.Popen([
+        sys.executable, str(BENCH_DIR / "fake_openai.py"), "--port", str(fake_port),
+        "--ttft-ms", str(args.ttft_ms), "--tokens-per-sec", str(args.tokens_per_sec),
+        "--completion-tokens", str(args.completion_tokens),
+    ])
+    env = {
+        # A few synthetic users drive the whole load, so per-user admission
+        # limits are off unless set explicitly
+        "LLM_USER_RATE": "0",
+        "LLM_USER_MAX_QUEUE": str(args.concurrency * 4),
+        **os.environ,
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{fake_port}/v1",
+        "NOTES_STORAGE": args.storage,
+        "NOTES_DB_URL": db_url,
+        "RESPONSE_CACHE_DIR": str(workdir / ".cache" / "responses"),
+    }
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(BACKEND_DIR / "src"),
+         "--port", str(app_port), "--log-level", "warning"],
+        # The routes still print debug output; keep it out of the report
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        await wait_until_up(f"http://127.0.0.1:{fake_port}/docs")
+        # Load starts once the app's startup warm-up has finished
+        await wait_until_up(f"{base_url}/readyz", ok=True)
+        peak, stop = [0], asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(psutil.Process(app.pid), peak, stop))
+        mix = parse_mix(args.mix)
+        print(f"Driving {args.concurrency} workers for {args.duration}s: {args.mix}")
+        samples, errors, elapsed = await drive(base_url, tree, mix, args.concurrency, args.duration, args.seed,
+                                               args.stream_share, args.upload_kb)
+        stop.set()
+        await sampler
+    finally:
+        app.terminate()
+        fake.terminate()
+        app.wait()
+        fake.wait()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("json", "baseline", "workdir", "keep")}
+    return summarize(samples, errors, elapsed, peak[0], config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    synth.add_arguments(parser)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="op=weight pairs")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds of load")
+    parser.add_argument("--stream-share", type=float, default=0.5, help="Fraction of ask/tutor/pux calls that stream")
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--workdir", help="Keep the generated tree here instead of a temp dir")
+    parser.add_argument("--keep", action="store_true", help="Don't delete the temp dir")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Report from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 regression against the baseline")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        PathlibPath(args.json).write_text(json.dumps(report, indent=2))
+    if args.baseline:
+        problems = compare(report, json.loads(PathlibPath(args.baseline).read_text()), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Cold start benchmark: import time of the app and time until it is ready.
+
+    python backend/bench/startup_bench.py --runs 5 --import-budget-ms 1200 \\
+        --ready-budget-ms 5000 [--json startup.json]
+
+Imports main in fresh interpreters and reports the median wall time plus
+the slowest top-level imports from `python -X importtime`, then starts the
+app (uvicorn, in a scratch working directory) and times the first /healthz
+answer and the first 200 from /readyz. Exits non-zero when a median is
+over its budget.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path as PathlibPath
+
+import httpx
+
+from run_bench import free_port
+
+BENCH_DIR = PathlibPath(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent
+SRC_DIR = BACKEND_DIR / "src"
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+IMPORT_MAIN = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def app_env(workdir: PathlibPath) -> dict:
+    return {
+        **os.environ,
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "sk-bench"),
+        "RESPONSE_CACHE_DIR": str(workdir / ".cache" / "responses"),
+    }
+
+
+def import_seconds(workdir: PathlibPath) -> float:
+    result = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=workdir, env={**app_env(workdir), "PYTHONPATH": str(SRC_DIR)},
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(workdir: PathlibPath, top: int) -> list:
+    # Modules imported directly by main, by cumulative microseconds
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir,
+                            env={**app_env(workdir), "PYTHONPATH": str(SRC_DIR)}, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and len(match.group(3)) == 3:
+            imports.append((match.group(4), int(match.group(2))))
+    return [{"module": name, "ms": round(us / 1000, 1)} for name, us in sorted(imports, key=lambda i: -i[1])[:top]]
+
+
+async def time_to_ready(workdir: PathlibPath, timeout: float = 60.0) -> dict:
+    port = free_port()
+    start = time.perf_counter()
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(SRC_DIR), "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=app_env(workdir), stdout=subprocess.DEVNULL,
+    )
+    timings = {"healthz": None, "readyz": None}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if timings["healthz"] is None and (await client.get("/healthz")).status_code == 200:
+                        timings["healthz"] = time.perf_counter() - start
+                    if timings["healthz"] is not None and (await client.get("/readyz")).status_code == 200:
+                        timings["readyz"] = time.perf_counter() - start
+                        return timings
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.02)
+    finally:
+        app.terminate()
+        app.wait()
+    raise SystemExit(f"The app was not ready within {timeout}s")
+
+
+def run(args) -> dict:
+    workdir = PathlibPath(tempfile.mkdtemp(prefix="notes-startup-"))
+    try:
+        (workdir / "users").mkdir()
+        imports = [import_seconds(workdir) for _ in range(args.runs)]
+        ready = [asyncio.run(time_to_ready(workdir)) for _ in range(args.runs)]
+        slowest = slowest_imports(workdir, args.top)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "runs": args.runs,
+        "import_ms": round(statistics.median(imports) * 1000, 1),
+        "healthz_ms": round(statistics.median(r["healthz"] for r in ready) * 1000, 1),
+        "readyz_ms": round(statistics.median(r["readyz"] for r in ready) * 1000, 1),
+        "slowest_imports": slowest,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    parser.add_argument("--import-budget-ms", type=float, default=1200.0)
+    parser.add_argument("--ready-budget-ms", type=float, default=5000.0)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(f"import main   {report['import_ms']:8.1f} ms  (budget {args.import_budget_ms:.0f})")
+    print(f"first healthz {report['healthz_ms']:8.1f} ms")
+    print(f"first readyz  {report['readyz_ms']:8.1f} ms  (budget {args.ready_budget_ms:.0f})")
+    print("slowest imports from main:")
+    for entry in report["slowest_imports"]:
+        print(f"  {entry['ms']:8.1f} ms  {entry['module']}")
+    if args.json:
+        PathlibPath(args.json).write_text(json.dumps(report, indent=2))
+
+    problems = []
+    if report["import_ms"] > args.import_budget_ms:
+        problems.append(f"import main took {report['import_ms']} ms, budget {args.import_budget_ms:.0f} ms")
+    if report["readyz_ms"] > args.ready_budget_ms:
+        problems.append(f"ready after {report['readyz_ms']} ms, budget {args.ready_budget_ms:.0f} ms")
+    for problem in problems:
+        print(f"OVER BUDGET {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Generate a synthetic users/ tree for benchmarks.
+
+    python backend/bench/synth.py bench-work/users --users 2 --notes 50 --subsections 8 \\
+        --chat-turns 20 --uploads 2 --upload-kb 64 [--storage sqlite --db-url sqlite:///bench-work/notes.db]
+
+Content goes through the same NoteStore the app uses, so either backend can
+be populated. Text is drawn from a fixed vocabulary with a seeded RNG, so
+runs with the same arguments produce the same tree.
+"""
+import argparse
+import random
+import sys
+from pathlib import Path as PathlibPath
+
+sys.path.insert(0, str(PathlibPath(__file__).resolve().parent.parent / "src"))
+
+from storage import NOTES_DB_URL, open_store  # noqa: E402
+
+VOCABULARY = (
+    "photosynthesis chlorophyll mitochondria enzyme protein membrane osmosis diffusion respiration glucose "
+    "algorithm recursion complexity graph vertex edge heap queue stack hashing "
+    "contract liability tort negligence statute precedent jurisdiction plaintiff defendant verdict "
+    "market demand supply elasticity inflation interest budget revenue margin forecast "
+    "the a of and to in is that for with as on by this which are from be it"
+).split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(VOCABULARY) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def paragraph(rng: random.Random, sentences: int = 5) -> str:
+    return " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(sentences))
+
+
+def text_of_size(rng: random.Random, nbytes: int) -> str:
+    parts, size = [], 0
+    while size < nbytes:
+        part = paragraph(rng)
+        parts.append(part)
+        size += len(part) + 2
+    return "\n\n".join(parts)[:nbytes]
+
+
+def note_data(rng: random.Random, store, user: str, note: str, subsections: int, chat_turns: int,
+              uploads: int, upload_kb: int) -> dict:
+    data = {
+        "subsections": {
+            f"{i:02d}-{rng.choice(VOCABULARY)}.md": f"# Section {i}\n\n" + "\n\n".join(paragraph(rng) for _ in range(rng.randint(2, 6)))
+            for i in range(subsections)
+        },
+        "chat": [
+            (f"20250101_{i:06d}-turn.md", f"Question: {sentence(rng, 8)} \n Answer by the LLM: {paragraph(rng, 3)}")
+            for i in range(chat_turns)
+        ],
+        "uploads": [],
+        "meta": {},
+    }
+    upload_dir = store.upload_dir(user, note)
+    for i in range(uploads):
+        text = text_of_size(rng, upload_kb * 1024)
+        raw = upload_dir / f"upload-{i}.txt"
+        raw.parent.mkdir(parents=True, exist_ok=True)
+        raw.write_text(text)
+        data["uploads"].append((raw.name, raw, text))
+    return data
+
+
+def generate(base_dir, storage: str = "fs", db_url: str = None, users: int = 1, notes: int = 20,
+             subsections: int = 6, chat_turns: int = 10, uploads: int = 1, upload_kb: int = 32, seed: int = 0):
+    store = open_store(PathlibPath(base_dir), storage, db_url or NOTES_DB_URL)
+    rng = random.Random(seed)
+    try:
+        for u in range(users):
+            user = f"bench{u}"
+            for n in range(notes):
+                note = f"note-{n:04d}"
+                store.import_note(user, note, note_data(rng, store, user, note, subsections, chat_turns, uploads, upload_kb))
+    finally:
+        store.close()
+    return [f"bench{u}" for u in range(users)]
+
+
+def add_arguments(parser):
+    parser.add_argument("--storage", default="fs", choices=["fs", "sqlite"])
+    parser.add_argument("--db-url")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--notes", type=int, default=20)
+    parser.add_argument("--subsections", type=int, default=6)
+    parser.add_argument("--chat-turns", type=int, default=10)
+    parser.add_argument("--uploads", type=int, default=1)
+    parser.add_argument("--upload-kb", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base_dir")
+    add_arguments(parser)
+    args = parser.parse_args()
+    generate(args.base_dir, args.storage, args.db_url, args.users, args.notes, args.subsections,
+             args.chat_turns, args.uploads, args.upload_kb, args.seed)
+    print(f"{args.users} users x {args.notes} notes written to {args.base_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path as PathlibPath
+
+LOCK_FILE = ".lock"
+FILE_ETAG_ENTRIES = int(os.getenv("FILE_ETAG_CACHE_ENTRIES", "8192"))
+
+_local_locks = {}  # note dir -> [asyncio.Lock, holders and waiters]
+_file_etags = OrderedDict()  # path -> (mtime_ns, size, etag), least recently used first
+
+
+def etag(text: str) -> str:
+    return f'"{hashlib.sha256(text.encode()).hexdigest()[:32]}"'
+
+
+def file_etag(path: PathlibPath) -> str:
+    # Same value as etag(path.read_text()), recomputed only when the file's
+    # (mtime_ns, size) changes so validators cost a stat, not a read
+    st = path.stat()
+    cached = _file_etags.get(str(path))
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        _file_etags.move_to_end(str(path))
+        return cached[2]
+    tag = etag(path.read_text())
+    _file_etags[str(path)] = (st.st_mtime_ns, st.st_size, tag)
+    _file_etags.move_to_end(str(path))
+    while len(_file_etags) > FILE_ETAG_ENTRIES:
+        _file_etags.popitem(last=False)
+    return tag
+
+
+def note_etag(etags: dict) -> str:
+    # Note-level validator derived from the sorted per-subsection ETags
+    return etag("\n".join(f"{name}:{tag}" for name, tag in sorted(etags.items())))
+
+
+def base_etag(tag: str) -> str:
+    # Drops the weak prefix and the "--zstd"/"--gzip" suffix that the
+    # compression middleware adds to encoded variants
+    tag = tag.strip().removeprefix("W/")
+    for encoding in ("zstd", "gzip"):
+        suffix = f'--{encoding}"'
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def parse_if_match(header: str):
+    # None means no precondition; "*" matches any current representation
+    if header is None:
+        return None
+    return {base_etag(tag) for tag in header.split(",") if tag.strip()}
+
+
+def _tmp_path(path: PathlibPath) -> PathlibPath:
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def _write_tmp(path: PathlibPath, text: str) -> PathlibPath:
+    tmp = _tmp_path(path)
+    with tmp.open("w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp
+
+
+def atomic_write(path: PathlibPath, text: str):
+    # Readers see either the old or the new file, never a partial one
+    os.replace(_write_tmp(path, text), path)
+
+
+def atomic_batch(writes: dict):
+    # All-or-nothing over several files: every temp file is written before
+    # anything is renamed, and a failed rename puts the earlier files back.
+    temps = {}
+    try:
+        for path, text in writes.items():
+            temps[path] = _write_tmp(path, text)
+    except BaseException:
+        for tmp in temps.values():
+            tmp.unlink(missing_ok=True)
+        raise
+
+    previous = {path: path.read_text() if path.exists() else None for path in writes}
+    done = []
+    try:
+        for path, tmp in temps.items():
+            os.replace(tmp, path)
+            done.append(path)
+    except BaseException:
+        for path in done:
+            if previous[path] is None:
+                path.unlink(missing_ok=True)
+            else:
+                atomic_write(path, previous[path])
+        for path, tmp in temps.items():
+            if path not in done:
+                tmp.unlink(missing_ok=True)
+        raise
+
+
+@asynccontextmanager
+async def note_lock(note_dir: PathlibPath):
+    # Serializes writers of one note across coroutines (asyncio.Lock) and
+    # across uvicorn workers (flock on <note>/.lock, taken off the event loop)
+    # The lock is dropped again once nobody holds or waits for it
+    key = str(note_dir)
+    local = _local_locks.setdefault(key, [asyncio.Lock(), 0])
+    local[1] += 1
+    try:
+        async with local[0]:
+            note_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(note_dir / LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+    finally:
+        local[1] -= 1
+        if not local[1]:
+            del _local_locks[key]
@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+import llm
+import metrics
+from tokens import count_tokens
+
+# Whole-prompt budget shared by system prompt, notes, uploads, history and query
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "16000"))
+# Share of what is left after system prompt and query that history may take
+HISTORY_TOKEN_SHARE = float(os.getenv("HISTORY_TOKEN_SHARE", "0.35"))
+# Turns always kept verbatim; everything older is folded into the summary
+HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", "6"))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a tutoring conversation about the user's notes. "
+    "Merge the new exchange into the summary. Keep what the user has understood, what they "
+    "struggled with, open questions and the current stage of the discussion. "
+    "Reply with the updated summary only, in under 250 words."
+)
+
+_fold_locks = {}
+_fold_tasks = set()
+
+
+def load_summary(store, user: str, note: str) -> dict:
+    # "folded" counts the turns already merged into the summary
+    state = store.get_meta(user, note, "chat_summary") or {"summary": "", "folded": 0}
+    if "folded" not in state:
+        # Written when turns were files and the summary tracked the last name
+        through = state.pop("folded_through", "")
+        state["folded"] = sum(1 for name, _, _ in store.chat_turns(user, note) if name <= through) if through else 0
+    return state
+
+
+def save_summary(store, user: str, note: str, state: dict):
+    store.set_meta(user, note, "chat_summary", state)
+
+
+class Budget:
+    def __init__(self, system_tokens: int, query: str, total: int = CONTEXT_TOKEN_BUDGET):
+        # system_tokens: precomputed by the prompt registry
+        self.total = total
+        self.fixed = system_tokens + count_tokens(query)
+        self.remaining = max(total - self.fixed, 0)
+
+    def history_allowance(self) -> int:
+        return int(self.remaining * HISTORY_TOKEN_SHARE)
+
+    def spend(self, tokens: int) -> int:
+        self.remaining = max(self.remaining - tokens, 0)
+        return self.remaining
+
+
+def select_history(store, user: str, note: str, budget: Budget) -> str:
+    # Rolling summary of the folded turns plus the unfolded turns, newest
+    # first until the history allowance runs out, returned oldest first.
+    state = load_summary(store, user, note)
+    allowance = budget.history_allowance()
+    summary = state["summary"]
+    used = count_tokens(summary) if summary else 0
+
+    kept = []
+    for _, segment, tokens in reversed(store.chat_turns(user, note, state["folded"])):
+        if used + tokens > allowance:
+            break
+        kept.append(segment)
+        used += tokens
+
+    budget.spend(used)
+    history = "".join(reversed(kept))
+    if summary:
+        history = f"Summary of the earlier conversation:\n{summary}\n{history}"
+    return history
+
+
+async def fold_history(store, user: str, note: str, keep_recent: int = HISTORY_RECENT_TURNS):
+    # Folds turns older than the verbatim window into the summary, one turn
+    # per model call, persisting after each so progress is never redone.
+    lock = _fold_locks.setdefault((user, note), asyncio.Lock())
+    async with lock:
+        state = load_summary(store, user, note)
+        turns = store.chat_turns(user, note, state["folded"])
+        pending = turns[:-keep_recent] if keep_recent else turns
+        for _, segment, _ in pending:
+            messages = [
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(content=f"Summary so far:\n{state['summary'] or '(empty)'}\n\nNew exchange:\n{segment}"),
+            ]
+            state["summary"] = await llm.get_client().ainvoke("summary", messages)
+            state["folded"] += 1
+            save_summary(store, user, note, state)
+
+
+def schedule_fold(store, user: str, note: str):
+    task = asyncio.create_task(metrics.background(fold_history(store, user, note), "summary"))
+    _fold_tasks.add(task)
+    # Summaries are best effort; a failed fold is retried after the next turn
+    task.add_done_callback(lambda t: _fold_tasks.discard(t) or t.cancelled() or t.exception())
+    return task
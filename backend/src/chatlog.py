@@ -0,0 +1,219 @@
+import fcntl
+import json
+import os
+import shutil
+import struct
+import time
+from contextlib import contextmanager
+from pathlib import Path as PathlibPath
+
+from context_cache import format_segment
+from tokens import count_tokens
+
+LOG_FILE = "chat.jsonl"
+INDEX_FILE = "chat.idx"
+LEGACY_DIR = "chat"
+OFFSET = struct.Struct(">Q")
+
+# log path -> (log size, index size) last seen consistent in this process
+_validated = {}
+# Logs found holding unparsable records, rewritten by the next compaction
+_damaged = set()
+
+
+def turn_record(name: str, text: str, created: float = None) -> dict:
+    # The token count is stored once so history selection never re-tokenizes
+    return {"name": name, "text": text, "created": created or time.time(),
+            "tokens": count_tokens(format_segment(name, text))}
+
+
+def _encode(record: dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+class ChatLog:
+    # One note's chat turns as an append-only JSONL log ("chat.jsonl") plus a
+    # fixed-width index of record offsets ("chat.idx"): turn i starts at
+    # index[i], so a page or the tail is one seek into each file. Writers hold
+    # an exclusive flock on the log; turns are identified by their position.
+
+    def __init__(self, note_dir: PathlibPath):
+        self.note_dir = note_dir
+        self.log = note_dir / LOG_FILE
+        self.index = note_dir / INDEX_FILE
+        self.legacy = note_dir / LEGACY_DIR
+
+    @contextmanager
+    def _locked(self):
+        self.note_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.log, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    # -- consistency ---------------------------------------------------------
+
+    def _scan(self):
+        # Intact records with their offsets, and where the last complete line ends
+        records, offsets, position, end = [], [], 0, 0
+        with self.log.open("rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    try:
+                        records.append(json.loads(line))
+                        offsets.append(position)
+                    except ValueError:
+                        _damaged.add(str(self.log))
+                    end = position + len(line)
+                position += len(line)
+        return records, offsets, end
+
+    def _check(self) -> bool:
+        # The index is right when its last offset starts the log's last line
+        log_size = self.log.stat().st_size if self.log.exists() else 0
+        index_size = self.index.stat().st_size if self.index.exists() else 0
+        if _validated.get(str(self.log)) == (log_size, index_size):
+            return True
+        if index_size % OFFSET.size:
+            return False
+        if not index_size:
+            return log_size == 0
+        with self.index.open("rb") as f:
+            f.seek(index_size - OFFSET.size)
+            (last,) = OFFSET.unpack(f.read(OFFSET.size))
+        with self.log.open("rb") as f:
+            f.seek(last)
+            line = f.readline()
+        if last + len(line) != log_size or not line.endswith(b"\n"):
+            return False
+        _validated[str(self.log)] = (log_size, index_size)
+        return True
+
+    def _repair(self, fd: int):
+        # Under the lock: cut a torn final line (crash mid-append) and
+        # rebuild the index from the intact records
+        _, offsets, end = self._scan()
+        if end < os.fstat(fd).st_size:
+            os.ftruncate(fd, end)
+        self._write_index(offsets)
+
+    def _ensure(self):
+        if not self.log.exists() and self.legacy.is_dir():
+            self._import_legacy()
+        if not self._check():
+            # Might only be an append in flight; recheck once it's done
+            with self._locked() as fd:
+                if not self._check():
+                    self._repair(fd)
+
+    def _import_legacy(self):
+        # chat/*.md from before the log, in filename (timestamp) order;
+        # compact() deletes the directory afterwards
+        with self._locked():
+            if self.log.stat().st_size:
+                return
+            files = sorted(self.legacy.glob("*.md"))
+            self._rewrite([turn_record(p.name, p.read_text(), p.stat().st_mtime) for p in files])
+
+    def _write_index(self, offsets):
+        tmp = self.index.with_name(f".{self.index.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(b"".join(OFFSET.pack(o) for o in offsets))
+        os.replace(tmp, self.index)
+        _validated.pop(str(self.log), None)
+
+    def _rewrite(self, records):
+        lines = [_encode(record) for record in records]
+        offsets, position = [], 0
+        for line in lines:
+            offsets.append(position)
+            position += len(line)
+        tmp = self.log.with_name(f".{self.log.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.log)
+        self._write_index(offsets)
+
+    # -- writes --------------------------------------------------------------
+
+    def append(self, record: dict) -> int:
+        # Returns the new turn's position
+        self._ensure()
+        line = _encode(record)
+        with self._locked() as fd:
+            if not self._check():
+                self._repair(fd)
+            offset = os.fstat(fd).st_size
+            os.write(fd, line)
+            os.fsync(fd)
+            with self.index.open("ab") as index:
+                position = index.tell() // OFFSET.size
+                index.write(OFFSET.pack(offset))
+            return position
+
+    def replace(self, records):
+        # Whole-log rewrite, for imports and migrations
+        with self._locked():
+            self._rewrite(records)
+
+    def needs_compaction(self) -> bool:
+        return self.legacy.is_dir() or str(self.log) in _damaged
+
+    def compact(self):
+        # Drops unparsable records and the imported chat/ directory
+        self._ensure()
+        with self._locked():
+            self._rewrite(self._scan()[0])
+            _damaged.discard(str(self.log))
+        shutil.rmtree(self.legacy, ignore_errors=True)
+
+    # -- reads ---------------------------------------------------------------
+
+    def count(self) -> int:
+        self._ensure()
+        return self.index.stat().st_size // OFFSET.size if self.index.exists() else 0
+
+    def peek_count(self) -> int:
+        # Like count(), for read-only callers (listings): no legacy import,
+        # repair or lock; a log that needs either is counted as it stands
+        if not self.log.exists():
+            return len(list(self.legacy.glob("*.md"))) if self.legacy.is_dir() else 0
+        if self._check():
+            return self.index.stat().st_size // OFFSET.size if self.index.exists() else 0
+        return len(self._scan()[0])
+
+    def read(self, start: int = 0, stop: int = None):
+        # Turns [start, stop) in log order
+        total = self.count()
+        start = max(start, 0)
+        stop = total if stop is None else min(stop, total)
+        if start >= stop:
+            return []
+        with self.index.open("rb") as f:
+            f.seek(start * OFFSET.size)
+            raw = f.read((stop - start + (stop < total)) * OFFSET.size)
+        bounds = [OFFSET.unpack_from(raw, i)[0] for i in range(0, len(raw), OFFSET.size)]
+        with self.log.open("rb") as f:
+            f.seek(bounds[0])
+            if stop < total:
+                data = f.read(bounds[-1] - bounds[0])
+            else:
+                # The final record ends at its newline; an append may be
+                # landing after it
+                data = f.read(bounds[-1] - bounds[0]) + f.readline()
+                bounds.append(bounds[0] + len(data))
+        records = []
+        for a, b in zip(bounds, bounds[1:]):
+            try:
+                # Up to the newline: unindexed garbage may follow a record
+                records.append(json.loads(data[a - bounds[0]:b - bounds[0]].partition(b"\n")[0]))
+            except ValueError:
+                continue
+        return records
+
+    def tail(self, n: int):
+        total = self.count()
+        return self.read(total - n, total)
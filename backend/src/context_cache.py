@@ -0,0 +1,118 @@
+import asyncio
+import os
+from collections import OrderedDict
+from pathlib import Path as PathlibPath
+
+from tokens import count_tokens
+
+
+def format_segment(name: str, text: str) -> str:
+    return f"\n\n{'='*5} {name} {'='*5}\n{text}"
+
+
+class ContextCache:
+    # LRU of formatted context segments keyed on file path, validated against
+    # (mtime_ns, size) on every lookup. Directory listings are cached against
+    # the directory's own mtime, which changes whenever an entry is added,
+    # removed or renamed into place.
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()  # path -> (mtime_ns, size, nbytes, segment, tokens)
+        self._listings = {}  # (directory, pattern) -> (mtime_ns, [paths])
+
+    def list_files(self, directory: PathlibPath, pattern: str):
+        try:
+            mtime = directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        key = (str(directory), pattern)
+        cached = self._listings.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        paths = sorted(directory.glob(pattern))
+        self._listings[key] = (mtime, paths)
+        return paths
+
+    def _entry(self, path: PathlibPath):
+        key = str(path)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self.invalidate(path)
+            return "", 0
+        entry = self._segments.get(key)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            self.hits += 1
+            self._segments.move_to_end(key)
+            return entry[3], entry[4]
+
+        self.misses += 1
+        self.invalidate(path)
+        segment = format_segment(path.name, path.read_text())
+        tokens = count_tokens(segment)
+        nbytes = len(segment.encode())
+        if nbytes <= self.max_bytes:
+            self._segments[key] = (st.st_mtime_ns, st.st_size, nbytes, segment, tokens)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._segments.popitem(last=False)
+                self.bytes -= evicted[2]
+        return segment, tokens
+
+    def segment(self, path: PathlibPath) -> str:
+        return self._entry(path)[0]
+
+    def segment_tokens(self, path: PathlibPath):
+        # (formatted segment, token count); the count is computed once per version
+        return self._entry(path)
+
+    def assemble(self, directory: PathlibPath, pattern: str = "*.md") -> str:
+        return "".join(self.segment(path) for path in self.list_files(directory, pattern))
+
+    def measure(self, directory: PathlibPath, pattern: str = "*.md"):
+        entries = [self._entry(path) for path in self.list_files(directory, pattern)]
+        return "".join(e[0] for e in entries), sum(e[1] for e in entries)
+
+    def invalidate(self, path: PathlibPath):
+        entry = self._segments.pop(str(path), None)
+        if entry:
+            self.bytes -= entry[2]
+        parent = str(path.parent)
+        for key in [k for k in self._listings if k[0] == parent]:
+            del self._listings[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._segments),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+cache = ContextCache(max_bytes=int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+
+async def watch(root: PathlibPath, on_change):
+    # Picks up edits made outside the API (editors, git checkouts, ...)
+    from watchfiles import awatch
+
+    root.mkdir(parents=True, exist_ok=True)
+    resolved = root.resolve()
+    async for changes in awatch(root):
+        for _, changed in changes:
+            # Cache keys use the same relative paths the routes build
+            on_change(root / PathlibPath(changed).relative_to(resolved))
+
+
+def start_watcher(root: PathlibPath, on_change):
+    if os.getenv("CONTEXT_CACHE_WATCH", "1") == "0":
+        return None
+    return asyncio.create_task(watch(root, on_change))
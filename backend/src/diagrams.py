@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+import llm
+import metrics
+import prompts
+from response_cache import cache as response_cache, cache_key
+
+DIAGRAM_MARKER = "\n\n**Merm:** "
+JOB_CONCURRENCY = int(os.getenv("DIAGRAM_JOB_CONCURRENCY", "4"))
+JOB_RETENTION = int(os.getenv("DIAGRAM_JOB_RETENTION", "100"))
+
+MERM_SYSTEM_PROMPT = "You are a helpful assistant which helps generate only suitable mermaid diagram for notes based on the tags, keywords and instructions as provided by the user only for the data provided."
+
+
+def split_diagram(text: str):
+    # (subsection body, generated diagram or None)
+    body, marker, diagram = text.partition(DIAGRAM_MARKER)
+    return body, (diagram.rstrip("\n") if marker else None)
+
+
+def content_hash(body: str) -> str:
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def merm_messages(body: str):
+    # Instructions first and the subsection last, so every diagram request
+    # shares the same prompt prefix
+    return [
+        SystemMessage(content=MERM_SYSTEM_PROMPT),
+        SystemMessage(content=prompts.registry.get("merm").text),
+        HumanMessage(content=f"Notes:\n{body}")
+    ]
+
+
+async def write_diagram(store, user: str, note: str, name: str, answer: str, digest: str = None):
+    # Replaces the subsection's diagram block instead of appending another
+    # one and records it in the diagram store; both happen under the note lock
+    async with store.lock(user, note):
+        text = store.read_subsection(user, note, name)
+        if text is None:
+            return
+        body, _ = split_diagram(text)
+        store.write_subsections(user, note, {name: f"{body}{DIAGRAM_MARKER}{answer}\n"})
+        if digest:
+            stored = store.get_meta(user, note, "diagrams") or {}
+            stored[name] = {"hash": digest, "mermaid": answer}
+            store.set_meta(user, note, "diagrams", stored)
+
+
+async def generate(store, user: str, note: str, name: str, bypass: bool = False):
+    # Returns (diagram, skipped). Diagrams are stored per subsection against
+    # the hash of its body, so an unchanged subsection never hits the model.
+    body, current = split_diagram(store.read_subsection(user, note, name))
+    digest = content_hash(body)
+    entry = (store.get_meta(user, note, "diagrams") or {}).get(name)
+    if not bypass:
+        metrics.cache_lookup("diagram", bool(entry and entry["hash"] == digest))
+    if not bypass and entry and entry["hash"] == digest:
+        if current != entry["mermaid"]:
+            await write_diagram(store, user, note, name, entry["mermaid"])
+        return entry["mermaid"], True
+
+    client = llm.get_client()
+    messages = merm_messages(body)
+
+    async def compute():
+        return {"mermaid": await client.ainvoke("merm", messages)}
+
+    result, cached = await response_cache.get_or_compute(cache_key(client.model_for("merm"), messages, route="merm"), compute, bypass=bypass)
+    if not bypass:
+        metrics.cache_lookup("response", cached)
+    answer = result["mermaid"]
+    await write_diagram(store, user, note, name, answer, digest)
+    return answer, cached
+
+
+class DiagramJob:
+    def __init__(self, user: str, note: str, names):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.note = note
+        self.created = time.time()
+        self.status = "running"
+        self.results = {name: {"status": "pending"} for name in names}
+        self._changed = asyncio.Event()
+
+    def update(self, name: str, **result):
+        self.results[name] = result
+        self._notify()
+
+    def finish(self):
+        self.status = "finished"
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def snapshot(self) -> dict:
+        counts = {}
+        for result in self.results.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.results),
+            "counts": counts,
+            "results": self.results,
+        }
+
+    async def events(self):
+        # Yields a snapshot now and after every change until the job finishes
+        while True:
+            changed = self._changed
+            yield self.snapshot()
+            if self.status == "finished":
+                return
+            await changed.wait()
+
+
+_jobs = {}
+_active = {}  # (user, note) -> job id, one running job per note
+_tasks = set()
+
+
+def model_calls(store, user: str, note: str, force: bool = False) -> int:
+    # How many subsections a new job would send to the model: all of them when
+    # forced, else those whose body no longer matches its stored diagram. A job
+    # already running for the note is returned as is and costs nothing.
+    running = _active.get((user, note))
+    if running and running in _jobs:
+        return 0
+    names = store.list_subsections(user, note)
+    if force:
+        return len(names)
+    stored = store.get_meta(user, note, "diagrams") or {}
+    calls = 0
+    for name in names:
+        entry = stored.get(name)
+        text = store.read_subsection(user, note, name)
+        if text is not None and not (entry and entry["hash"] == content_hash(split_diagram(text)[0])):
+            calls += 1
+    return calls
+
+
+async def _run(job: DiagramJob, store, names, force: bool, concurrency: int):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(name: str):
+        async with slots:
+            job.update(name, status="running")
+            try:
+                answer, skipped = await generate(store, job.user, job.note, name, bypass=force)
+                job.update(name, status="skipped" if skipped else "done", mermaid=answer)
+            except Exception as e:
+                job.update(name, status="failed", error=str(e))
+
+    try:
+        await asyncio.gather(*(one(name) for name in names))
+    finally:
+        _active.pop((job.user, job.note), None)
+        job.finish()
+
+
+def start_job(store, user: str, note: str, force: bool = False, concurrency: int = JOB_CONCURRENCY) -> DiagramJob:
+    running = _active.get((user, note))
+    if running and running in _jobs:
+        return _jobs[running]
+
+    names = store.list_subsections(user, note)
+    job = DiagramJob(user, note, names)
+    _jobs[job.id] = job
+    _active[(user, note)] = job.id
+    # Keep the most recent JOB_RETENTION jobs around for polling
+    for old in sorted(_jobs.values(), key=lambda j: j.created)[:-JOB_RETENTION]:
+        if old.status == "finished":
+            del _jobs[old.id]
+
+    task = asyncio.create_task(_run(job, store, names, force, concurrency))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
+
+
+def get_job(user: str, note: str, job_id: str):
+    job = _jobs.get(job_id)
+    if job is None or (job.user, job.note) != (user, note):
+        return None
+    return job
@@ -0,0 +1,163 @@
+import asyncio
+import os
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+import llm
+import metrics
+from context_cache import format_segment
+from diagrams import content_hash, split_diagram
+from scheduler import current_user
+from tokens import count_tokens
+
+# Raw passages picked for the query on top of the digest
+DIGEST_RAW_TOKENS = int(os.getenv("DIGEST_RAW_TOKENS", "2000"))
+# Sections this small are used as their own summary, without a model call
+DIGEST_MIN_TOKENS = int(os.getenv("DIGEST_MIN_TOKENS", "150"))
+# Longest section text sent to the model for one summary
+DIGEST_INPUT_CHARS = int(os.getenv("DIGEST_INPUT_CHARS", "24000"))
+# Seconds to wait after a write before digesting, so bursts of writes coalesce
+DIGEST_DELAY = float(os.getenv("DIGEST_DELAY", "2"))
+
+SECTION_PROMPT = (
+    "You write compact study digests of a user's notes. Summarize the section below: its key "
+    "concepts, definitions, facts, figures and how they relate. Keep the user's terminology. "
+    "Reply with the summary only, in under 150 words."
+)
+NOTE_PROMPT = (
+    "You write compact study digests of a user's notes. Below are summaries of every section "
+    "of one note. Write an overview of the whole note: its subject, main themes and how the "
+    "sections fit together. Reply with the overview only, in under 200 words."
+)
+
+_locks = {}
+_pending = {}  # (user, note) -> task
+_dirty = set()
+
+
+def load_digest(store, user: str, note: str) -> dict:
+    # "sections": segment name -> {hash, version, summary, tokens}, version
+    # being the store's document version the hash was taken at; "note":
+    # {hash, summary}
+    return store.get_meta(user, note, "digest") or {"sections": {}, "note": None}
+
+
+def save_digest(store, user: str, note: str, state: dict):
+    store.set_meta(user, note, "digest", state)
+
+
+def section_body(name: str, text: str) -> str:
+    # Generated diagrams are not part of what the user wrote
+    return split_diagram(text)[0] if name.endswith(".md") else text
+
+
+def note_hash(sections: dict) -> str:
+    return content_hash("".join(f"{name}\n{entry['hash']}\n" for name, entry in sorted(sections.items())))
+
+
+async def summarize(prompt: str, text: str) -> str:
+    messages = [SystemMessage(content=prompt), HumanMessage(content=text)]
+    return await llm.get_client().ainvoke("digest", messages)
+
+
+async def refresh_digest(store, user: str, note: str):
+    # Summaries are keyed by the hash of the section body, so only new or
+    # changed sections go to the model; the note overview is redone only
+    # when some section summary changed. Progress is saved per section.
+    lock = _locks.setdefault((user, note), asyncio.Lock())
+    async with lock:
+        current_user.set(user)
+        state = load_digest(store, user, note)
+        # Versions before text: a write in between leaves a stale version,
+        # never a current version on an old hash
+        versions = store.document_versions(user, note, include_uploads=True)
+        documents = store.note_documents(user, note, include_uploads=True)
+        sections = {}
+        for name, text in documents:
+            body = section_body(name, text)
+            digest = content_hash(body)
+            entry = state["sections"].get(name)
+            if not entry or entry["hash"] != digest:
+                tokens = count_tokens(body)
+                summary = body if tokens <= DIGEST_MIN_TOKENS else await summarize(SECTION_PROMPT, body[:DIGEST_INPUT_CHARS])
+                entry = {"hash": digest, "summary": summary.strip(), "tokens": tokens}
+                state["sections"][name] = entry
+                save_digest(store, user, note, state)
+            entry["version"] = versions.get(name)
+            sections[name] = entry
+
+        overall = note_hash(sections)
+        if sections and (state["note"] or {}).get("hash") != overall:
+            text = "".join(format_segment(name, entry["summary"]) for name, entry in sections.items())
+            state["note"] = {"hash": overall, "summary": (await summarize(NOTE_PROMPT, text)).strip()}
+        state["sections"] = sections
+        save_digest(store, user, note, state)
+
+
+async def _run(store, user: str, note: str):
+    key = (user, note)
+    while True:
+        _dirty.discard(key)
+        await asyncio.sleep(DIGEST_DELAY)
+        await refresh_digest(store, user, note)
+        if key not in _dirty:
+            return
+
+
+def _finished(key, task):
+    _pending.pop(key, None)
+    _dirty.discard(key)
+    # Digests are best effort; a failed run is retried after the next write
+    task.cancelled() or task.exception()
+
+
+def schedule_digest(store, user: str, note: str):
+    # One run per note at a time; writes during a run trigger another pass
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Written from a script: the next tutor or PUX turn schedules it
+        return None
+    key = (user, note)
+    if key in _pending:
+        _dirty.add(key)
+        return _pending[key]
+    task = _pending[key] = loop.create_task(metrics.background(_run(store, user, note), "digest"))
+    task.add_done_callback(lambda t: _finished(key, t))
+    return task
+
+
+def note_context(store, user: str, note: str, query: str, token_budget: int) -> str:
+    # Note overview and section summaries, plus the raw passages that best
+    # match the query. Falls back to the plain retrieved context while the
+    # digest is missing or stale (and has a refresh scheduled), and when the
+    # note is small enough that the digest would not save anything.
+    # Freshness is checked against document versions; only sections whose
+    # version moved are read, since the body may not have (a new diagram).
+    state = load_digest(store, user, note)
+    versions = store.document_versions(user, note, include_uploads=True)
+    entries = {name: state["sections"].get(name) for name in versions}
+    changed = [name for name, entry in entries.items() if not entry or entry.get("version") != versions[name]]
+    fresh = all(entries[name] for name in changed)
+    if fresh and changed:
+        documents = store.note_documents(user, note, include_uploads=True, names=set(changed))
+        fresh = len(documents) == len(changed) and all(
+            entries[name]["hash"] == content_hash(section_body(name, text)) for name, text in documents
+        )
+    metrics.cache_lookup("digest", fresh)
+    if changed:
+        # Stale, or current but stamped with an old version: either way a
+        # refresh brings the versions up to date
+        schedule_digest(store, user, note)
+    if not fresh:
+        return store.note_context(user, note, query, token_budget, include_uploads=True)
+
+    digest = "".join(format_segment(name, entry["summary"]) for name, entry in entries.items())
+    if state["note"] and state["note"]["hash"] == note_hash(entries):
+        digest = f"Overview of the note:\n{state['note']['summary']}\n\nSection summaries:{digest}"
+    digest_tokens = count_tokens(digest)
+    raw_budget = min(DIGEST_RAW_TOKENS, token_budget - digest_tokens)
+    if raw_budget <= 0 or sum(entry["tokens"] for entry in entries.values()) <= digest_tokens + raw_budget:
+        return store.note_context(user, note, query, token_budget, include_uploads=True)
+    passages = store.note_context(user, note, query, raw_budget, include_uploads=True)
+    return f"{digest}\n\nPassages most relevant to the query:{passages}"
@@ -0,0 +1,123 @@
+import datetime
+import gzip
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+
+from atomic import parse_if_match
+
+MIN_COMPRESS_BYTES = 1024
+SKIP_CONTENT_TYPES = ("text/event-stream", "image/", "application/zip", "application/pdf")
+
+
+def http_date(timestamp: float) -> str:
+    return format_datetime(datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc), usegmt=True)
+
+
+def not_modified(request: Request, etag: str, last_modified: float = None) -> bool:
+    # If-None-Match wins over If-Modified-Since (RFC 9110 13.2.2)
+    tags = parse_if_match(request.headers.get("if-none-match"))
+    if tags is not None:
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def conditional(request: Request, etag: str, last_modified: float, build):
+    # build() is only called when the client's copy is stale, so the body is
+    # never read or serialized for a 304
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(build(), headers=headers)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+class CompressionMiddleware:
+    # zstd (when the zstandard package is present) or gzip for complete JSON
+    # and text bodies; streamed responses such as SSE pass through untouched
+
+    def __init__(self, app, minimum_size: int = MIN_COMPRESS_BYTES, level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.zstd = _zstd()
+
+    def _encoding(self, scope) -> str:
+        accept = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1").lower()
+        offered = {part.split(";")[0].strip() for part in accept.split(",")}
+        if self.zstd and "zstd" in offered:
+            return "zstd"
+        if "gzip" in offered:
+            return "gzip"
+        return None
+
+    def _compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "zstd":
+            return self.zstd.ZstdCompressor(level=self.level).compress(body)
+        return gzip.compress(body, compresslevel=self.level + 3)
+
+    async def __call__(self, scope, receive, send):
+        encoding = self._encoding(scope) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = {k.lower(): v for k, v in start["headers"]}
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            body = message.get("body", b"")
+            if (
+                message.get("more_body")
+                or b"content-encoding" in headers
+                or len(body) < self.minimum_size
+                or content_type.startswith(SKIP_CONTENT_TYPES)
+            ):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            compressed = self._compress(encoding, body)
+            raw = [(k, v) for k, v in start["headers"] if k.lower() not in (b"content-length", b"etag")]
+            raw.append((b"content-encoding", encoding.encode()))
+            raw.append((b"content-length", str(len(compressed)).encode()))
+            raw.append((b"vary", b"Accept-Encoding"))
+            if b"etag" in headers:
+                # Encoded variants must not share the identity ETag; the
+                # suffix is stripped again by atomic.base_etag
+                tag = headers[b"etag"].decode("latin-1")
+                raw.append((b"etag", f'{tag[:-1]}--{encoding}"'.encode() if tag.endswith('"') else headers[b"etag"]))
+            await send({**start, "headers": raw})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, wrapped_send)
@@ -0,0 +1,337 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+import metrics
+from scheduler import current_user, scheduler
+from tokens import count_tokens, encoding
+
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+# Cheaper model for short mechanical work (diagrams, history summaries, note digests)
+FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4.1-nano")
+# Tried in order once a route's own models keep failing
+FALLBACK_MODELS = [m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "gpt-4.1-mini").split(",") if m.strip()]
+
+# Per-route caps on in-flight completions, e.g. LLM_ROUTE_LIMITS="ask=8,tutor=4"
+DEFAULT_ROUTE_LIMITS = {"ask": 8, "tutor": 8, "pux": 8, "merm": 4, "summary": 2, "digest": 2}
+# Model chain per route, e.g. LLM_ROUTE_MODELS="tutor=gpt-4o|gpt-4o-mini"
+DEFAULT_ROUTE_MODELS = {"merm": f"{FAST_MODEL}|{DEFAULT_MODEL}", "summary": f"{FAST_MODEL}|{DEFAULT_MODEL}",
+                        "digest": f"{FAST_MODEL}|{DEFAULT_MODEL}"}
+# Deadline in seconds for a whole call, retries and fallbacks included
+DEFAULT_ROUTE_TIMEOUTS = {"ask": 90, "tutor": 90, "pux": 90, "merm": 30, "summary": 45, "digest": 60}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Routes whose calls are sent a second time once they outlast the route's p95
+LLM_HEDGE_ROUTES = os.getenv("LLM_HEDGE_ROUTES", "merm")
+
+# The OpenAI SDK and LangChain's wrapper are most of the process's import
+# time; load_sdk() brings them in on first use or during the startup warm-up
+httpx = openai = ChatOpenAI = None
+# Worth another attempt: transient network and provider-side failures
+RETRYABLE = ()
+# Worth trying the next model: the above, or this model being unavailable
+FALLBACK_ON = ()
+
+RETRIES = metrics.Counter("notes_llm_retries_total", "Model call attempts retried after a transient error", ("route", "model"))
+FALLBACKS = metrics.Counter("notes_llm_fallbacks_total", "Calls moved on to the next model in the route's chain", ("route", "model"))
+HEDGES = metrics.Counter("notes_llm_hedges_total", "Second requests sent for slow calls, by which one answered", ("route", "winner"))
+
+
+def load_sdk():
+    global httpx, openai, ChatOpenAI, RETRYABLE, FALLBACK_ON
+    if FALLBACK_ON:
+        return
+    import httpx
+    import openai
+    if ChatOpenAI is None:
+        from langchain_openai import ChatOpenAI
+    RETRYABLE = (
+        TimeoutError, httpx.TransportError, openai.APITimeoutError, openai.APIConnectionError,
+        openai.RateLimitError, openai.InternalServerError,
+    )
+    FALLBACK_ON = RETRYABLE + (openai.NotFoundError, openai.PermissionDeniedError)
+
+
+class LLMUnavailable(Exception):
+    # Every model in the route's chain failed or the deadline passed
+    def __init__(self, route: str, cause: BaseException = None):
+        reason = f": {str(cause) or type(cause).__name__}" if cause else ""
+        super().__init__(f"The language model is unavailable for '{route}'{reason}")
+        self.route = route
+
+
+def parse_route_spec(spec: str, defaults: dict, cast=str) -> dict:
+    values = dict(defaults)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, value = item.partition("=")
+        values[route.strip()] = cast(value.strip())
+    return values
+
+
+def parse_route_limits(spec: str) -> dict:
+    return parse_route_spec(spec, DEFAULT_ROUTE_LIMITS, int)
+
+
+class CallPolicy:
+    # How one route calls the model: models in fallback order, overall
+    # deadline, retries per model and whether slow calls are hedged
+    __slots__ = ("models", "timeout", "retries", "hedge")
+
+    def __init__(self, models, timeout: float = 90.0, retries: int = LLM_MAX_RETRIES, hedge: bool = False):
+        self.models = list(dict.fromkeys(models))
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+
+
+def route_policies(model: str = DEFAULT_MODEL) -> dict:
+    models = parse_route_spec(os.getenv("LLM_ROUTE_MODELS", ""), DEFAULT_ROUTE_MODELS)
+    timeouts = parse_route_spec(os.getenv("LLM_ROUTE_TIMEOUTS", ""), DEFAULT_ROUTE_TIMEOUTS, float)
+    hedged = {route.strip() for route in LLM_HEDGE_ROUTES.split(",") if route.strip()}
+    return {
+        route: CallPolicy(
+            models.get(route, model).split("|") + FALLBACK_MODELS,
+            timeout=timeouts.get(route, 90.0),
+            hedge=route in hedged,
+        )
+        for route in set(DEFAULT_ROUTE_LIMITS) | set(models) | set(timeouts) | hedged
+    }
+
+
+class LLMClient:
+    # One ChatOpenAI per process sharing a pooled keep-alive httpx client, so
+    # requests reuse connections instead of paying a TLS handshake each time.
+
+    def __init__(self, model: str = DEFAULT_MODEL, route_limits: dict = None, policies: dict = None,
+                 max_connections: int = 32, keepalive_expiry: float = 30.0):
+        import httpx
+
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        self.model = model
+        self._chats = {}
+        self.policies = policies or route_policies(model)
+        self.limits = route_limits or dict(DEFAULT_ROUTE_LIMITS)
+        self._semaphores = {route: asyncio.Semaphore(n) for route, n in self.limits.items()}
+        self._latency = {}  # route -> recent successful call durations
+
+    def chat(self, model: str) -> "ChatOpenAI":
+        # Retries are ours (CallPolicy), so the SDK's own are turned off;
+        # stream_usage makes streamed calls report usage on the last chunk
+        if model not in self._chats:
+            load_sdk()
+            self._chats[model] = ChatOpenAI(model=model, http_async_client=self.http, stream_usage=True, max_retries=0)
+        return self._chats[model]
+
+    def policy(self, route: str) -> CallPolicy:
+        if route not in self.policies:
+            self.policies[route] = CallPolicy([self.model] + FALLBACK_MODELS)
+        return self.policies[route]
+
+    def model_for(self, route: str) -> str:
+        # The model a route normally answers with; part of response cache keys
+        return self.policy(route).models[0]
+
+    def _observe(self, route: str, seconds: float):
+        self._latency.setdefault(route, deque(maxlen=200)).append(seconds)
+
+    def _hedge_delay(self, route: str):
+        # The route's recent p95, once there are enough samples to trust it
+        samples = self._latency.get(route)
+        if not samples or len(samples) < 20:
+            return None
+        return sorted(samples)[int(len(samples) * 0.95) - 1]
+
+    async def _call(self, route: str, attempt, deadline: float):
+        # Runs attempt(model) through the route's model chain, retrying
+        # transient errors with jittered backoff, all within the deadline
+        load_sdk()
+        policy = self.policy(route)
+        error = None
+        for i, model in enumerate(policy.models):
+            if i:
+                FALLBACKS.inc(route=route, model=model)
+            retrying = AsyncRetrying(
+                stop=stop_after_attempt(policy.retries + 1) | (lambda state: time.monotonic() >= deadline),
+                wait=wait_random_exponential(multiplier=0.5, max=8),
+                retry=retry_if_exception_type(RETRYABLE),
+                before_sleep=lambda state, model=model: RETRIES.inc(route=route, model=model),
+                reraise=True,
+            )
+            try:
+                async for retry in retrying:
+                    with retry:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError(f"deadline of {policy.timeout}s exceeded")
+                        async with asyncio.timeout(remaining):
+                            return await attempt(model)
+            except FALLBACK_ON as e:
+                error = e
+                if time.monotonic() >= deadline:
+                    break
+        raise LLMUnavailable(route, error)
+
+    async def _hedged(self, route: str, model: str, messages):
+        # One request, plus a second one if the first outlasts the route's p95;
+        # the first successful answer wins and the other is cancelled
+        chat = self.chat(model)
+        start = time.perf_counter()
+        delay = self._hedge_delay(route) if self.policy(route).hedge else None
+        first = asyncio.ensure_future(chat.ainvoke(messages))
+        tasks, hedged, error = {first}, False, None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    tasks.add(asyncio.ensure_future(chat.ainvoke(messages)))
+                    hedged = True
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedged:
+                            HEDGES.inc(route=route, winner="first" if task is first else "second")
+                        self._observe(route, time.perf_counter() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _slot(self, route: str) -> asyncio.Semaphore:
+        if route not in self._semaphores:
+            self._semaphores[route] = asyncio.Semaphore(self.limits.get(route, 8))
+        return self._semaphores[route]
+
+    @asynccontextmanager
+    async def _acquire(self, route: str):
+        # Fair share of the global cap first, then the route's own limit
+        start = time.perf_counter()
+        async with scheduler.slot(current_user.get(), route), self._slot(route):
+            metrics.add_phase("llm_queue", time.perf_counter() - start)
+            yield
+
+    def _account(self, route: str, messages, completion: str, usage):
+        # Provider-reported usage when present, local token counts otherwise
+        if usage:
+            prompt_tokens, completion_tokens = usage["input_tokens"], usage["output_tokens"]
+        else:
+            prompt_tokens = sum(count_tokens(str(m.content)) for m in messages)
+            completion_tokens = count_tokens(completion)
+        metrics.LLM_TOKENS.inc(prompt_tokens, route=route, kind="prompt")
+        metrics.LLM_TOKENS.inc(completion_tokens, route=route, kind="completion")
+        metrics.PROMPT_TOKENS.observe(prompt_tokens, route=route)
+        metrics.record(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    async def ainvoke(self, route: str, messages) -> str:
+        async with self._acquire(route):
+            start = time.perf_counter()
+            deadline = time.monotonic() + self.policy(route).timeout
+            with metrics.span("model"):
+                result = await self._call(route, lambda model: self._hedged(route, model, messages), deadline)
+            metrics.LLM_SECONDS.observe(time.perf_counter() - start, route=route)
+        self._account(route, messages, result.content, getattr(result, "usage_metadata", None))
+        return result.content
+
+    async def _open_stream(self, model: str, messages):
+        # A stream counts as started once its first chunk arrives; failures
+        # before that are retried like any other call
+        stream = self.chat(model).astream(messages)
+        try:
+            return stream, await anext(stream, None)
+        except BaseException:
+            await stream.aclose()
+            raise
+
+    async def astream(self, route: str, messages):
+        # The route slot is held for the whole stream, not just the first
+        # token. Retries and fallbacks only happen before anything is yielded.
+        async with self._acquire(route):
+            start = time.perf_counter()
+            deadline = time.monotonic() + self.policy(route).timeout
+            first = None
+            parts, usage, stream = [], None, None
+            try:
+                stream, chunk = await self._call(route, lambda model: self._open_stream(model, messages), deadline)
+                while chunk is not None:
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    if chunk.content:
+                        if first is None:
+                            first = time.perf_counter() - start
+                            metrics.LLM_TTFT_SECONDS.observe(first, route=route)
+                            metrics.add_phase("model_ttft", first)
+                        parts.append(chunk.content)
+                        yield chunk.content
+                    try:
+                        async with asyncio.timeout(deadline - time.monotonic()):
+                            chunk = await anext(stream, None)
+                    except TimeoutError as e:
+                        raise LLMUnavailable(route, e) from e
+            finally:
+                if stream is not None:
+                    await stream.aclose()
+                elapsed = time.perf_counter() - start
+                metrics.LLM_SECONDS.observe(elapsed, route=route)
+                metrics.add_phase("model", elapsed)
+                self._account(route, messages, "".join(parts), usage)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+client: LLMClient = None
+
+
+def get_client() -> LLMClient:
+    if client is None:
+        raise RuntimeError("LLM client not started")
+    return client
+
+
+def start():
+    global client
+    client = LLMClient(
+        route_limits=parse_route_limits(os.getenv("LLM_ROUTE_LIMITS", "")),
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "32")),
+    )
+
+
+def warm_up():
+    # What the first model call would otherwise pay for: the SDK imports, the
+    # tokenizer, one ChatOpenAI per route model and the SDK's response models,
+    # whose pydantic serializers are built on first use and raced under load.
+    # Blocking; the lifespan runs it in a worker thread.
+    load_sdk()
+    encoding()
+    from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+    ChatCompletion.model_validate({
+        "id": "warm-up", "object": "chat.completion", "created": 0, "model": DEFAULT_MODEL,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": ""}}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }).model_dump()
+    ChatCompletionChunk.model_validate({
+        "id": "warm-up", "object": "chat.completion.chunk", "created": 0, "model": DEFAULT_MODEL,
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}}],
+    }).model_dump()
+    llm_client = get_client()
+    for policy in list(llm_client.policies.values()):
+        llm_client.chat(policy.models[0])
+
+
+async def close():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
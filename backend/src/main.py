@@ -1,23 +1,84 @@
-from fastapi import FastAPI, HTTPException, Path, Body, logger, UploadFile, File
+from fastapi import FastAPI, HTTPException, Path, Body, Depends, Header, Query, Request, logger
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from pathlib import Path as PathlibPath
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage
+from langchain_core.messages import SystemMessage, HumanMessage
+import asyncio
 import os
 from typing import List
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import datetime
+import re
+import time
+from contextlib import aclosing, asynccontextmanager
+
+import llm
+import diagrams
+import digests
+import metrics
+import prompts
+import storage
+import uploads
+from atomic import base_etag, etag, note_etag, parse_if_match
+from http_cache import CompressionMiddleware, conditional
+from manifest import CursorError
+from budget import Budget, schedule_fold, select_history
+from context_cache import cache as context_cache
+from patches import PatchError, apply_diff, apply_ops
+from response_cache import cache as response_cache, cache_key
+from scheduler import admission, admit_request
+from streaming import replay_answer, sse, stream_answer
 
 class QuestionRequest(BaseModel):
     query: str
     contextLevel: int  # You can adjust the data type as needed
     includeDiagram: bool
+    stream: bool = False  # Server-Sent Events instead of a single JSON body
+    bypassCache: bool = False  # Skip the response cache lookup (the fresh answer is still stored)
+    includeContext: bool = True  # Echo the assembled notes context back in the response
+
+# Completions in flight for one /ask/batch request; the scheduler caps the total
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "4"))
+ASK_BATCH_MAX_ITEMS = int(os.getenv("ASK_BATCH_MAX_ITEMS", "20"))
 
 class QueryModel(BaseModel):
     query: str
+    stream: bool = False
+
+# Startup state /readyz reports; "ready" once the warm-up below finished
+readiness = {"ready": False, "warmup_seconds": None, "error": None}
 
-app = FastAPI()
+async def warm_up():
+    # SDK imports, tokenizer, prompt token counts and serializers load off
+    # the event loop, so the server answers (and /healthz passes) while they do
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(llm.warm_up)
+        await asyncio.to_thread(prompts.registry.count_tokens)
+    except Exception as e:
+        logger.logger.exception("Startup warm-up failed")
+        readiness["error"] = str(e)
+        return
+    readiness["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    readiness["ready"] = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared, pooled LLM client for every route
+    prompts.registry.start()
+    llm.start()
+    store.start()
+    warming = asyncio.create_task(warm_up())
+    yield
+    warming.cancel()
+    readiness["ready"] = False
+    store.close()
+    prompts.registry.close()
+    uploads.shutdown()
+    await llm.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 load_dotenv()  # Load environment variables from .env file
 
 # CORS for React dev server
@@ -27,68 +88,310 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified"],
 )
+app.add_middleware(CompressionMiddleware)
+# Outermost, so timings include compression and the whole streamed body
+app.add_middleware(metrics.MetricsMiddleware)
 
 def ensure_user_dir(username: str) -> PathlibPath:
     user_dir = BASE_DIR / username
     user_dir.mkdir(parents=True, exist_ok=True)
     return user_dir
 
+FILENAME_UNSAFE = re.compile(r'[^\w\s-]')
+MERMAID_BLOCK = re.compile(r'```mermaid\n(.*?)\n```', re.DOTALL)
+
+def response_filename(query: str) -> str:
+    # Create a safe filename from the query
+    safe_query = FILENAME_UNSAFE.sub('', query)[:30].strip().replace(' ', '-').lower()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{timestamp}-{safe_query}.md"
+
+def extract_mermaid(answer: str):
+    # Extract Mermaid diagram from the response if it exists
+    mermaid_match = MERMAID_BLOCK.search(answer)
+    return mermaid_match.group(1) if mermaid_match else None
+
+def model_unavailable(error: Exception) -> HTTPException:
+    # Every model in the route's chain failed; the client may try again shortly
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "10"})
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 BASE_DIR = PathlibPath("users")
+# Directory tree (default) or SQLite, see NOTES_STORAGE / NOTES_DB_URL
+store = storage.open_store(BASE_DIR)
+
+def store_written(username: str, note_name: str, kind: str, name: str):
+    if kind == "chat":
+        # Fold turns that left the verbatim window into the rolling summary
+        schedule_fold(store, username, note_name)
+    else:
+        # Keep the note digest tutor and PUX turns use as context current
+        digests.schedule_digest(store, username, note_name)
+
+store.subscribe(store_written)
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")  # Optional
 
 # 1. List all notes (folders) for a user
 @app.get("/users/{username}/notes")
-async def list_user_notes(username: str):
-    user_dir = BASE_DIR / username
-    if not user_dir.exists():
+async def list_user_notes(
+    username: str,
+    request: Request,
+    sort: str = Query("name", pattern="^(name|modified|size)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    cursor: str = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    if not store.user_exists(username):
         raise HTTPException(status_code=404, detail="User not found")
-    folders = [f.name for f in user_dir.iterdir() if f.is_dir()]
-    return {"notes": folders}
+    # Served from the user's manifest: sizes, times and hashes without a
+    # directory walk, one page at a time
+    try:
+        listing = store.note_listing(username, sort, order == "desc", cursor, limit)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tag = etag(f"{listing['etag']}|{sort}|{order}|{cursor}|{limit}")
+    return conditional(request, tag, listing["modified"], lambda: {
+        "notes": [item["name"] for item in listing["items"]],
+        "items": listing["items"],
+        "next_cursor": listing["next_cursor"],
+        "total": listing["total"],
+    })
+
+# 1b. Full-text search over all of a user's subsections, chat turns and uploads
+@app.get("/users/{username}/search")
+async def search_user_notes(
+    username: str,
+    q: str = Query(..., min_length=1),
+    note: str = Query(None, description="Only search this note"),
+    kind: str = Query(None, pattern="^(subsection|chat|upload)$"),
+    limit: int = Query(20, ge=1, le=100),
+):
+    if not store.user_exists(username):
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"query": q, "hits": store.search(username, q, limit=limit, note=note, kind=kind)}
 
 # 2. List all subsections (markdown files) for a specific note (folder)
 @app.get("/users/{username}/notes/{note_name}")
-async def list_note_subsections(username: str, note_name: str):
-    note_dir = BASE_DIR / username / note_name
-    if not note_dir.exists() or not note_dir.is_dir():
+async def list_note_subsections(
+    username: str,
+    note_name: str,
+    request: Request,
+    sort: str = Query("name", pattern="^(name|modified|size)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    cursor: str = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    if not store.note_exists(username, note_name):
         raise HTTPException(status_code=404, detail="Note not found")
-    files = [f.name for f in note_dir.glob("*.md")]
-    return {"subsections": files}
+    try:
+        listing = store.subsection_listing(username, note_name, sort, order == "desc", cursor, limit)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tag = etag(f"{listing['etag']}|{sort}|{order}|{cursor}|{limit}")
+    return conditional(request, tag, listing["modified"], lambda: {
+        "subsections": [item["name"] for item in listing["items"]],
+        "items": listing["items"],
+        "next_cursor": listing["next_cursor"],
+        "total": listing["total"],
+    })
 
 # 3. Get content of all subsections in a note (folder)
 @app.get("/users/{username}/notes/{note_name}/content")
-async def get_note_content(username: str, note_name: str):
-    note_dir = BASE_DIR / username / note_name
-    if not note_dir.exists() or not note_dir.is_dir():
+async def get_note_content(
+    username: str,
+    note_name: str,
+    request: Request,
+    cursor: str = Query(None, description="Filename the previous page ended on"),
+    limit: int = Query(None, ge=1, le=500),
+):
+    if not store.note_exists(username, note_name):
         raise HTTPException(status_code=404, detail="Note not found")
 
-    # Read all markdown files in the folder and return their content as an array
-    subsections = []
-    for file in note_dir.glob("*.md"):
-        subsections.append({"filename": file.name, "content": file.read_text()})
-
-    return {"subsections": subsections}
+    # Validators come from the stored ETags, so a 304 never reads the content.
+    # Every page carries the note-level ETag: for a given cursor and limit it
+    # determines the page, and it is what If-Match on /update and PATCH
+    # .../content expects.
+    etags = store.subsection_etags(username, note_name)
+    page = [name for name in etags if cursor is None or name > cursor]
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1]
+    tag = note_etag(etags)
+    last_modified = store.last_modified(username, note_name, page)
+
+    # Read the subsections of this page and return their content as an array
+    def build():
+        subsections = [{"filename": name, "content": store.read_subsection(username, note_name, name), "etag": etags[name]} for name in page]
+        return {"subsections": subsections, "etag": tag, "next_cursor": next_cursor}
+
+    return conditional(request, tag, last_modified, build)
+
+# 3b. Get the content of a single subsection
+@app.get("/users/{username}/notes/{note_name}/content/{filename}")
+async def get_subsection_content(username: str, note_name: str, filename: str, request: Request):
+    tag = store.subsection_etags(username, note_name).get(filename) if store.note_exists(username, note_name) else None
+    if PathlibPath(filename).name != filename or tag is None:
+        raise HTTPException(status_code=404, detail="Subsection not found")
+    return conditional(
+        request, tag, store.last_modified(username, note_name, [filename]),
+        lambda: {"filename": filename, "content": store.read_subsection(username, note_name, filename), "etag": tag},
+    )
 
 # 4. Append content to a specific subsection markdown file
 
 # 5. Update multiple subsections (i.e., all the markdown files in a note)
 @app.post("/users/{username}/notes/{note_name}/update")
-async def update_note_subsections(username: str, note_name: str, subsections: List[dict] = Body(...)):
-    note_dir = BASE_DIR / username / note_name
-    if not note_dir.exists() or not note_dir.is_dir():
+async def update_note_subsections(
+    username: str,
+    note_name: str,
+    subsections: List[dict] = Body(...),
+    if_match: str = Header(None, alias="If-Match"),
+):
+    if not store.note_exists(username, note_name):
         raise HTTPException(status_code=404, detail="Note not found")
-    
+
+    # Validate the whole batch before touching anything
     for subsection in subsections:
-        subsection_file = note_dir / subsection["filename"]
-        if not subsection_file.exists():
-            raise HTTPException(status_code=404, detail=f"Subsection {subsection['filename']} not found")
-        
-        # Write the new content to the subsection file
-        with subsection_file.open("w") as f:
-            f.write(subsection["content"])
-    
-    return {"status": "success", "message": "Subsections updated"}
-@app.post("/users/{username}/notes/{note_name}/ask")
+        if not isinstance(subsection.get("filename"), str) or not isinstance(subsection.get("content"), str):
+            raise HTTPException(status_code=422, detail="Each subsection needs a filename and content")
+        if PathlibPath(subsection["filename"]).name != subsection["filename"]:
+            raise HTTPException(status_code=400, detail=f"Invalid subsection name {subsection['filename']}")
+
+    async with store.lock(username, note_name):
+        all_etags = store.subsection_etags(username, note_name)
+        current = {}
+        for subsection in subsections:
+            if subsection["filename"] not in all_etags:
+                raise HTTPException(status_code=404, detail=f"Subsection {subsection['filename']} not found")
+            current[subsection["filename"]] = all_etags[subsection["filename"]]
+
+        # Optimistic locking: per-subsection "etag" fields in the body and/or
+        # an If-Match header carrying the note-level ETag from GET .../content
+        conflicts = {
+            s["filename"]: current[s["filename"]]
+            for s in subsections
+            if s.get("etag") and base_etag(s["etag"]) != current[s["filename"]]
+        }
+        expected = parse_if_match(if_match)
+        if expected is not None and "*" not in expected:
+            if note_etag(all_etags) not in expected:
+                conflicts = conflicts or current
+        if conflicts:
+            raise HTTPException(status_code=412, detail={"message": "Subsections changed since they were read", "etags": conflicts})
+
+        # Write the new content to the subsections, all or nothing
+        etags = store.write_subsections(username, note_name, {s["filename"]: s["content"] for s in subsections})
+
+    return {"status": "success", "message": "Subsections updated", "etags": etags}
+
+class EditOp(BaseModel):
+    start: int  # Character offsets into the base version
+    end: int
+    text: str = ""  # Replacement for [start, end)
+
+class SubsectionPatch(BaseModel):
+    filename: str
+    etag: str = None  # Version the edits were made against (or a note-level If-Match)
+    ops: List[EditOp] = None
+    diff: str = None  # Unified diff, instead of ops
+
+# 5b. Apply edits to subsections instead of resending their whole content
+@app.patch("/users/{username}/notes/{note_name}/content")
+async def patch_note_subsections(
+    username: str,
+    note_name: str,
+    patches: List[SubsectionPatch] = Body(...),
+    if_match: str = Header(None, alias="If-Match"),
+):
+    if not store.note_exists(username, note_name):
+        raise HTTPException(status_code=404, detail="Note not found")
+    expected = parse_if_match(if_match)
+    if len({p.filename for p in patches}) != len(patches):
+        raise HTTPException(status_code=422, detail="Send all edits to a subsection in one patch")
+    for patch in patches:
+        if (patch.ops is None) == (patch.diff is None):
+            raise HTTPException(status_code=422, detail=f"{patch.filename}: send either ops or diff")
+        if patch.etag is None and expected is None:
+            raise HTTPException(status_code=428, detail=f"{patch.filename}: edits need a base version (etag or If-Match)")
+
+    async with store.lock(username, note_name):
+        all_etags = store.subsection_etags(username, note_name)
+        missing = [p.filename for p in patches if p.filename not in all_etags]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Subsection {missing[0]} not found")
+
+        # Edits only apply to the exact version they were made against
+        conflicts = {p.filename: all_etags[p.filename] for p in patches if p.etag and base_etag(p.etag) != all_etags[p.filename]}
+        if expected is not None and "*" not in expected and note_etag(all_etags) not in expected:
+            conflicts = conflicts or {p.filename: all_etags[p.filename] for p in patches}
+        if conflicts:
+            raise HTTPException(status_code=412, detail={"message": "Subsections changed since they were read", "etags": conflicts})
+
+        contents, changed = {}, {}
+        for patch in patches:
+            text = store.read_subsection(username, note_name, patch.filename)
+            try:
+                if patch.diff is not None:
+                    contents[patch.filename], ranges = apply_diff(text, patch.diff)
+                else:
+                    contents[patch.filename], ranges = apply_ops(text, [(op.start, op.end, op.text) for op in patch.ops])
+            except PatchError as e:
+                raise HTTPException(status_code=422, detail=f"{patch.filename}: {e}")
+            changed[patch.filename] = ranges
+
+        # Only the patched subsections are written (and re-indexed)
+        etags = store.write_subsections(username, note_name, contents)
+
+    return {"status": "success", "etags": etags, "etag": note_etag({**all_etags, **etags}), "changed": changed}
+
+def ask_system(include_diagram: bool):
+    return [prompts.registry.get(name) for name in (("ask", "ask_diagram") if include_diagram else ("ask",))]
+
+def ask_prompt(context: str, query: str, context_level: int, include_diagram: bool):
+    # Static prompt and note context first, the per-request parts last, so
+    # asks on the same note share the longest possible prefix with the
+    # provider's prompt cache whether or not they want a diagram
+    messages = [
+        SystemMessage(content=prompts.registry.get("ask").text),
+        SystemMessage(content=f"Notes:\n{context}"),
+    ]
+    if include_diagram:
+        messages.append(SystemMessage(content=prompts.registry.get("ask_diagram").text))
+    messages.append(HumanMessage(content=f"Now, based on these notes, generate further notes for the following query. If needed, refer to the context. Out of 5, I'd rate myself {context_level}/5 on the topic I'm about to ask you. The query is as follows.:\n{query}"))
+    return messages
+
+def ask_messages(username: str, note_name: str, query: str, context_level: int, include_diagram: bool):
+    # Relevant chunks of the note's subsections
+    budget = Budget(sum(prompt.tokens for prompt in ask_system(include_diagram)), query)
+    context = store.note_context(username, note_name, query, budget.remaining)
+    return ask_prompt(context, query, context_level, include_diagram), context
+
+def chat_messages(prompt, context: str, chat_history: str, query: str):
+    # Most stable first: system prompt, note context, history, then the query
+    messages = [
+        SystemMessage(content=prompt.text),
+        SystemMessage(content=f"The notes taken by the user is as follows: {context}."),
+    ]
+    if chat_history:
+        messages.append(SystemMessage(content=f"The chat history is as follows: {chat_history}."))
+    messages.append(HumanMessage(content=f"The query is as follows.:\n{query}"))
+    return messages
+
+async def existing_note(username: str, note_name: str):
+    # Ahead of admission, so a missing note does not cost a token
+    if not store.note_exists(username, note_name):
+        raise HTTPException(status_code=404, detail="Note not found")
+
+@app.post("/users/{username}/notes/{note_name}/ask", dependencies=[Depends(existing_note), Depends(admission)])
 async def ask_question_with_context(
     username: str = Path(...),
     note_name: str = Path(...),
@@ -98,83 +401,234 @@ async def ask_question_with_context(
     context_level = body.contextLevel
     include_diagram = body.includeDiagram
     
-    note_dir = BASE_DIR / username / note_name
-    
-    # Gather content from all markdown files (subsections) in the note folder
-    context = ""
-    for file in note_dir.glob("*.md"):
-        context += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        context += file.read_text()
-    
     try:
-        # LangChain LLM instance
-        llm = ChatOpenAI(model_name="gpt-4o-mini")
-        
-        # Prepare system prompt based on whether diagram is requested
-        system_prompt = (
-            "You are a helpful assistant which helps generate notes based on the tags, keywords, and instructions as provided by the user. "
-            "If the user's rating is low, explain the topic to them in a manner which can be easily understood even by a child. "
-            "Include vivid examples and explanations. If the rating is higher, provide detailed, in-depth information on the topic requested by the user. "
-            "Delve into the nitty-gritty details on the topic requested by the user."
-        )
-        
-        if include_diagram:
-            system_prompt += (
-                "\n\nAdditionally, you MUST include a Mermaid diagram to visualize the concept. "
-                "The diagram should be enclosed in mermaid code blocks like: ```mermaid\n[diagram code]\n```\n"
-                "Use appropriate diagram type (flowchart, sequence diagram, class diagram, etc.) based on the query context. "
-                "Keep the diagram clear, focused on the main concepts, and properly formatted according to Mermaid syntax. Return only a single mermaid diagram. NOT MORE THAN 1."
-            )
-        
-        # LangChain message-style prompt
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=f"Notes:\n{context}\n\nNow, based on these notes, generate further notes for the following query. If needed, refer to the context. Out of 5, I'd rate myself {context_level}/5 on the topic I'm about to ask you. The query is as follows.:\n{query}")
-        ]
-        
-        answer = llm(messages).content
+        client = llm.get_client()
+        with metrics.span("context"):
+            messages, context = ask_messages(username, note_name, query, context_level, include_diagram)
+        metrics.record(context_bytes=len(context.encode()))
+        key = cache_key(client.model_for("ask"), messages, route="ask")
+
+        def remember(result):
+            # The answer is now a subsection of the note itself, so asking the
+            # same thing again against the updated note should hit as well
+            after, _ = ask_messages(username, note_name, query, context_level, include_diagram)
+            response_cache.put(cache_key(client.model_for("ask"), after, route="ask"), result)
+
+        if body.stream:
+            cached = None if body.bypassCache else response_cache.get(key)
+            if not body.bypassCache:
+                metrics.cache_lookup("response", cached is not None)
+            if cached:
+                return sse_response(replay_answer(cached["answer"], {"filename": cached["filename"], "cached": True, "diagram": extract_mermaid(cached["answer"]) if include_diagram else None}))
+            writer = store.response_writer(username, note_name, "subsection", response_filename(query), header=f"# Response to: {query}\n\n")
+            # The mermaid extraction runs once the whole answer has arrived
+            def on_complete(answer):
+                result = {"answer": answer, "filename": writer.name}
+                response_cache.put(key, result)
+                remember(result)
+                return {"diagram": extract_mermaid(answer) if include_diagram else None}
+            return sse_response(stream_answer(client.astream("ask", messages), writer, on_complete))
+
+        async def compute():
+            answer = await client.ainvoke("ask", messages)
+            # Create a new subsection for the response
+            filename = response_filename(query)
+            with metrics.span("write"):
+                store.write_subsections(username, note_name, {filename: f"# Response to: {query}\n\n{answer}"})
+            return {"answer": answer, "filename": filename}
+
+        # Cache hits (and coalesced duplicates) reuse the subsection already written
+        result, cached = await response_cache.get_or_compute(key, compute, bypass=body.bypassCache)
+        if not body.bypassCache:
+            metrics.cache_lookup("response", cached)
+        if not cached:
+            remember(result)
+        answer = result["answer"]
         print("answer is below")
         print(answer)
-        # Create a new markdown file for the response
-        import time
-        import re
-        import datetime
-        
-        # Create a safe filename from the query
-        safe_query = re.sub(r'[^\w\s-]', '', query)[:30].strip().replace(' ', '-').lower()
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_filename = f"{timestamp}-{safe_query}.md"
-        
-        # Create the new subsection file
-        response_file = note_dir / new_filename
-        with response_file.open("w") as f:
-            f.write(f"# Response to: {query}\n\n{answer}")
         
         # Process the diagram if included
         mermaid_diagram = None
         if include_diagram:
-            # Extract Mermaid diagram from the response if it exists
-            mermaid_match = re.search(r'```mermaid\n(.*?)\n```', answer, re.DOTALL)
-            if mermaid_match:
-                mermaid_diagram = mermaid_match.group(1)
+            mermaid_diagram = extract_mermaid(answer)
         print("hiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiii")
 
         print(mermaid_diagram)
-        return {
+        response = {
             "status": "received",
             "username": username,
             "note_name": note_name,
-            "context": context,
             "answer": answer,
             "query": query,
+            "cached": cached,
             "diagram": mermaid_diagram if include_diagram and mermaid_diagram else None
         }
+        if body.includeContext:
+            response["context"] = context
+        return response
     
+    except llm.LLMUnavailable as e:
+        raise model_unavailable(e)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}\n{error_details}")
-@app.post("/users/{username}/notes/{note_name}/tutor")
+        logger.logger.exception("Error processing query")
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+
+class AskItem(BaseModel):
+    query: str
+    contextLevel: int
+    includeDiagram: bool = False
+
+class AskBatchRequest(BaseModel):
+    items: List[AskItem] = Field(min_length=1, max_length=ASK_BATCH_MAX_ITEMS)
+    stream: bool = False  # One "item" event per finished query, then "done"
+    bypassCache: bool = False
+    includeContext: bool = True
+
+async def batch_admission(username: str, body: AskBatchRequest):
+    # A batch is admitted as one request per query, then scheduled like /ask
+    admit_request(username, cost=len(body.items))
+
+def unique_filename(query: str, taken: set, existing) -> str:
+    # Batched queries are answered within the same second; keep their files
+    # apart from each other and from the note's existing subsections
+    filename = response_filename(query)
+    stem, n = filename.removesuffix(".md"), 2
+    while filename in taken or filename in existing:
+        filename, n = f"{stem}-{n}.md", n + 1
+    taken.add(filename)
+    return filename
+
+@app.post("/users/{username}/notes/{note_name}/ask/batch", dependencies=[Depends(batch_admission)])
+async def ask_batch(
+    username: str = Path(...),
+    note_name: str = Path(...),
+    body: AskBatchRequest = Body(...)
+):
+    if not store.note_exists(username, note_name):
+        raise HTTPException(status_code=404, detail="Note not found")
+    items = body.items
+
+    client = llm.get_client()
+    # One context for the whole batch, retrieved for all queries at once, so
+    # every completion shares the same prompt prefix
+    with metrics.span("context"):
+        system_tokens = max(sum(prompt.tokens for prompt in ask_system(item.includeDiagram)) for item in items)
+        budget = Budget(system_tokens, max((item.query for item in items), key=len))
+        context = store.note_context(username, note_name, " ".join(item.query for item in items), budget.remaining)
+    metrics.record(context_bytes=len(context.encode()))
+
+    # Identical items are answered once
+    groups = {}
+    for index, item in enumerate(items):
+        messages = ask_prompt(context, item.query, item.contextLevel, item.includeDiagram)
+        key = cache_key(client.model_for("ask"), messages, route="ask")
+        groups.setdefault(key, (item, messages, []))[2].append(index)
+
+    answers = {}  # filename -> (key, file text, result); written together at the end
+    taken = set()
+    slots = asyncio.Semaphore(ASK_BATCH_CONCURRENCY)
+
+    async def answer(key: str, item: AskItem, messages):
+        cached = None if body.bypassCache else response_cache.get(key)
+        if not body.bypassCache:
+            metrics.cache_lookup("response", cached is not None)
+        if cached:
+            return {"answer": cached["answer"], "filename": cached["filename"], "cached": True}
+        try:
+            async with slots:
+                text = await client.ainvoke("ask", messages)
+        except llm.LLMUnavailable as e:
+            return {"error": str(e)}
+        except Exception as e:
+            logger.logger.exception("Error processing batched query")
+            return {"error": f"Error processing query: {str(e)}"}
+        filename = unique_filename(item.query, taken, set(store.list_subsections(username, note_name)))
+        result = {"answer": text, "filename": filename}
+        answers[filename] = (key, f"# Response to: {item.query}\n\n{text}", result)
+        return {**result, "cached": False}
+
+    def item_results(key: str, outcome: dict):
+        item, _, indexes = groups[key]
+        for index in indexes:
+            if "error" in outcome:
+                yield {"index": index, "query": item.query, "status": "failed", "error": outcome["error"]}
+            else:
+                diagram = extract_mermaid(outcome["answer"]) if item.includeDiagram else None
+                yield {"index": index, "query": item.query, "status": "done", **outcome, "diagram": diagram}
+
+    def write_answers() -> dict:
+        # Every new answer becomes a subsection in one batch write; only then
+        # are they cached, so a cache hit always points at a written file
+        if not answers:
+            return {}
+        pending = dict(answers)
+        answers.clear()
+        with metrics.span("write"):
+            etags = store.write_subsections(username, note_name, {name: text for name, (_, text, _) in pending.items()})
+        for name, (key, _, result) in pending.items():
+            response_cache.put(key, result)
+            item = groups[key][0]
+            after, _ = ask_messages(username, note_name, item.query, item.contextLevel, item.includeDiagram)
+            response_cache.put(cache_key(client.model_for("ask"), after, route="ask"), result)
+        return etags
+
+    async def run():
+        async def one(key: str):
+            item, messages, _ = groups[key]
+            return key, await answer(key, item, messages)
+
+        tasks = [asyncio.create_task(one(key)) for key in groups]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                key, outcome = await finished
+                for result in item_results(key, outcome):
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def finish(results: list) -> dict:
+        # Also runs when the client went away: answers that finished are kept
+        try:
+            etags = write_answers()
+        except Exception as e:
+            logger.logger.exception("Error writing batched answers")
+            return {"error": f"Error writing answers: {str(e)}"}
+        failed = sum(1 for result in results if result["status"] == "failed")
+        return {"total": len(items), "succeeded": len(results) - failed, "failed": failed, "etags": etags}
+
+    results = []
+    if body.stream:
+        async def events():
+            try:
+                async with aclosing(run()) as outcomes:
+                    async for result in outcomes:
+                        results.append(result)
+                        yield sse("item", result)
+            finally:
+                done = finish(results)
+            yield sse("error", {"detail": done["error"]}) if "error" in done else sse("done", done)
+        return sse_response(events())
+
+    try:
+        async with aclosing(run()) as outcomes:
+            results = [result async for result in outcomes]
+    finally:
+        done = finish(results)
+    if "error" in done:
+        raise HTTPException(status_code=500, detail=done["error"])
+    response = {
+        "status": "received",
+        "username": username,
+        "note_name": note_name,
+        "results": sorted(results, key=lambda result: result["index"]),
+        **done,
+    }
+    if body.includeContext:
+        response["context"] = context
+    return response
+
+@app.post("/users/{username}/notes/{note_name}/tutor", dependencies=[Depends(admission)])
 async def tutor_route(
     username: str = Path(...),
     note_name: str = Path(...),
@@ -184,236 +638,30 @@ async def tutor_route(
     query = body.query
     print("belowwwwwwwwwwwwwwwwww")
     print(BASE_DIR)
-    note_dir = BASE_DIR / username / note_name
-    chat_dir = BASE_DIR / username / note_name / "chat"
-    upload_dir = BASE_DIR / username / note_name / "uploaded_files"
-    chat_dir.mkdir(parents=True, exist_ok=True)
 
-    
-    # Gather content from all markdown files (subsections) in the note folder
-    context = ""
-    for file in note_dir.glob("*.md"):
-        context += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        context += file.read_text()
-
-    # Gather content from the text files present in the uploaded_files subfolder
-    for file in upload_dir.glob("*.txt"):
-        context += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        context += file.read_text()
-    
-    chat_history = ""
-    for file in chat_dir.glob("*.md"):
-        chat_history += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        chat_history += file.read_text()
-    
-
-    print(chat_history)
     try:
-        # LangChain LLM instance
-        llm = ChatOpenAI(model_name="gpt-4o-mini")
+        client = llm.get_client()
         print("hi")
-        content='''Introduction
-Welcome to your personalized learning experience! In this journey, we'll dive deep into the concepts from your notes. Instead of just giving you answers, I’ll help you explore these ideas through reflective questions and guided thinking. By the end of this process, you’ll have a solid grasp of the material and be able to apply it effectively.
-
-As your tutor, my goal is to help you build a true understanding, not just memorize facts. I’ll challenge your thinking, guide you when necessary, and provide opportunities for you to test your comprehension. Let’s get started!
-
-Key Areas of Focus:
-1. Enduring Understandings – What is the core concept we want to explore in depth?
-2. Essential Questions – The big questions that will drive our inquiry and challenge your thinking.
-3. Knowledge & Skills – What should you know and be able to do with this concept by the end of our sessions?
-4. Evidence of Understanding – How can we measure whether you truly grasp the concept?
-Your Learning Path:
-Stage 1: Foundations
-
-Goal: Understand the basic concept in simple terms.
-
-What I’ll ask you: “Can you explain this concept in your own words? What do you think it means at its core?”
-
-Remember: I’m not looking for a perfect answer right away. Just your current understanding. I’ll ask follow-up questions to help you refine it. If you give a surface-level answer, I’ll ask you to dig deeper.
-
-Stage 2: Anatomy of the Concept
-
-Goal: Break down the core components of the concept.
-
-What I’ll ask you: “Can you identify the key elements that make up this idea? What are the specific features or characteristics?”
-
-What to expect: I’ll guide you through a dissection of the concept by asking you to differentiate it from related ideas. If needed, we’ll go back to clarify where certain boundaries lie.
-
-Stage 3: Comparison
-
-Goal: Understand how this concept relates to others.
-
-What I’ll ask you: “How does this concept compare to something you already know? What makes it different or similar?”
-
-What to expect: I might challenge your thinking here: “Are we looking at a case of overlapping concepts, or is there a clear distinction?”
-
-Stage 4: Application
-
-Goal: Start applying the concept to real-world situations.
-
-What I’ll ask you: “Can you think of an example where this concept plays out in reality? Why do you think it applies there?”
-
-What to expect: We’ll analyze how well you can apply the concept, looking for depth in your thinking: “What assumptions or expectations are you challenging or addressing in this example?”
-
-Stage 5: Reflection & Mastery
-
-Goal: Reflect on what you’ve learned and demonstrate mastery.
-
-What I’ll ask you: “How has your understanding evolved? What key insights do you now have that you didn’t before?”
-
-What to expect: I’ll challenge you to think critically: “Can you revisit any earlier responses and refine them based on what you now know? Where can you see your understanding growing?”
-
-Learning Rules:
-Rule 1 - Avoid Affirming Full Understanding Too Quickly: At the start and throughout all stages, I’ll acknowledge your effort, but I won’t confirm your understanding until we’ve delved deeper. I’ll ask follow-up questions like:
-
-“Why do you think this is the right explanation?”
-
-“What assumptions are you making here?”
-
-“Can you explain why this is the case and not the opposite?” This ensures we’re truly building understanding and not just agreeing on surface-level answers.
-
-Rule 2 - Surface Learner’s Mental Model Before Stage 1: Before we start, I’ll ask you to explain the concept in your own words without using examples. This helps surface any shallow or surface-level understanding. For example:
-
-“What does this idea really mean to you in one sentence?”
-
-“What do you think distinguishes this from a more traditional approach?”
-
-Rule 3 - Reinforce “Pause and Probe” After Every Example: After you provide an example, I’ll ask you to reflect on it:
-
-“What about this example makes it relevant?”
-
-“What makes this a true instance of the concept we’re discussing?”
-
-“What new insights does this example give you that you hadn’t considered?”
-
-Rule 4 - Clarify If You Skip a Question: If you jump ahead without reflecting deeply, I’ll gently guide you back:
-
-“Hold on a second, I’d like to revisit that earlier idea. Could you explain what you meant by [example]?”
-
-“Before we move forward, I think there’s something important we should clarify about your earlier point.”
-
-Rule 5 - Introduce “Pushback” for Deeper Thinking in Stages 2 & 3: During the anatomy and comparison stages, I’ll challenge you to think critically:
-
-“Could this example actually represent something different from what we’re discussing?”
-
-“Do you think there’s another way of framing this concept that might give us fresh insights?” This helps deepen your understanding and avoid simple confirmation bias.
-
-Rule 6 - Live Assessment Adjustment for Stage 5: When we reach the final stages, I’ll give you a live challenge where I introduce some gray areas:
-
-“Do you think this situation fits with the concept we’ve discussed? Why or why not?”
-
-“What might be the unintended consequences or overlooked factors in this situation?” Your responses will help assess how flexible and deep your understanding is.
-
-Final Assessment:
-If you reach the end of the learning journey, I’ll assess your understanding based on two rubrics:
-
-Concept Understanding Rubric (5-Point Scale)
-
-Understanding Skills Rubric (5-Point Scale)
-
-Concept Understanding Rubric (5-Point Scale)
-5 – Masterful Reframer
-
-Clearly explains the essence of the concept in their own words, not just examples.
-
-Consistently makes connections between different concepts.
-
-Demonstrates original, insightful examples.
-
-Anticipates nuances and variations in real-world applications.
-
-4 – Strategic Spotter
-
-Solid understanding of the concept with minor gaps.
-
-Provides relevant examples and explains them well.
-
-Occasionally needs prompting to connect broader ideas or anticipate consequences.
-
-3 – Emerging Thinker
-
-Understands basic definitions and can spot examples with guidance.
-
-Struggles to differentiate from other related concepts and occasionally gets stuck.
-
-Needs further coaching to refine their understanding.
-
-2 – Functional Fixer
-
-Focuses on surface-level details or visible problems.
-
-Struggles to reframe concepts or connect them to broader ideas.
-
-Needs further exploration and refinement of thinking.
-
-1 – Unaware or Misguided
-
-Little or no understanding of the core concept.
-
-Struggles to explain the idea or its application.
-
-Understanding Skills Rubric (5-Point Scale)
-5 – Self-Aware Sensemaker
-
-Actively questions assumptions and reflects on learning.
-
-Revises thinking after feedback and explores new perspectives.
-
-Makes connections across contexts.
-
-4 – Curious Connector
-
-Engages actively and asks insightful questions.
-
-Connects examples with broader ideas.
-
-Occasionally revises their view based on deeper thinking.
-
-3 – Responsive Reasoner
-
-Responds to prompts and guidance.
-
-Shows effort but needs support to deepen insights.
-
-Hesitates to revise thinking or explore different angles.
-
-2 – Passive Participant
-
-Waits for validation or direction before engaging.
-
-Rarely reflects deeply on concepts.
-
-Needs more scaffolding to build curiosity.
-
-1 – Answer-First Thinker
-
-Focuses on providing quick answers without exploring or understanding.
-
-Rarely engages in reflective thinking or deep inquiry.
-'''
-        # LangChain message-style prompt
-        messages = [
-            SystemMessage(content=content),
-            SystemMessage(content=f"The notes taken by the user is as follows: {context}. Similarly, the chat history is as follows: {chat_history}."),
-            HumanMessage(content=f"The query is as follows.:\n{query}")
-        ]
-
-        answer = llm(messages).content
+        prompt = prompts.registry.get("tutor")
+        # Fit history, then the note digest with the passages that match the
+        # query, into what the system prompt leaves
+        with metrics.span("context"):
+            budget = Budget(prompt.tokens, query)
+            chat_history = select_history(store, username, note_name, budget)
+            context = digests.note_context(store, username, note_name, query, budget.remaining)
+        metrics.record(context_bytes=len(context.encode()) + len(chat_history.encode()))
+
+        messages = chat_messages(prompt, context, chat_history, query)
+
+        if body.stream:
+            writer = store.response_writer(username, note_name, "chat", response_filename(query), header=f"Question: {query} \n Answer by the LLM: ")
+            return sse_response(stream_answer(client.astream("tutor", messages), writer))
+
+        answer = await client.ainvoke("tutor", messages)
         print(answer)
-        # Create a new markdown file for the response
-        import time
-        import re
-        
-        # Create a safe filename from the query
-        safe_query = re.sub(r'[^\w\s-]', '', query)[:30].strip().replace(' ', '-').lower()
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_filename = f"{timestamp}-{safe_query}.md"
-        
-        
-        # Create the new subsection file
-        response_file = chat_dir / new_filename
-        with response_file.open("w") as f:
-            f.write(f"Question: {query} \n Answer by the LLM: {answer}")
+        # Record the exchange as a new chat turn
+        with metrics.span("write"):
+            store.add_chat_turn(username, note_name, response_filename(query), f"Question: {query} \n Answer by the LLM: {answer}")
         
         return {
         "status": "received",
@@ -424,13 +672,13 @@ Rarely engages in reflective thinking or deep inquiry.
     }
 
         
+    except llm.LLMUnavailable as e:
+        raise model_unavailable(e)
     except Exception as e:
-        print("enception occured")
-        import traceback
-        error_details = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}\n{error_details}")
+        logger.logger.exception("Error processing query")
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
-@app.post("/users/{username}/notes/{note_name}/pux")
+@app.post("/users/{username}/notes/{note_name}/pux", dependencies=[Depends(admission)])
 async def pux_route(
     username: str = Path(...),
     note_name: str = Path(...),
@@ -440,86 +688,36 @@ async def pux_route(
     query = body.query
 
     
-    note_dir = BASE_DIR / username / note_name
-    chat_dir = BASE_DIR / username / note_name / "chat"
-    upload_dir = BASE_DIR / username / note_name / "uploaded_files"
-    chat_dir.mkdir(parents=True, exist_ok=True)
 
 
     
     
-    # Gather content from all markdown files (subsections) in the note folder
-    context = ""
-    for file in note_dir.glob("*.md"):
-        context += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        context += file.read_text()
-
-    # Gather content from the text files present in the uploaded_files subfolder
-    for file in upload_dir.glob("*.txt"):
-        context += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        context += file.read_text()
-    
-    chat_history = ""
-    for file in chat_dir.glob("*.md"):
-        chat_history += f"\n\n{'='*5} {file.name} {'='*5}\n"
-        chat_history += file.read_text()
     
 
 
     try:
-        # LangChain LLM instance
-        llm = ChatOpenAI(model_name="gpt-4o-mini")
-
-        content='''You're working with a client from a specialized domain (e.g., tech, legal, medical). Here's how to quickly understand their jargon and apply it to your project.
+        client = llm.get_client()
 
-1. Capture & Simplify
-Take note of unfamiliar terms and request simple explanations.
-Goal: Build basic understanding of key terms.
+        prompt = prompts.registry.get("business")
+        # Fit history, then the note digest with the passages that match the
+        # query, into what the system prompt leaves
+        with metrics.span("context"):
+            budget = Budget(prompt.tokens, query)
+            chat_history = select_history(store, username, note_name, budget)
+            context = digests.note_context(store, username, note_name, query, budget.remaining)
+        metrics.record(context_bytes=len(context.encode()) + len(chat_history.encode()))
 
-2. Contextualize & Connect
-Link the terms to your project—how do they affect your goals?
-Goal: Understand the practical impact of these concepts.
-Link the tags together such that it forms a story/workflow/plan
+        messages = chat_messages(prompt, context, chat_history, query)
 
-3. Align & Act
-Apply the terms to your business decisions, like budgeting or resources.
-Goal: Use the terms strategically in your work.
+        if body.stream:
+            writer = store.response_writer(username, note_name, "chat", response_filename(query), header=f"Question: {query} \n Answer by the LLM: ")
+            return sse_response(stream_answer(client.astream("pux", messages), writer))
 
-4. Evaluate & Reflect
-Look back on how these concepts fit into your project.
-Goal: Refine your understanding and approach.
-
-5. Cross-Question & Deepen Insight
-Challenge your understanding and dig deeper into the terms.
-Goal: Ensure a comprehensive grasp of the concepts.
-Generate further questions that can be thought.
-
-End Goal: Integrate these domain-specific terms into your business to make informed decisions and collaborate effectively.
-
-'''
-        # LangChain message-style prompt
-        messages = [
-            SystemMessage(content=content),
-            SystemMessage(content=f"The notes taken by the user is as follows: {context}. Similarly, the chat history is as follows: {chat_history}."),
-            HumanMessage(content=f"The query is as follows.:\n{query}")
-        ]
-
-        answer = llm(messages).content
-        
-        # Create a new markdown file for the response
-        import time
-        import re
-        
-        # Create a safe filename from the query
-        safe_query = re.sub(r'[^\w\s-]', '', query)[:30].strip().replace(' ', '-').lower()
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_filename = f"{timestamp}-{safe_query}.md"
+        answer = await client.ainvoke("pux", messages)
         
-        
-        # Create the new subsection file
-        response_file = chat_dir / new_filename
-        with response_file.open("w") as f:
-            f.write(f"Question: {query} \n Answer by the LLM: {answer}")
+        # Record the exchange as a new chat turn
+        with metrics.span("write"):
+            store.add_chat_turn(username, note_name, response_filename(query), f"Question: {query} \n Answer by the LLM: {answer}")
         
         return {
         "status": "received",
@@ -530,63 +728,149 @@ End Goal: Integrate these domain-specific terms into your business to make infor
     }
 
         
+    except llm.LLMUnavailable as e:
+        raise model_unavailable(e)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}\n{error_details}")
+        logger.logger.exception("Error processing query")
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+
+class DiagramJobRequest(BaseModel):
+    force: bool = False  # Regenerate even subsections whose content is unchanged
 
-@app.get("/users/{username}/notes/{filename}/{subtopic}")
-async def merm_route(username: str, filename: str,subtopic:str):
+async def diagram_admission(username: str, note_name: str, body: DiagramJobRequest = Body(DiagramJobRequest())):
+    # A job makes one model call per subsection it has to regenerate
+    if not store.note_exists(username, note_name):
+        raise HTTPException(status_code=404, detail="Note not found")
+    calls = diagrams.model_calls(store, username, note_name, force=body.force)
+    if calls:
+        admit_request(username, cost=calls)
+
+@app.post("/users/{username}/notes/{note_name}/diagrams", status_code=202, dependencies=[Depends(diagram_admission)])
+async def start_diagram_job(username: str, note_name: str, body: DiagramJobRequest = Body(DiagramJobRequest())):
+    job = diagrams.start_job(store, username, note_name, force=body.force)
+    return job.snapshot()
+
+@app.get("/users/{username}/notes/{note_name}/diagrams/{job_id}")
+async def get_diagram_job(username: str, note_name: str, job_id: str):
+    job = diagrams.get_job(username, note_name, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.snapshot()
+
+@app.get("/users/{username}/notes/{note_name}/diagrams/{job_id}/events")
+async def stream_diagram_job(username: str, note_name: str, job_id: str):
+    job = diagrams.get_job(username, note_name, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        async for snapshot in job.events():
+            yield sse("finished" if snapshot["status"] == "finished" else "progress", snapshot)
+    return sse_response(events())
+
+# Chat history of a note, newest page first; pass next_cursor as `before` for older turns
+@app.get("/users/{username}/notes/{note_name}/chat")
+async def get_chat_history(
+    username: str,
+    note_name: str,
+    before: int = Query(None, ge=0, description="Position the previous page started at"),
+    limit: int = Query(20, ge=1, le=200),
+):
+    if not store.note_exists(username, note_name):
+        raise HTTPException(status_code=404, detail="Note not found")
+    return store.chat_page(username, note_name, before=before, limit=limit)
+
+@app.get("/users/{username}/notes/{filename}/{subtopic}", dependencies=[Depends(admission)])
+async def merm_route(username: str, filename: str,subtopic:str, bypass_cache: bool = Query(False, alias="bypassCache")):
    
     subtopic = subtopic + ".md"
-    file_path = BASE_DIR / username / filename / subtopic
-    if not file_path.exists():
+    if store.read_subsection(username, filename, subtopic) is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    context = file_path.read_text()
-
-    # LangChain LLM instance
-    llm = ChatOpenAI(model_name="gpt-4o-mini")
-    # Open and read a file
-    fp = 'backend/prompts/merm.txt'  # Change this to your file name
-
+    # Unchanged subsections reuse their stored diagram; a new one replaces
+    # the previous "**Merm:**" block rather than being appended again
     try:
-        with open(fp, 'r') as file:
-            content = file.read()
-            print("File content read")
-    except FileNotFoundError:
-        print(f"Error: File '{fp}' not found.")
+        answer, _ = await diagrams.generate(store, username, filename, subtopic, bypass=bypass_cache)
+    except llm.LLMUnavailable as e:
+        raise model_unavailable(e)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"LangChain Error: {e}")
+    return {"mermaid":answer}
 
-    # LangChain message-style prompt
-    messages = [
-        SystemMessage(content="You are a helpful assistant which helps generate only suitable mermaid diagram for notes based on the tags, keywords and instructions as provided by the user only for the data provided."),
-        HumanMessage(content=f"""Notes:\n{context}\n\n {content}""")
+
+UPLOAD_BODY = {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "properties": {"file": {"type": "string", "format": "binary"}}, "required": ["file"],
+}}}}
+
+@app.post("/users/{username}/notes/{note_name}/upload", openapi_extra={"requestBody": UPLOAD_BODY})
+async def upload_route(username: str, note_name: str, request: Request):
+    # Path: users/username/notes/note_name/uploaded_files
+    # The body is parsed as it streams in, so oversized uploads are refused
+    # by Content-Length or cut off at the cap instead of being received whole;
+    # identical content is stored only once
+    file = uploads.StreamedUpload(request)
+    stored_name, sha256, size, duplicate = await store.save_upload(username, note_name, file)
+
+    return {
+        "message": f"File '{file.filename}' uploaded successfully to note '{note_name}' for user '{username}'.",
+        "filename": stored_name,
+        "sha256": sha256,
+        "size": size,
+        "duplicate": duplicate,
+    }
+
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process serves requests
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: prompts loaded and token-counted, store started, LLM client
+    # open and warmed up
+    checks = {
+        "prompts": prompts.registry.loaded(),
+        "store": store.started,
+        "llm": llm.client is not None,
+        "warmup": readiness["ready"],
+    }
+    ready = all(checks.values())
+    body = {"status": "ready" if ready else "starting", "checks": checks, "warmup_seconds": readiness["warmup_seconds"]}
+    if readiness["error"]:
+        body["error"] = readiness["error"]
+    return ORJSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_route():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def cache_gauges():
+    context_stats, response_stats = context_cache.stats(), response_cache.stats()
+    return [
+        ("notes_context_cache_bytes", "gauge", "Bytes held by the context cache", context_stats["bytes"]),
+        ("notes_context_cache_hits_total", "counter", "Context cache hits", context_stats["hits"]),
+        ("notes_context_cache_misses_total", "counter", "Context cache misses", context_stats["misses"]),
+        ("notes_response_cache_memory_bytes", "gauge", "Bytes held by the in-memory response cache", response_stats["memory_bytes"]),
+        ("notes_response_cache_coalesced_total", "counter", "Requests that awaited an identical in-flight completion", response_stats["coalesced"]),
     ]
-    
 
-    try:
-        answer = llm(messages).content
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LangChain Error: {e}")
+metrics.add_collector(cache_gauges)
 
-    # Append query and answer to markdown file
-    with file_path.open("a") as f:
-        f.write(f"\n\n**Merm:** {answer}\n")
-    return {"mermaid":answer}
 
+@app.get("/cache/context")
+async def context_cache_stats():
+    return context_cache.stats()
 
-@app.post("/users/{username}/notes/{note_name}/upload")
-async def upload_route(username: str, note_name: str, file: UploadFile = File(...)):
-    # Path: users/username/notes/note_name/uploaded_files
-    upload_path = BASE_DIR / username  / note_name / "uploaded_files"
-    upload_path.mkdir(parents=True, exist_ok=True)
 
-    # Save the uploaded file using the original filename
-    file_path = upload_path / file.filename
-    with open(file_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+@app.get("/cache/responses")
+async def response_cache_stats():
+    return response_cache.stats()
+
 
-    return {"message": f"File '{file.filename}' uploaded successfully to note '{note_name}' for user '{username}'."}
+@app.get("/prompts")
+async def prompt_stats():
+    return prompts.registry.stats()
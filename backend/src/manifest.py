@@ -0,0 +1,274 @@
+import asyncio
+import base64
+import json
+import os
+from bisect import bisect_left, bisect_right
+from pathlib import Path as PathlibPath
+
+from atomic import atomic_write, etag, file_etag, note_etag
+from chatlog import LOG_FILE
+
+MANIFEST_FILE = ".manifest.json"
+SORT_KEYS = ("name", "modified", "size")
+# JSON types a cursor's sort value may have, per sort key
+SORT_TYPES = {"name": (str,), "modified": (int, float), "size": (int,)}
+# Seconds between a change and persisting the manifest, so bursts write once
+MANIFEST_SAVE_DELAY = float(os.getenv("MANIFEST_SAVE_DELAY", "1"))
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(sort: str, descending: bool, entry: dict) -> str:
+    raw = json.dumps([sort, descending, entry[sort], entry["name"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool):
+    # (sort value, name) of the last entry of the previous page
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_descending, value, name = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError("Malformed cursor")
+    if (cursor_sort, cursor_descending) != (sort, descending):
+        raise CursorError("Cursor was issued for a different sort order")
+    # bool is an int; neither it nor a value of the wrong type is comparable
+    # with the sort column
+    if isinstance(value, bool) or not isinstance(value, SORT_TYPES[sort]) or not isinstance(name, str):
+        raise CursorError("Malformed cursor")
+    return value, name
+
+
+def page(ordered: list, sort: str, descending: bool, cursor: str = None, limit: int = 100):
+    # ordered: entries ascending by (sort value, name). Keyset pagination, so
+    # a page costs a binary search plus the page itself.
+    after = decode_cursor(cursor, sort, descending) if cursor else None
+    key = lambda entry: (entry[sort], entry["name"])
+    if descending:
+        stop = bisect_left(ordered, tuple(after), key=key) if after else len(ordered)
+        items, more = ordered[max(stop - limit, 0):stop][::-1], stop > limit
+    else:
+        start = bisect_right(ordered, tuple(after), key=key) if after else 0
+        items, more = ordered[start:start + limit], start + limit < len(ordered)
+    return items, encode_cursor(sort, descending, items[-1]) if more and items else None
+
+
+class UserManifest:
+    # Listing index of one user's tree, persisted as users/<user>/.manifest.json:
+    # per note its subsections (size, mtime, content hash), chat turn count
+    # and the directory mtime it was last reconciled against. Write paths
+    # keep it current through store events; a changed user or note directory
+    # mtime (something added, removed or renamed behind our back) makes the
+    # affected part rescan on its next listing. Subsections whose
+    # (mtime_ns, size) did not change keep their hash.
+
+    def __init__(self, user_dir: PathlibPath, chat_count):
+        self.user_dir = user_dir
+        self.path = user_dir / MANIFEST_FILE
+        self.chat_count = chat_count
+        self.notes = {}  # note -> record, see _scan_note
+        self.checked = None  # user dir mtime_ns of the last note-set reconcile
+        self._ordered = {}  # (note or None, sort) -> (entries ascending, latest modified)
+        self._etag = None
+        self._save_handle = None
+        try:
+            state = json.loads(self.path.read_text())
+            self.notes, self.checked = state["notes"], state["checked"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def _changed(self, note: str = None):
+        # Drops the sorted views the change affects: all of them without a note
+        if note is None:
+            self._ordered = {}
+        else:
+            self._ordered = {key: value for key, value in self._ordered.items() if key[0] not in (None, note)}
+        self._etag = None
+        self._schedule_save()
+
+    def _schedule_save(self):
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.save()
+        self._save_handle = loop.call_later(MANIFEST_SAVE_DELAY, self.save)
+
+    def save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        try:
+            before = self.user_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        atomic_write(self.path, json.dumps({"notes": self.notes, "checked": self.checked}))
+        if self.checked == before:
+            # Our own rename is not a reason to rescan the note set
+            self.checked = self.user_dir.stat().st_mtime_ns
+
+    def _summarize(self, note: str, record: dict):
+        subsections = record["subsections"]
+        record["entry"] = {
+            "name": note,
+            "subsections": len(subsections),
+            "size": sum(sub["size"] for sub in subsections.values()),
+            # Last edit of what the user sees; metadata writes do not count
+            "modified": max([record["chat_modified"]] + [sub["modified"] for sub in subsections.values()]) or record["dir_modified"],
+            "chat_turns": record["chat_turns"],
+            "etag": note_etag({name: sub["etag"] for name, sub in subsections.items()}),
+        }
+
+    def _subsection(self, path: PathlibPath, previous: dict = None):
+        st = path.stat()
+        version = [st.st_mtime_ns, st.st_size]
+        if previous and previous["version"] == version:
+            return previous
+        return {"name": path.name, "size": st.st_size, "modified": st.st_mtime, "etag": file_etag(path), "version": version}
+
+    def _scan_note(self, note: str):
+        note_dir = self.user_dir / note
+        try:
+            st = note_dir.stat()
+        except FileNotFoundError:
+            self.notes.pop(note, None)
+            return
+        old = self.notes.get(note, {}).get("subsections", {})
+        subsections = {}
+        for path in note_dir.glob("*.md"):
+            try:
+                subsections[path.name] = self._subsection(path, old.get(path.name))
+            except FileNotFoundError:
+                continue
+        try:
+            chat_modified = (note_dir / LOG_FILE).stat().st_mtime
+        except FileNotFoundError:
+            chat_modified = 0.0
+        record = {
+            "checked": st.st_mtime_ns,
+            "dir_modified": st.st_mtime,
+            "chat_modified": chat_modified,
+            "chat_turns": self.chat_count(note),
+            "subsections": subsections,
+        }
+        self._summarize(note, record)
+        self.notes[note] = record
+
+    def _note_changed(self, note: str) -> bool:
+        try:
+            return (self.user_dir / note).stat().st_mtime_ns != self.notes[note]["checked"]
+        except (FileNotFoundError, KeyError):
+            return True
+
+    def reconcile(self):
+        # The note set, when the user directory changed since the last look
+        try:
+            mtime = self.user_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.checked:
+            return
+        present = {entry.name for entry in os.scandir(self.user_dir) if entry.is_dir()} if mtime else set()
+        for note in set(self.notes) - present:
+            del self.notes[note]
+        for note in present:
+            if note not in self.notes or self._note_changed(note):
+                self._scan_note(note)
+        self.checked = mtime
+        self._changed()
+
+    def reconcile_note(self, note: str):
+        if self._note_changed(note):
+            self._scan_note(note)
+            self._changed(note)
+
+    def written(self, note: str, kind: str, name: str):
+        # Store event: refresh just what was written
+        record = self.notes.get(note)
+        if record is None:
+            self._scan_note(note)
+        elif kind == "subsection":
+            try:
+                record["subsections"][name] = self._subsection(self.user_dir / note / name, record["subsections"].get(name))
+            except FileNotFoundError:
+                record["subsections"].pop(name, None)
+        elif kind == "chat":
+            record["chat_turns"] = self.chat_count(note)
+            record["chat_modified"] = max(record["chat_modified"], (self.user_dir / note / LOG_FILE).stat().st_mtime)
+        else:
+            return
+        if note in self.notes:
+            self._summarize(note, self.notes[note])
+            # The event accounts for the directory change it caused
+            try:
+                self.notes[note]["checked"] = (self.user_dir / note).stat().st_mtime_ns
+            except FileNotFoundError:
+                pass
+        self._changed(note)
+
+    def _sorted(self, note, sort: str, entries):
+        # (entries ascending by sort, latest "modified" among them)
+        key = (note, sort)
+        if key not in self._ordered:
+            ordered = sorted(entries(), key=lambda entry: (entry[sort], entry["name"]))
+            self._ordered[key] = ordered, max((entry["modified"] for entry in ordered), default=0.0)
+        return self._ordered[key]
+
+    def etag(self) -> str:
+        if self._etag is None:
+            self._etag = etag("\n".join(
+                f"{note}:{record['entry']['etag']}:{record['chat_turns']}" for note, record in sorted(self.notes.items())
+            ))
+        return self._etag
+
+    def list_notes(self, sort: str, descending: bool, cursor: str, limit: int) -> dict:
+        self.reconcile()
+        ordered, modified = self._sorted(None, sort, lambda: [record["entry"] for record in self.notes.values()])
+        items, next_cursor = page(ordered, sort, descending, cursor, limit)
+        # Notes on this page changed outside the write paths are rescanned
+        stale = [entry["name"] for entry in items if self._note_changed(entry["name"])]
+        if stale:
+            for note in stale:
+                self._scan_note(note)
+                self._changed(note)
+            return self.list_notes(sort, descending, cursor, limit)
+        return {"items": items, "next_cursor": next_cursor, "total": len(ordered), "etag": self.etag(), "modified": modified}
+
+    def list_subsections(self, note: str, sort: str, descending: bool, cursor: str, limit: int) -> dict:
+        self.reconcile_note(note)
+        record = self.notes.get(note)
+        if record is None:
+            return {"items": [], "next_cursor": None, "total": 0, "etag": note_etag({}), "modified": 0.0}
+        ordered, _ = self._sorted(note, sort, lambda: [
+            {key: sub[key] for key in ("name", "size", "modified", "etag")} for sub in record["subsections"].values()
+        ])
+        items, next_cursor = page(ordered, sort, descending, cursor, limit)
+        return {"items": items, "next_cursor": next_cursor, "total": len(ordered), "etag": record["entry"]["etag"],
+                "modified": record["entry"]["modified"]}
+
+
+class Manifests:
+    def __init__(self, base_dir: PathlibPath, chat_count):
+        self.base_dir = base_dir
+        self.chat_count = chat_count  # (user, note) -> turns
+        self._users = {}
+
+    def get(self, user: str) -> UserManifest:
+        manifest = self._users.get(user)
+        if manifest is None:
+            manifest = self._users[user] = UserManifest(self.base_dir / user, lambda note: self.chat_count(user, note))
+        return manifest
+
+    def written(self, user: str, note: str, kind: str, name: str):
+        # Users not loaded yet are reconciled when first listed
+        manifest = self._users.get(user)
+        if manifest is not None:
+            manifest.written(note, kind, name)
+
+    def close(self):
+        for manifest in self._users.values():
+            if manifest._save_handle is not None:
+                manifest.save()
@@ -0,0 +1,232 @@
+import contextvars
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Requests slower than this many milliseconds are logged with their phase
+# breakdown; 0 disables the log. SLOW_REQUEST_LOG sends it to a file.
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_LOG = os.getenv("SLOW_REQUEST_LOG")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TOKEN_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+
+slow_log = logging.getLogger("slow_requests")
+slow_log.addHandler(logging.FileHandler(SLOW_REQUEST_LOG) if SLOW_REQUEST_LOG else logging.StreamHandler())
+slow_log.propagate = False
+slow_log.setLevel(logging.INFO)
+
+_registry = []
+_collectors = []
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labelnames + ("le",)
+        for key, series in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{_labels(names, key + (bound,))} {count}"
+            yield f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}"
+
+
+def add_collector(collect):
+    # collect() returns [(name, type, help, value)] sampled at scrape time
+    _collectors.append(collect)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        if metric.values:
+            lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, help, value in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram("notes_http_request_duration_seconds", "Request duration until the last body byte", ("route", "method", "status"))
+PHASE_SECONDS = Histogram("notes_request_phase_seconds", "Time spent per phase of a request", ("route", "phase"))
+CONTEXT_BYTES = Histogram("notes_context_bytes", "Bytes of notes context put into a prompt", ("route",), BYTES_BUCKETS)
+LLM_SECONDS = Histogram("notes_llm_duration_seconds", "Model call duration, queueing excluded", ("route",))
+LLM_TTFT_SECONDS = Histogram("notes_llm_time_to_first_token_seconds", "Time to the first streamed token", ("route",))
+LLM_TOKENS = Counter("notes_llm_tokens_total", "Prompt and completion tokens", ("route", "kind"))
+PROMPT_TOKENS = Histogram("notes_llm_prompt_tokens", "Prompt size per model call", ("route",), TOKEN_BUCKETS)
+CACHE_LOOKUPS = Counter("notes_cache_lookups_total", "Cache lookups per request route", ("route", "cache", "result"))
+
+
+class Trace:
+    # Phase timings and counters for the request being served
+    __slots__ = ("scope", "start", "phases", "counts")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counts = {}
+
+    @property
+    def route(self) -> str:
+        # The router adds the matched route to the scope; the label is its
+        # path template, never the raw path
+        route = self.scope.get("route")
+        return route.path if route is not None else self.scope.get("background", "unmatched")
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name: str, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def current() -> Trace:
+    return _trace.get()
+
+
+@contextmanager
+def span(phase: str):
+    # Usable around awaits as well; time is added to the current request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(phase, time.perf_counter() - start)
+
+
+def add_phase(phase: str, seconds: float):
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+def record(**counts):
+    # Per-request numbers such as context_bytes or prompt_tokens
+    trace = _trace.get()
+    if trace is not None:
+        for name, value in counts.items():
+            trace.count(name, value)
+
+
+def cache_lookup(cache: str, hit: bool):
+    trace = _trace.get()
+    CACHE_LOOKUPS.inc(route=trace.route if trace else "background", cache=cache, result="hit" if hit else "miss")
+    if trace is not None:
+        trace.count(f"{cache}_cache_{'hits' if hit else 'misses'}")
+
+
+async def background(coro, name: str):
+    # Wraps work spawned with create_task. The task starts with a copy of the
+    # request's context, so it gets a Trace of its own: its phases are
+    # reported under "background:<name>" and never added to the request.
+    trace = Trace({"background": f"background:{name}"})
+    _trace.set(trace)
+    try:
+        return await coro
+    finally:
+        for phase, seconds in trace.phases.items():
+            PHASE_SECONDS.observe(seconds, route=trace.route, phase=phase)
+
+
+def finish(trace: Trace, method: str, status: int):
+    total = time.perf_counter() - trace.start
+    REQUEST_SECONDS.observe(total, route=trace.route, method=method, status=str(status))
+    for phase, seconds in trace.phases.items():
+        PHASE_SECONDS.observe(seconds, route=trace.route, phase=phase)
+    if "context_bytes" in trace.counts:
+        CONTEXT_BYTES.observe(trace.counts["context_bytes"], route=trace.route)
+    if SLOW_REQUEST_MS and total * 1000 >= SLOW_REQUEST_MS:
+        slow_log.info(json.dumps({
+            "route": trace.route,
+            "method": method,
+            "status": status,
+            "ms": round(total * 1000, 1),
+            "phases_ms": {phase: round(seconds * 1000, 1) for phase, seconds in trace.phases.items()},
+            **trace.counts,
+        }))
+
+
+class MetricsMiddleware:
+    # Opens a Trace per HTTP request and closes it after the last body
+    # message, so streamed (SSE) responses are timed to their end
+
+    def __init__(self, app, skip=("/metrics",)):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope)
+        token = _trace.set(trace)
+        status = 500
+
+        async def wrapped_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            _trace.reset(token)
+            finish(trace, scope["method"], status)
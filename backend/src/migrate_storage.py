@@ -0,0 +1,50 @@
+"""Copy every note between the directory-tree store and the SQLite store.
+
+    python migrate_storage.py fs sqlite [--base-dir users] [--db-url sqlite:///notes.db]
+    python migrate_storage.py sqlite fs
+
+Run from the directory the server runs in. Notes already in the target are
+overwritten, so the migration can be repeated.
+"""
+import argparse
+
+from storage import NOTES_DB_URL, open_store
+
+
+def migrate(source, target, users=None):
+    counts = {"notes": 0, "subsections": 0, "chat": 0, "uploads": 0}
+    for user in users or source.list_users():
+        for note in source.list_notes(user):
+            data = source.export_note(user, note)
+            target.import_note(user, note, data)
+            counts["notes"] += 1
+            for kind in ("subsections", "chat", "uploads"):
+                counts[kind] += len(data[kind])
+            print(f"{user}/{note}: {len(data['subsections'])} subsections, {len(data['chat'])} chat turns, {len(data['uploads'])} uploads")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move notes between storage backends")
+    parser.add_argument("source", choices=["fs", "sqlite"])
+    parser.add_argument("target", choices=["fs", "sqlite"])
+    parser.add_argument("--base-dir", default="users", help="Directory tree root (also holds raw uploads)")
+    parser.add_argument("--target-base-dir", help="Directory tree root for the target, defaults to --base-dir")
+    parser.add_argument("--db-url", default=NOTES_DB_URL)
+    parser.add_argument("--user", action="append", help="Only migrate these users")
+    args = parser.parse_args()
+    if args.source == args.target and not args.target_base_dir:
+        parser.error("source and target are the same store")
+
+    source = open_store(args.base_dir, args.source, args.db_url)
+    target = open_store(args.target_base_dir or args.base_dir, args.target, args.db_url)
+    try:
+        counts = migrate(source, target, args.user)
+    finally:
+        source.close()
+        target.close()
+    print(", ".join(f"{count} {kind}" for kind, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
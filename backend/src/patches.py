@@ -0,0 +1,80 @@
+import re
+
+HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(ValueError):
+    pass
+
+
+def apply_ops(text: str, ops) -> tuple:
+    # ops: (start, end, replacement) with offsets in characters of the base
+    # text; they may come in any order but must not overlap. Returns the new
+    # text and the [start, end) ranges of the new text that changed.
+    pieces, changed, position, shift = [], [], 0, 0
+    for start, end, replacement in sorted(ops, key=lambda op: (op[0], op[1])):
+        if not 0 <= start <= end <= len(text):
+            raise PatchError(f"Edit [{start}, {end}) is outside the text (length {len(text)})")
+        if start < position:
+            raise PatchError(f"Edit [{start}, {end}) overlaps the previous one")
+        pieces += [text[position:start], replacement]
+        changed.append([start + shift, start + shift + len(replacement)])
+        shift += len(replacement) - (end - start)
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces), changed
+
+
+def apply_diff(text: str, diff: str) -> tuple:
+    # Unified diff (as from `diff -u` or `git diff`) against the base text.
+    # Context and removed lines must match the base; file headers are ignored.
+    lines = text.splitlines(keepends=True)
+    diff_lines = diff.splitlines(keepends=True)
+    i = next((n for n, line in enumerate(diff_lines) if line.startswith("@@")), None)
+    if i is None:
+        raise PatchError("The diff has no hunks")
+
+    out, changed, position, size = [], [], 0, 0
+    while i < len(diff_lines):
+        match = HUNK_RE.match(diff_lines[i])
+        if not match:
+            raise PatchError(f"Bad hunk header: {diff_lines[i].rstrip()}")
+        old_start, old_count = int(match[1]), int(match[2] if match[2] is not None else 1)
+        start = old_start - 1 if old_count else old_start
+        if start < position or start > len(lines):
+            raise PatchError(f"Hunk at line {old_start} is out of order or past the end")
+        for line in lines[position:start]:
+            out.append(line)
+            size += len(line)
+        position = start
+        hunk_start, modified, last = size, False, None
+        i += 1
+        while i < len(diff_lines) and not diff_lines[i].startswith("@@"):
+            line = diff_lines[i]
+            tag, body = (" ", line) if line in ("\n", "\r\n") else (line[:1], line[1:])
+            if tag == "\\":
+                # "\ No newline at end of file" applies to the line before
+                if last in (" ", "+") and out and out[-1].endswith("\n"):
+                    out[-1] = out[-1].rstrip("\r\n")
+                    size = sum(map(len, out))
+            elif tag in (" ", "-"):
+                if position >= len(lines) or lines[position].rstrip("\r\n") != body.rstrip("\r\n"):
+                    raise PatchError(f"Line {position + 1} does not match the diff")
+                if tag == " ":
+                    out.append(lines[position])
+                    size += len(lines[position])
+                else:
+                    modified = True
+                position += 1
+            elif tag == "+":
+                out.append(body)
+                size += len(body)
+                modified = True
+            else:
+                raise PatchError(f"Unexpected diff line: {line.rstrip()}")
+            last = tag
+            i += 1
+        if modified:
+            changed.append([hunk_start, size])
+    out.extend(lines[position:])
+    return "".join(out), changed
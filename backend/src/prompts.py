@@ -0,0 +1,102 @@
+import logging
+import os
+from pathlib import Path as PathlibPath
+
+from atomic import etag
+from context_cache import start_watcher
+from tokens import count_tokens
+
+# backend/prompts, independent of the working directory the server runs in
+PROMPT_DIR = PathlibPath(os.getenv("PROMPT_DIR", str(PathlibPath(__file__).resolve().parent.parent / "prompts")))
+# Prompts the routes use; the server does not start without them
+REQUIRED = ("ask", "ask_diagram", "business", "merm", "tutor")
+
+log = logging.getLogger("prompts")
+
+
+class Prompt:
+    __slots__ = ("name", "text", "etag", "_tokens")
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.etag = etag(text)
+        self._tokens = None
+
+    @property
+    def tokens(self) -> int:
+        # Counted on first use: loading the tokenizer is left to the startup
+        # warm-up (see count_tokens below) instead of blocking load()
+        if self._tokens is None:
+            self._tokens = count_tokens(self.text)
+        return self._tokens
+
+
+class PromptRegistry:
+    # Every *.txt under the prompt directory, read once and token-counted on
+    # first use.
+    # Edits are picked up by the file watcher; a file that turns empty or
+    # disappears keeps its last good version if a route needs it.
+
+    def __init__(self, directory: PathlibPath = PROMPT_DIR, required=REQUIRED):
+        self.directory = PathlibPath(directory)
+        self.required = tuple(required)
+        self._prompts = {}
+        self._watcher = None
+
+    def _read(self, path: PathlibPath) -> Prompt:
+        text = path.read_text()
+        if not text.strip():
+            raise ValueError(f"Prompt '{path.name}' is empty")
+        return Prompt(path.stem, text)
+
+    def load(self):
+        prompts = {prompt.name: prompt for prompt in map(self._read, sorted(self.directory.glob("*.txt")))}
+        missing = [name for name in self.required if name not in prompts]
+        if missing:
+            raise RuntimeError(f"Missing prompts in {self.directory}: {', '.join(missing)}")
+        self._prompts = prompts
+
+    def reload(self, path: PathlibPath):
+        if path.suffix != ".txt" or path.parent != self.directory:
+            return
+        try:
+            prompt = self._read(path)
+        except (FileNotFoundError, ValueError) as e:
+            if path.stem in self.required:
+                log.warning("Keeping the previous version of prompt '%s': %s", path.stem, e)
+            else:
+                self._prompts.pop(path.stem, None)
+            return
+        previous = self._prompts.get(prompt.name)
+        if previous is None or previous.etag != prompt.etag:
+            self._prompts[prompt.name] = prompt
+            log.info("Reloaded prompt '%s' (%d tokens)", prompt.name, prompt.tokens)
+
+    def start(self):
+        self.load()
+        self._watcher = start_watcher(self.directory, self.reload)
+
+    def close(self):
+        if self._watcher:
+            self._watcher.cancel()
+
+    def loaded(self) -> bool:
+        return bool(self._prompts)
+
+    def count_tokens(self):
+        # Blocking; the lifespan warm-up runs it in a worker thread
+        for prompt in list(self._prompts.values()):
+            prompt.tokens
+
+    def get(self, name: str) -> Prompt:
+        return self._prompts[name]
+
+    def stats(self) -> dict:
+        return {
+            name: {"tokens": prompt.tokens, "bytes": len(prompt.text.encode()), "etag": prompt.etag}
+            for name, prompt in sorted(self._prompts.items())
+        }
+
+
+registry = PromptRegistry()
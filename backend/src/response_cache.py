@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path as PathlibPath
+
+CACHE_DIR = PathlibPath(os.getenv("RESPONSE_CACHE_DIR", ".cache/responses"))
+TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+MEMORY_BYTES = int(os.getenv("RESPONSE_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+DISK_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def cache_key(model: str, messages, **extra) -> str:
+    # Content address over everything that shapes the completion
+    payload = {
+        "model": model,
+        "messages": [[m.type, m.content] for m in messages],
+        "extra": extra,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    # Two tiers: an in-memory LRU in front of one JSON file per key on disk.
+    # Both are bounded by bytes and entries expire after TTL_SECONDS. Identical
+    # requests that arrive while a completion is running share its result.
+
+    def __init__(self, directory: PathlibPath = CACHE_DIR, ttl: int = TTL_SECONDS,
+                 memory_bytes: int = MEMORY_BYTES, disk_bytes: int = DISK_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> (created, nbytes, value)
+        self._memory_used = 0
+        self._disk_used = None  # scanned lazily
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _path(self, key: str) -> PathlibPath:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, created: float, value: dict):
+        nbytes = len(json.dumps(value))
+        if nbytes > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old:
+            self._memory_used -= old[1]
+        self._memory[key] = (created, nbytes, value)
+        self._memory_used += nbytes
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted[1]
+
+    def get(self, key: str):
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry:
+            if now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                return entry[2]
+            self._memory.pop(key)
+            self._memory_used -= entry[1]
+
+        path = self._path(key)
+        try:
+            stored = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if now - stored["created"] > self.ttl:
+            self._unlink(path)
+            return None
+        self._remember(key, stored["created"], stored["value"])
+        return stored["value"]
+
+    def put(self, key: str, value: dict):
+        created = time.time()
+        self._remember(key, created, value)
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"created": created, "value": value})
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(data)
+        os.replace(tmp, path)
+        self._disk_used = self._scan_disk() if self._disk_used is None else self._disk_used + len(data)
+        if self._disk_used > self.disk_bytes:
+            self._evict_disk()
+
+    def _unlink(self, path: PathlibPath):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        if self._disk_used is not None:
+            self._disk_used -= size
+
+    def _scan_disk(self) -> int:
+        return sum(p.stat().st_size for p in self.directory.glob("*/*.json"))
+
+    def _evict_disk(self):
+        # Expired entries first, then least recently written, down to 90% of the cap
+        now = time.time()
+        files = sorted(self.directory.glob("*/*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            if self._disk_used <= self.disk_bytes * 0.9:
+                break
+            self._unlink(path)
+        for path in files:
+            if path.exists() and now - path.stat().st_mtime > self.ttl:
+                self._unlink(path)
+
+    async def get_or_compute(self, key: str, compute, bypass: bool = False):
+        # Returns (value, cached). bypass skips the lookup but still stores the
+        # fresh value; concurrent callers of the same key await one compute.
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value, True
+            if key in self._inflight:
+                self.coalesced += 1
+                return await asyncio.shield(self._inflight[key]), True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Nobody may be waiting; don't log "exception never retrieved"
+                future.exception()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        future.set_result(value)
+        self.put(key, value)
+        return value, False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_used,
+            "disk_bytes": self._disk_used,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+cache = ResponseCache()
@@ -0,0 +1,227 @@
+import math
+import os
+import re
+import zlib
+from collections import Counter, OrderedDict
+from pathlib import Path as PathlibPath
+
+from context_cache import cache as context_cache, format_segment
+from tokens import count_tokens
+
+TOKEN_RE = re.compile(r"\w+")
+CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1200"))
+TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "6000"))
+TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "12"))
+MAX_NOTES = int(os.getenv("RETRIEVAL_MAX_NOTES", "256"))
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+
+def terms(text: str):
+    return TOKEN_RE.findall(text.lower())
+
+
+def chunk_text(text: str, max_chars: int = CHUNK_CHARS):
+    # Paragraph-aligned chunks; paragraphs longer than max_chars are cut hard.
+    # Past 3/4 of the size, a chunk also ends after any paragraph whose hash
+    # says so: boundaries then depend on content rather than on everything
+    # before them, and an edit changes only the chunks around it.
+    chunks, current = [], ""
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        if not para:
+            continue
+        while len(para) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(para[:max_chars])
+            para = para[max_chars:]
+        if current and len(current) + len(para) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{para}" if current else para
+        if len(current) >= max_chars * 3 // 4 and zlib.crc32(para.encode()) % 4 == 0:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class Chunk:
+    __slots__ = ("source", "position", "text", "tf", "length", "tokens")
+
+    def __init__(self, source: str, position: int, text: str):
+        self.source = source
+        self.position = position
+        self.text = text
+        self.tf = Counter(terms(text))
+        self.length = sum(self.tf.values())
+        self.tokens = count_tokens(text)
+
+
+class NoteIndex:
+    # Incremental BM25 index over the chunks of one note's documents. Each
+    # document is re-chunked only when its version (for files: mtime_ns and
+    # size) changes, and chunks whose text survived the edit are kept as they
+    # are, so a small edit only re-tokenizes the paragraphs it touched.
+
+    def __init__(self):
+        self.sources = {}  # key -> (version, [Chunk])
+        self.postings = {}  # term -> {Chunk: tf}
+        self.total_length = 0
+        self.chunk_count = 0
+
+    def _drop(self, chunks):
+        for chunk in chunks:
+            for term in chunk.tf:
+                bucket = self.postings.get(term)
+                if bucket is not None:
+                    bucket.pop(chunk, None)
+                    if not bucket:
+                        del self.postings[term]
+            self.total_length -= chunk.length
+            self.chunk_count -= 1
+
+    def _remove(self, key: str):
+        entry = self.sources.pop(key, None)
+        if entry:
+            self._drop(entry[1])
+
+    def update_text(self, key: str, name: str, version, text: str):
+        entry = self.sources.get(key)
+        if entry and entry[0] == version:
+            return
+        old = {}
+        for chunk in entry[1] if entry else ():
+            old.setdefault(chunk.text, []).append(chunk)
+        chunks = []
+        for i, piece in enumerate(chunk_text(text)):
+            reused = old.get(piece)
+            if reused:
+                chunk = reused.pop()
+                chunk.position = i
+            else:
+                chunk = Chunk(name, i, piece)
+                for term, tf in chunk.tf.items():
+                    self.postings.setdefault(term, {})[chunk] = tf
+                self.total_length += chunk.length
+                self.chunk_count += 1
+            chunks.append(chunk)
+        self._drop(chunk for remaining in old.values() for chunk in remaining)
+        self.sources[key] = (version, chunks)
+
+    def update(self, path: PathlibPath):
+        key = str(path)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self._remove(key)
+            return
+        version = (st.st_mtime_ns, st.st_size)
+        entry = self.sources.get(key)
+        if entry and entry[0] == version:
+            return
+        self.update_text(key, path.name, version, path.read_text())
+
+    def retain(self, keys):
+        wanted = set(keys)
+        for key in [k for k in self.sources if k not in wanted]:
+            self._remove(key)
+
+    def sync(self, paths):
+        # Brings the index in line with the current file listing
+        self.retain(str(p) for p in paths)
+        for path in paths:
+            self.update(path)
+
+    def score(self, query: str) -> dict:
+        scores = {}
+        if not self.chunk_count:
+            return scores
+        avg_length = self.total_length / self.chunk_count
+        for term in set(terms(query)):
+            bucket = self.postings.get(term)
+            if not bucket:
+                continue
+            idf = math.log(1 + (self.chunk_count - len(bucket) + 0.5) / (len(bucket) + 0.5))
+            for chunk, tf in bucket.items():
+                norm = tf + K1 * (1 - B + B * chunk.length / avg_length)
+                scores[chunk] = scores.get(chunk, 0.0) + idf * tf * (K1 + 1) / norm
+        return scores
+
+    def chunks(self, keys):
+        for key in keys:
+            entry = self.sources.get(str(key))
+            if entry:
+                yield from entry[1]
+
+
+class IndexRegistry:
+    def __init__(self, max_notes: int = MAX_NOTES):
+        self.max_notes = max_notes
+        self._indexes = OrderedDict()  # note_dir -> NoteIndex
+
+    def get(self, note_dir: PathlibPath) -> NoteIndex:
+        key = str(note_dir)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = NoteIndex()
+            while len(self._indexes) > self.max_notes:
+                self._indexes.popitem(last=False)
+        self._indexes.move_to_end(key)
+        return index
+
+    def notify(self, path: PathlibPath, note_dir: PathlibPath):
+        # Write-path hook: only files already indexed in a loaded note are
+        # refreshed; new files and unloaded notes are picked up by sync()
+        index = self._indexes.get(str(note_dir))
+        if index is not None and str(path) in index.sources:
+            index.update(path)
+
+
+indexes = IndexRegistry()
+
+
+def select_context(note_dir: PathlibPath, sources, query: str,
+                   token_budget: int = TOKEN_BUDGET, top_k: int = TOP_K) -> str:
+    # sources: (directory, pattern) pairs, e.g. the note's *.md and its uploads.
+    # Notes that fit the budget are passed through whole (straight from the
+    # context cache); larger ones are cut down to the best-scoring BM25
+    # chunks, kept in document order.
+    measured = [context_cache.measure(directory, pattern) for directory, pattern in sources]
+    if sum(tokens for _, tokens in measured) <= token_budget:
+        return "".join(text for text, _ in measured)
+
+    paths = [p for directory, pattern in sources for p in context_cache.list_files(directory, pattern)]
+    index = indexes.get(note_dir)
+    index.sync(paths)
+
+    return format_chunks(pick_chunks(index, list(index.chunks(paths)), query, token_budget, top_k))
+
+
+def pick_chunks(index: NoteIndex, chunks, query: str, token_budget: int = TOKEN_BUDGET, top_k: int = TOP_K):
+    # Best-scoring chunks under the budget, returned in document order
+    if sum(c.tokens for c in chunks) <= token_budget:
+        return chunks
+    scores = index.score(query)
+    ranked = sorted(chunks, key=lambda c: scores.get(c, 0.0), reverse=True)
+    chosen, used = set(), 0
+    for chunk in ranked:
+        if len(chosen) >= top_k:
+            break
+        if used + chunk.tokens > token_budget:
+            continue
+        chosen.add(chunk)
+        used += chunk.tokens
+    return [c for c in chunks if c in chosen]
+
+
+def format_chunks(chunks) -> str:
+    grouped = OrderedDict()
+    for chunk in chunks:
+        grouped.setdefault(chunk.source, []).append(chunk.text)
+    return "".join(format_segment(name, "\n\n".join(texts)) for name, texts in grouped.items())
@@ -0,0 +1,177 @@
+import asyncio
+import contextvars
+import heapq
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+import metrics
+
+# Model calls in flight across all users and routes
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Calls allowed to wait for a slot before new requests get a 503
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+# Calls one user may have waiting before their new requests get a 429
+LLM_USER_MAX_QUEUE = int(os.getenv("LLM_USER_MAX_QUEUE", "8"))
+# Token bucket per user: LLM-bound requests per second, and the burst allowed
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE", "0.5"))
+LLM_USER_BURST = float(os.getenv("LLM_USER_BURST", "10"))
+# Fair-queueing weights, e.g. LLM_USER_WEIGHTS="alice=2,batch=0.5"; default 1
+LLM_USER_WEIGHTS = os.getenv("LLM_USER_WEIGHTS", "")
+
+QUEUE_WAIT_SECONDS = metrics.Histogram("notes_llm_queue_wait_seconds", "Time a model call waited for a scheduler slot", ("route",))
+REJECTIONS = metrics.Counter("notes_llm_rejections_total", "LLM-bound requests refused at admission", ("reason",))
+
+# The user LLM calls are scheduled for; set by admission and inherited by
+# tasks the request spawns (diagram jobs, history folds)
+current_user = contextvars.ContextVar("llm_user", default="")
+
+
+def parse_weights(spec: str) -> dict:
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        user, _, value = item.partition("=")
+        weights[user.strip()] = float(value)
+    return weights
+
+
+class Scheduler:
+    # Global concurrency cap with weighted fair queueing across users: each
+    # waiting call gets a virtual finish tag (start + 1 / weight, where start
+    # is the later of the scheduler's virtual time and the user's previous
+    # tag) and freed slots go to the smallest tag, so a user with many queued
+    # calls cannot starve one with a single call.
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 user_max_queue: int = LLM_USER_MAX_QUEUE, rate: float = LLM_USER_RATE,
+                 burst: float = LLM_USER_BURST, weights: dict = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.user_max_queue = user_max_queue
+        self.rate = rate
+        self.burst = burst
+        self.weights = weights or {}
+        self.active = 0
+        self._heap = []  # (finish tag, seq, future)
+        self._seq = 0
+        self._vtime = 0.0
+        self._last_tag = {}  # user -> finish tag of their latest queued call
+        self._waiting = {}  # user -> calls waiting
+        self._enqueued = {}  # future -> enqueue time, for the oldest-wait gauge
+        self._buckets = {}  # user -> [tokens, last refill]
+        self._hold = 1.0  # moving average of seconds a slot is held
+
+    @property
+    def queued(self) -> int:
+        return len(self._enqueued)
+
+    def oldest_wait(self) -> float:
+        return time.monotonic() - min(self._enqueued.values()) if self._enqueued else 0.0
+
+    def _take_token(self, user: str, cost: float = 1) -> float:
+        # 0 when the tokens were taken, else seconds until they are available
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(user, [self.burst, now])
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / self.rate
+
+    def admit(self, user: str, cost: float = 1):
+        # Called once per LLM-bound request, before any work is done; batch
+        # requests cost one token per model call they will make. A cost the
+        # bucket can never hold is refused outright rather than clamped.
+        if self.rate > 0 and cost > self.burst:
+            REJECTIONS.inc(reason="too_large")
+            raise HTTPException(status_code=413, detail=f"Request needs {cost:g} model calls, more than the {self.burst:g} a user may burst")
+        if self.queued >= self.max_queue:
+            REJECTIONS.inc(reason="queue_full")
+            retry = self.queued / max(self.max_concurrency, 1) * self._hold
+            raise HTTPException(status_code=503, detail="Server busy, try again later",
+                                headers={"Retry-After": str(max(math.ceil(retry), 1))})
+        if self._waiting.get(user, 0) >= self.user_max_queue:
+            REJECTIONS.inc(reason="user_queue")
+            raise HTTPException(status_code=429, detail="Too many requests in progress",
+                                headers={"Retry-After": str(max(math.ceil(self._hold), 1))})
+        wait = self._take_token(user, cost)
+        if wait:
+            REJECTIONS.inc(reason="rate")
+            raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                                headers={"Retry-After": str(math.ceil(wait))})
+
+    def _release(self):
+        # Hands the slot straight to the next waiter, skipping cancelled ones
+        while self._heap:
+            tag, _, future = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue
+            self._vtime = tag
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user: str, route: str = ""):
+        start = time.monotonic()
+        if self.active < self.max_concurrency and not self._enqueued:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            tag = max(self._vtime, self._last_tag.get(user, 0.0)) + 1.0 / self.weights.get(user, 1.0)
+            self._last_tag[user] = tag
+            self._seq += 1
+            heapq.heappush(self._heap, (tag, self._seq, future))
+            self._waiting[user] = self._waiting.get(user, 0) + 1
+            self._enqueued[future] = start
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Cancelled after being handed the slot: pass it on
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+            finally:
+                del self._enqueued[future]
+                self._waiting[user] -= 1
+                if not self._waiting[user]:
+                    del self._waiting[user]
+        granted = time.monotonic()
+        QUEUE_WAIT_SECONDS.observe(granted - start, route=route)
+        try:
+            yield
+        finally:
+            self._hold = 0.9 * self._hold + 0.1 * (time.monotonic() - granted)
+            self._release()
+
+
+scheduler = Scheduler(weights=parse_weights(LLM_USER_WEIGHTS))
+
+
+def admit_request(username: str, cost: int = 1):
+    # 429/503 with Retry-After before any work is done, and the user every
+    # model call of the request is queued as
+    scheduler.admit(username, cost=cost)
+    current_user.set(username)
+
+
+async def admission(username: str):
+    # Dependency for LLM-bound routes
+    admit_request(username)
+
+
+def queue_gauges():
+    return [
+        ("notes_llm_queue_depth", "gauge", "Model calls waiting for a scheduler slot", scheduler.queued),
+        ("notes_llm_active_calls", "gauge", "Model calls holding a scheduler slot", scheduler.active),
+        ("notes_llm_queue_oldest_wait_seconds", "gauge", "Age of the longest-waiting model call", round(scheduler.oldest_wait(), 3)),
+    ]
+
+
+metrics.add_collector(queue_gauges)
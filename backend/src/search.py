@@ -0,0 +1,161 @@
+import math
+import os
+from collections import Counter, OrderedDict
+
+from retrieval import B, K1, TOKEN_RE, terms
+
+SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "200"))
+MAX_OFFSETS = 50
+MAX_USERS = int(os.getenv("SEARCH_MAX_USERS", "64"))
+KINDS = ("subsection", "chat", "upload")
+
+
+def match_offsets(text: str, query_terms) -> list:
+    # [start, end] of every whole-word, case-insensitive match in the text
+    wanted = set(query_terms)
+    offsets = []
+    for match in TOKEN_RE.finditer(text):
+        if match.group().lower() in wanted:
+            offsets.append([match.start(), match.end()])
+            if len(offsets) >= MAX_OFFSETS:
+                break
+    return offsets
+
+
+def hit(note: str, kind: str, name: str, score: float, text: str, query_terms, seq: int = None) -> dict:
+    # Snippet is a window of the document around the first match;
+    # offsets are positions in the full document text. Chat turns carry
+    # their position in the log, since turn names may repeat.
+    offsets = match_offsets(text, query_terms)
+    start = max(offsets[0][0] - SNIPPET_CHARS // 4, 0) if offsets else 0
+    return {
+        "note": note,
+        "kind": kind,
+        "name": name,
+        "seq": seq,
+        "score": round(score, 4),
+        "snippet": text[start:start + SNIPPET_CHARS],
+        "snippet_start": start,
+        "offsets": offsets,
+    }
+
+
+class Document:
+    __slots__ = ("note", "kind", "name", "seq", "text", "tf", "length")
+
+    def __init__(self, note: str, kind: str, name: str, seq: int, text: str):
+        self.note = note
+        self.kind = kind
+        self.name = name
+        self.seq = seq
+        self.text = text
+        self.tf = Counter(terms(text))
+        self.length = sum(self.tf.values())
+
+
+class UserIndex:
+    # Document-level inverted index over everything one user has stored.
+    # Writes only mark documents dirty; they are re-read on the next search.
+
+    def __init__(self):
+        # (note, kind, name, seq) -> Document; seq is the position of a chat
+        # turn in its note's log and None for other kinds
+        self.documents = {}
+        self.postings = {}  # term -> {key: tf}
+        self.total_length = 0
+        self.dirty = set()
+        self.chat_counts = {}  # note -> chat turns indexed
+
+    def remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for term in document.tf:
+            bucket = self.postings.get(term)
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del self.postings[term]
+        self.total_length -= document.length
+
+    def update(self, key, text: str):
+        self.remove(key)
+        if text is None:
+            return
+        document = self.documents[key] = Document(*key, text)
+        for term, tf in document.tf.items():
+            self.postings.setdefault(term, {})[key] = tf
+        self.total_length += document.length
+
+    def search(self, query: str, limit: int, note: str = None, kind: str = None) -> list:
+        query_terms = set(terms(query))
+        count = len(self.documents)
+        if not count or not query_terms:
+            return []
+        average = self.total_length / count
+        scores = {}
+        for term in query_terms:
+            bucket = self.postings.get(term)
+            if not bucket:
+                continue
+            idf = math.log(1 + (count - len(bucket) + 0.5) / (len(bucket) + 0.5))
+            for key, tf in bucket.items():
+                if (note and key[0] != note) or (kind and key[1] != kind):
+                    continue
+                length = self.documents[key].length
+                scores[key] = scores.get(key, 0.0) + idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / average))
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [hit(*key[:3], score, self.documents[key].text, query_terms, seq=key[3]) for key, score in best]
+
+
+class SearchIndexes:
+    # One UserIndex per recently searched user, built from the store on first
+    # use and kept current through the store's write events
+
+    def __init__(self, store, max_users: int = MAX_USERS):
+        self.store = store
+        self.max_users = max_users
+        self._indexes = OrderedDict()  # user -> UserIndex
+        store.subscribe(self.on_write)
+
+    def on_write(self, user: str, note: str, kind: str, name: str):
+        # Chat events name the turn, not its position: the note's log is
+        # caught up as a whole
+        index = self._indexes.get(user)
+        if index is not None:
+            index.dirty.add((note, kind, None if kind == "chat" else name))
+
+    def _sync_chat(self, index: UserIndex, user: str, note: str):
+        # Turns are only appended; a shorter log was rewritten and is reindexed
+        indexed = index.chat_counts.get(note, 0)
+        if self.store.chat_log(user, note).count() < indexed:
+            for key in [key for key in index.documents if key[:2] == (note, "chat")]:
+                index.remove(key)
+            indexed = 0
+        for key, text in self.store.chat_documents(user, note, indexed):
+            index.update(key, text)
+            indexed = key[3] + 1
+        index.chat_counts[note] = indexed
+
+    def get(self, user: str) -> UserIndex:
+        index = self._indexes.get(user)
+        if index is None:
+            index = self._indexes[user] = UserIndex()
+            for key, text in self.store.documents(user):
+                index.update(key, text)
+                if key[1] == "chat":
+                    index.chat_counts[key[0]] = key[3] + 1
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        else:
+            for note, kind, name in index.dirty:
+                if kind == "chat":
+                    self._sync_chat(index, user, note)
+                else:
+                    index.update((note, kind, name, None), self.store.read_document(user, note, kind, name))
+        index.dirty.clear()
+        self._indexes.move_to_end(user)
+        return index
+
+    def search(self, user: str, query: str, limit: int, note: str = None, kind: str = None) -> list:
+        return self.get(user).search(query, limit, note, kind)
@@ -0,0 +1,584 @@
+import hashlib
+import json
+import shutil
+import time
+from pathlib import Path as PathlibPath
+
+from sqlalchemy import (
+    Column, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+    create_engine, delete, event, func, insert, select, text as sql_text, tuple_, update,
+)
+
+import retrieval
+import uploads
+from atomic import etag, note_etag
+from context_cache import format_segment
+from manifest import decode_cursor, encode_cursor
+from retrieval import terms
+from search import hit
+from storage import NoteStore
+from streaming import BufferedResponse
+from tokens import count_tokens
+
+metadata = MetaData()
+
+notes = Table(
+    "notes", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String, nullable=False),
+    Column("name", String, nullable=False),
+    Column("created_at", Float, nullable=False),
+    Column("updated_at", Float, nullable=False),
+    # Listing summary, refreshed by every write to the note (see _summarize)
+    Column("size", Integer, nullable=False, server_default="0"),
+    Column("subsection_count", Integer, nullable=False, server_default="0"),
+    Column("chat_turns", Integer, nullable=False, server_default="0"),
+    Column("etag", String, nullable=False, server_default=""),
+    UniqueConstraint("username", "name"),
+    Index("ix_notes_user_updated", "username", "updated_at"),
+    Index("ix_notes_user_size", "username", "size"),
+)
+
+subsections = Table(
+    "subsections", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("note_id", Integer, ForeignKey("notes.id", ondelete="CASCADE"), nullable=False),
+    Column("filename", String, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("etag", String, nullable=False),
+    Column("tokens", Integer, nullable=False),
+    Column("size", Integer, nullable=False, server_default="0"),  # bytes of content
+    Column("updated_at", Float, nullable=False),
+    UniqueConstraint("note_id", "filename"),
+)
+
+chat_turns = Table(
+    "chat_turns", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("note_id", Integer, ForeignKey("notes.id", ondelete="CASCADE"), nullable=False),
+    Column("name", String, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("tokens", Integer, nullable=False),
+    Column("created_at", Float, nullable=False),
+    # Names repeat (same query in the same second); turns are ordered by id
+    Index("ix_chat_turns_note", "note_id", "id"),
+)
+
+upload_rows = Table(
+    "uploads", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("note_id", Integer, ForeignKey("notes.id", ondelete="CASCADE"), nullable=False),
+    Column("filename", String, nullable=False),
+    Column("sha256", String, nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("text", Text),  # NULL until extraction has finished
+    Column("tokens", Integer, nullable=False, default=0),
+    Column("updated_at", Float, nullable=False),
+    UniqueConstraint("note_id", "filename"),
+    Index("ix_uploads_sha256", "note_id", "sha256"),
+)
+
+note_meta = Table(
+    "note_meta", metadata,
+    Column("note_id", Integer, ForeignKey("notes.id", ondelete="CASCADE"), primary_key=True),
+    Column("key", String, primary_key=True),
+    Column("value", Text, nullable=False),
+)
+
+# One FTS5 table over all three kinds of text, kept in sync by triggers. The
+# rowid encodes the source row as id * 4 + kind code.
+SEARCH_KINDS = [
+    # (table, kind code, kind, name column, content expression)
+    ("subsections", 1, "subsection", "filename", "{row}.content"),
+    ("chat_turns", 2, "chat", "name", "{row}.content"),
+    ("uploads", 3, "upload", "filename", "coalesce({row}.text, '')"),
+]
+
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+    "note_id UNINDEXED, kind UNINDEXED, name, content, tokenize='porter unicode61')"
+]
+for _table, _code, _kind, _name, _content in SEARCH_KINDS:
+    _insert = (
+        "INSERT INTO search_fts(rowid, note_id, kind, name, content) "
+        f"VALUES (new.id * 4 + {_code}, new.note_id, '{_kind}', new.{_name}, {_content.format(row='new')});"
+    )
+    _delete = f"DELETE FROM search_fts WHERE rowid = old.id * 4 + {_code};"
+    FTS_SCHEMA += [
+        f"CREATE TRIGGER IF NOT EXISTS {_table}_fts_insert AFTER INSERT ON {_table} BEGIN {_insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {_table}_fts_update AFTER UPDATE ON {_table} BEGIN {_delete} {_insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {_table}_fts_delete AFTER DELETE ON {_table} BEGIN {_delete} END",
+    ]
+
+
+def _set_pragmas(dbapi_connection, _):
+    # WAL lets readers proceed while a writer commits; NORMAL sync is
+    # durable across application crashes, which is what WAL needs
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _upgrade(conn):
+    _upgrade_chat_turns(conn)
+    _add_listing_columns(conn)
+
+
+def _upgrade_chat_turns(conn):
+    # chat_turns used to be unique on (note_id, name). SQLite cannot drop a
+    # constraint, so the table is rebuilt with the same ids (which keeps the
+    # search_fts rows valid); the triggers are recreated afterwards.
+    legacy = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = 'chat_turns' AND name LIKE 'sqlite_autoindex_%'"
+    ).first()
+    if legacy is None:
+        return
+    for suffix in ("insert", "update", "delete"):
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS chat_turns_fts_{suffix}")
+    conn.exec_driver_sql("ALTER TABLE chat_turns RENAME TO chat_turns_unique")
+    chat_turns.create(conn)
+    conn.exec_driver_sql(
+        "INSERT INTO chat_turns (id, note_id, name, content, tokens, created_at) "
+        "SELECT id, note_id, name, content, tokens, created_at FROM chat_turns_unique"
+    )
+    conn.exec_driver_sql("DROP TABLE chat_turns_unique")
+
+
+def _add_listing_columns(conn):
+    # Databases from before the listing summary get the columns, their
+    # indexes and a one-off backfill
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(notes)")}
+    if not columns or "size" in columns:
+        return
+    conn.exec_driver_sql("ALTER TABLE subsections ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+    conn.exec_driver_sql("UPDATE subsections SET size = length(CAST(content AS BLOB))")
+    for name, kind, default in (("size", "INTEGER", "0"), ("subsection_count", "INTEGER", "0"),
+                                ("chat_turns", "INTEGER", "0"), ("etag", "VARCHAR", "''")):
+        conn.exec_driver_sql(f"ALTER TABLE notes ADD COLUMN {name} {kind} NOT NULL DEFAULT {default}")
+    for index in notes.indexes:
+        index.create(conn, checkfirst=True)
+    for note_id in conn.execute(select(notes.c.id)).scalars().all():
+        _summarize(conn, note_id)
+
+
+def _summarize(conn, note_id: int):
+    # O(files in the note), so listings never aggregate across notes
+    etags = dict(conn.execute(select(subsections.c.filename, subsections.c.etag).where(subsections.c.note_id == note_id)).all())
+    conn.execute(update(notes).where(notes.c.id == note_id).values(
+        size=select(func.coalesce(func.sum(subsections.c.size), 0)).where(subsections.c.note_id == note_id).scalar_subquery(),
+        subsection_count=len(etags),
+        chat_turns=select(func.count()).where(chat_turns.c.note_id == note_id).scalar_subquery(),
+        etag=note_etag(etags),
+    ))
+
+
+def _page(conn, query, sort_column, name_column, sort: str, descending: bool, cursor: str, limit: int):
+    # Keyset pagination: the cursor bounds an index range instead of skipping rows
+    if cursor:
+        bound = tuple_(*decode_cursor(cursor, sort, descending))
+        key = tuple_(sort_column, name_column)
+        query = query.where(key < bound if descending else key > bound)
+    order = (sort_column.desc(), name_column.desc()) if descending else (sort_column, name_column)
+    rows = [dict(row._mapping) for row in conn.execute(query.order_by(*order).limit(limit + 1))]
+    items = rows[:limit]
+    return items, encode_cursor(sort, descending, items[-1]) if len(rows) > limit else None
+
+
+def _segment_tokens(name: str, text: str) -> int:
+    # Same count the file store's context cache records for a segment
+    return count_tokens(format_segment(name, text))
+
+
+class SqliteStore(NoteStore):
+    # Notes, subsections, chat turns, upload text and metadata in one SQLite
+    # database. Raw uploaded files and the per-note lock files stay under
+    # base_dir.
+
+    def __init__(self, base_dir: PathlibPath, db_url: str):
+        super().__init__(base_dir)
+        self.engine = create_engine(db_url, connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", _set_pragmas)
+        with self.engine.begin() as conn:
+            _upgrade(conn)
+            metadata.create_all(conn)
+            for statement in FTS_SCHEMA:
+                conn.exec_driver_sql(statement)
+
+    def close(self):
+        super().close()
+        self.engine.dispose()
+
+    def _note_id(self, conn, user: str, note: str, create: bool = False):
+        note_id = conn.execute(select(notes.c.id).where(notes.c.username == user, notes.c.name == note)).scalar()
+        if note_id is None and create:
+            now = time.time()
+            note_id = conn.execute(
+                insert(notes).values(username=user, name=note, created_at=now, updated_at=now)
+            ).inserted_primary_key[0]
+        return note_id
+
+    def _touch(self, conn, note_id: int):
+        conn.execute(update(notes).where(notes.c.id == note_id).values(updated_at=time.time()))
+        _summarize(conn, note_id)
+
+    def list_users(self):
+        with self.engine.connect() as conn:
+            return list(conn.execute(select(notes.c.username).distinct().order_by(notes.c.username)).scalars())
+
+    def user_exists(self, user: str) -> bool:
+        with self.engine.connect() as conn:
+            return conn.execute(select(notes.c.id).where(notes.c.username == user).limit(1)).first() is not None
+
+    def list_notes(self, user: str):
+        with self.engine.connect() as conn:
+            return list(conn.execute(select(notes.c.name).where(notes.c.username == user).order_by(notes.c.name)).scalars())
+
+    def note_exists(self, user: str, note: str) -> bool:
+        with self.engine.connect() as conn:
+            return self._note_id(conn, user, note) is not None
+
+    def list_subsections(self, user: str, note: str):
+        return list(self.subsection_etags(user, note))
+
+    def subsection_etags(self, user: str, note: str) -> dict:
+        query = (
+            select(subsections.c.filename, subsections.c.etag)
+            .join(notes, notes.c.id == subsections.c.note_id)
+            .where(notes.c.username == user, notes.c.name == note)
+            .order_by(subsections.c.filename)
+        )
+        with self.engine.connect() as conn:
+            return dict(conn.execute(query).all())
+
+    def note_listing(self, user: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        columns = {"name": notes.c.name, "modified": notes.c.updated_at, "size": notes.c.size}
+        query = select(
+            notes.c.name, notes.c.subsection_count.label("subsections"), notes.c.size,
+            notes.c.updated_at.label("modified"), notes.c.chat_turns, notes.c.etag,
+        ).where(notes.c.username == user)
+        with self.engine.connect() as conn:
+            total, modified = conn.execute(
+                select(func.count(), func.max(notes.c.updated_at)).where(notes.c.username == user)
+            ).one()
+            items, next_cursor = _page(conn, query, columns[sort], notes.c.name, sort, descending, cursor, limit)
+        return {"items": items, "next_cursor": next_cursor, "total": total,
+                "etag": etag(f"{user}:{total}:{modified}"), "modified": modified or 0.0}
+
+    def subsection_listing(self, user: str, note: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        columns = {"name": subsections.c.filename, "modified": subsections.c.updated_at, "size": subsections.c.size}
+        with self.engine.connect() as conn:
+            summary = conn.execute(
+                select(notes.c.id, notes.c.subsection_count, notes.c.etag, notes.c.updated_at)
+                .where(notes.c.username == user, notes.c.name == note)
+            ).first()
+            if summary is None:
+                return {"items": [], "next_cursor": None, "total": 0, "etag": note_etag({}), "modified": 0.0}
+            query = select(
+                subsections.c.filename.label("name"), subsections.c.size,
+                subsections.c.updated_at.label("modified"), subsections.c.etag,
+            ).where(subsections.c.note_id == summary.id)
+            items, next_cursor = _page(conn, query, columns[sort], subsections.c.filename, sort, descending, cursor, limit)
+        return {"items": items, "next_cursor": next_cursor, "total": summary.subsection_count,
+                "etag": summary.etag, "modified": summary.updated_at}
+
+    def read_subsection(self, user: str, note: str, name: str):
+        query = (
+            select(subsections.c.content)
+            .join(notes, notes.c.id == subsections.c.note_id)
+            .where(notes.c.username == user, notes.c.name == note, subsections.c.filename == name)
+        )
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def last_modified(self, user: str, note: str, names=()) -> float:
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            modified = conn.execute(select(notes.c.updated_at).where(notes.c.id == note_id)).scalar()
+            if names:
+                latest = conn.execute(
+                    select(func.max(subsections.c.updated_at))
+                    .where(subsections.c.note_id == note_id, subsections.c.filename.in_(list(names)))
+                ).scalar()
+                modified = max(modified, latest or 0)
+            return modified
+
+    def write_subsections(self, user: str, note: str, contents: dict) -> dict:
+        now = time.time()
+        etags = {name: etag(text) for name, text in contents.items()}
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note, create=True)
+            existing = set(conn.execute(
+                select(subsections.c.filename)
+                .where(subsections.c.note_id == note_id, subsections.c.filename.in_(list(contents)))
+            ).scalars())
+            for name, text in contents.items():
+                values = {"content": text, "etag": etags[name], "tokens": _segment_tokens(name, text),
+                          "size": len(text.encode()), "updated_at": now}
+                if name in existing:
+                    conn.execute(
+                        update(subsections)
+                        .where(subsections.c.note_id == note_id, subsections.c.filename == name)
+                        .values(**values)
+                    )
+                else:
+                    conn.execute(insert(subsections).values(note_id=note_id, filename=name, **values))
+            self._touch(conn, note_id)
+        for name in contents:
+            self._emit(user, note, "subsection", name)
+        return etags
+
+    def chat_turns(self, user: str, note: str, start: int = 0):
+        query = (
+            select(chat_turns.c.name, chat_turns.c.content, chat_turns.c.tokens)
+            .join(notes, notes.c.id == chat_turns.c.note_id)
+            .where(notes.c.username == user, notes.c.name == note)
+            .order_by(chat_turns.c.id)
+            .offset(start)
+        )
+        with self.engine.connect() as conn:
+            return [(name, format_segment(name, text), tokens) for name, text, tokens in conn.execute(query)]
+
+    def chat_page(self, user: str, note: str, before: int = None, limit: int = 20) -> dict:
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            total = conn.execute(select(func.count()).where(chat_turns.c.note_id == note_id)).scalar()
+            stop = total if before is None else min(before, total)
+            start = max(stop - limit, 0)
+            rows = conn.execute(
+                select(chat_turns.c.name, chat_turns.c.content, chat_turns.c.created_at)
+                .where(chat_turns.c.note_id == note_id)
+                .order_by(chat_turns.c.id)
+                .offset(start).limit(stop - start)
+            ).all()
+        return {
+            "turns": [
+                {"seq": start + i, "name": name, "content": text, "created": created}
+                for i, (name, text, created) in enumerate(rows)
+            ],
+            "total": total,
+            "next_cursor": start or None,
+        }
+
+    def add_chat_turn(self, user: str, note: str, name: str, text: str):
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note, create=True)
+            conn.execute(
+                insert(chat_turns).values(
+                    note_id=note_id, name=name, content=text, tokens=_segment_tokens(name, text), created_at=time.time()
+                )
+            )
+            self._touch(conn, note_id)
+        self._emit(user, note, "chat", name)
+
+    def response_writer(self, user: str, note: str, kind: str, name: str, header: str = ""):
+        # A row is only inserted once the answer is complete
+        if kind == "chat":
+            return BufferedResponse(name, header, lambda text: self.add_chat_turn(user, note, name, text))
+        return BufferedResponse(name, header, lambda text: self.write_subsections(user, note, {name: text}))
+
+    def get_meta(self, user: str, note: str, key: str):
+        query = (
+            select(note_meta.c.value)
+            .join(notes, notes.c.id == note_meta.c.note_id)
+            .where(notes.c.username == user, notes.c.name == note, note_meta.c.key == key)
+        )
+        with self.engine.connect() as conn:
+            value = conn.execute(query).scalar()
+        return json.loads(value) if value is not None else None
+
+    def set_meta(self, user: str, note: str, key: str, value):
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note, create=True)
+            conn.execute(delete(note_meta).where(note_meta.c.note_id == note_id, note_meta.c.key == key))
+            conn.execute(insert(note_meta).values(note_id=note_id, key=key, value=json.dumps(value)))
+
+    def _record_upload(self, user: str, note: str, name: str, sha256: str, size: int, text: str = None):
+        values = {
+            "sha256": sha256,
+            "size": size,
+            "text": text,
+            "tokens": _segment_tokens(f"{name}.txt", text) if text is not None else 0,
+            "updated_at": time.time(),
+        }
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note, create=True)
+            conn.execute(delete(upload_rows).where(upload_rows.c.note_id == note_id, upload_rows.c.filename == name))
+            conn.execute(insert(upload_rows).values(note_id=note_id, filename=name, **values))
+            self._touch(conn, note_id)
+        self._emit(user, note, "upload", name)
+
+    def _upload_text(self, user: str, note: str, name: str, text: str):
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note)
+            conn.execute(
+                update(upload_rows)
+                .where(upload_rows.c.note_id == note_id, upload_rows.c.filename == name)
+                .values(text=text, tokens=_segment_tokens(f"{name}.txt", text), updated_at=time.time())
+            )
+        self._emit(user, note, "upload", name)
+
+    async def save_upload(self, user: str, note: str, file):
+        # The raw bytes stay on disk (streamed and deduplicated as before);
+        # the extracted text goes into the uploads table
+        path, sha256, size, duplicate = await uploads.save_upload(file, self.upload_dir(user, note))
+        if not duplicate:
+            self._record_upload(user, note, path.name, sha256, size)
+            uploads.schedule_extraction(
+                path, lambda text_file: self._upload_text(user, note, path.name, text_file.read_text())
+            )
+        return path.name, sha256, size, duplicate
+
+    def _documents(self, conn, note_id: int, include_uploads: bool):
+        # (index key, segment name, version, text, tokens) in context order
+        rows = conn.execute(
+            select(subsections.c.filename, subsections.c.etag, subsections.c.content, subsections.c.tokens)
+            .where(subsections.c.note_id == note_id)
+            .order_by(subsections.c.filename)
+        )
+        documents = [(f"s:{name}", name, tag, text, tokens) for name, tag, text, tokens in rows]
+        if include_uploads:
+            rows = conn.execute(
+                select(upload_rows.c.filename, upload_rows.c.updated_at, upload_rows.c.text, upload_rows.c.tokens)
+                .where(upload_rows.c.note_id == note_id, upload_rows.c.text.is_not(None))
+                .order_by(upload_rows.c.filename)
+            )
+            documents += [(f"u:{name}", f"{name}.txt", version, text, tokens) for name, version, text, tokens in rows]
+        return documents
+
+    def note_documents(self, user: str, note: str, include_uploads: bool = False, names=None) -> list:
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            documents = self._documents(conn, note_id, include_uploads) if note_id is not None else []
+        return [(name, text) for _, name, _, text, _ in documents if names is None or name in names]
+
+    def document_versions(self, user: str, note: str, include_uploads: bool = False) -> dict:
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            if note_id is None:
+                return {}
+            versions = dict(conn.execute(
+                select(subsections.c.filename, subsections.c.etag)
+                .where(subsections.c.note_id == note_id)
+                .order_by(subsections.c.filename)
+            ).all())
+            if include_uploads:
+                rows = conn.execute(
+                    select(upload_rows.c.filename, upload_rows.c.updated_at)
+                    .where(upload_rows.c.note_id == note_id, upload_rows.c.text.is_not(None))
+                    .order_by(upload_rows.c.filename)
+                )
+                versions.update((f"{name}.txt", version) for name, version in rows)
+        return versions
+
+    def note_context(self, user: str, note: str, query: str, token_budget: int, include_uploads: bool = False) -> str:
+        # Same policy as retrieval.select_context: whole documents when they
+        # fit, otherwise the best BM25 chunks from the shared index registry
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            documents = self._documents(conn, note_id, include_uploads) if note_id is not None else []
+        if sum(doc[4] for doc in documents) <= token_budget:
+            return "".join(format_segment(name, text) for _, name, _, text, _ in documents)
+
+        index = retrieval.indexes.get(f"sqlite:{note_id}")
+        index.retain(doc[0] for doc in documents)
+        for key, name, version, text, _ in documents:
+            index.update_text(key, name, version, text)
+        chunks = list(index.chunks(doc[0] for doc in documents))
+        return retrieval.format_chunks(retrieval.pick_chunks(index, chunks, query, token_budget))
+
+    def search(self, user: str, query: str, limit: int = 20, note: str = None, kind: str = None) -> list:
+        # Any query term may match (like the file store's BM25); each term is
+        # quoted so FTS5 operators in user input are taken literally
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        # A chat turn's seq is its position in the note's log, as in chat_page
+        sql = (
+            "SELECT notes.name, f.kind, f.name, bm25(search_fts) AS rank, f.content, "
+            "CASE WHEN f.kind = 'chat' THEN (SELECT count(*) FROM chat_turns AS c "
+            "WHERE c.note_id = f.note_id AND c.id < f.rowid / 4) END AS seq "
+            "FROM search_fts AS f JOIN notes ON notes.id = f.note_id "
+            "WHERE search_fts MATCH :match AND notes.username = :user"
+        )
+        params = {"match": " OR ".join(f'"{term}"' for term in sorted(query_terms)), "user": user, "limit": limit}
+        if note:
+            sql += " AND notes.name = :note"
+            params["note"] = note
+        if kind:
+            sql += " AND f.kind = :kind"
+            params["kind"] = kind
+        sql += " ORDER BY rank LIMIT :limit"
+        with self.engine.connect() as conn:
+            rows = conn.execute(sql_text(sql), params).all()
+        # bm25() is lower-is-better
+        return [hit(*row[:3], -row[3], row[4], query_terms, seq=row[5]) for row in rows]
+
+    def export_note(self, user: str, note: str) -> dict:
+        with self.engine.connect() as conn:
+            note_id = self._note_id(conn, user, note)
+            sections = conn.execute(
+                select(subsections.c.filename, subsections.c.content)
+                .where(subsections.c.note_id == note_id).order_by(subsections.c.filename)
+            ).all()
+            turns = conn.execute(
+                select(chat_turns.c.name, chat_turns.c.content)
+                .where(chat_turns.c.note_id == note_id).order_by(chat_turns.c.id)
+            ).all()
+            files = conn.execute(
+                select(upload_rows.c.filename, upload_rows.c.text)
+                .where(upload_rows.c.note_id == note_id).order_by(upload_rows.c.filename)
+            ).all()
+            meta = conn.execute(select(note_meta.c.key, note_meta.c.value).where(note_meta.c.note_id == note_id)).all()
+        upload_dir = self.upload_dir(user, note)
+        return {
+            "subsections": dict(sections),
+            "chat": [tuple(turn) for turn in turns],
+            "uploads": [
+                (name, upload_dir / name if (upload_dir / name).exists() else None, text) for name, text in files
+            ],
+            "meta": {key: json.loads(value) for key, value in meta},
+        }
+
+    def import_note(self, user: str, note: str, data: dict):
+        # Replaces whatever the database held for this note, so re-running a
+        # migration is safe
+        now = time.time()
+        upload_dir = self.upload_dir(user, note)
+        files = []
+        for name, raw, text in data["uploads"]:
+            target = upload_dir / name
+            if raw is not None and PathlibPath(raw).resolve() != target.resolve():
+                upload_dir.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(raw, target)
+            if not target.exists():
+                continue
+            sha256 = hashlib.sha256(target.read_bytes()).hexdigest()
+            tokens = _segment_tokens(f"{name}.txt", text) if text is not None else 0
+            files.append({"filename": name, "sha256": sha256, "size": target.stat().st_size, "text": text, "tokens": tokens})
+
+        with self.engine.begin() as conn:
+            note_id = self._note_id(conn, user, note, create=True)
+            for table in (subsections, chat_turns, upload_rows, note_meta):
+                conn.execute(delete(table).where(table.c.note_id == note_id))
+            if data["subsections"]:
+                conn.execute(insert(subsections), [
+                    {"note_id": note_id, "filename": name, "content": text, "etag": etag(text),
+                     "tokens": _segment_tokens(name, text), "size": len(text.encode()), "updated_at": now}
+                    for name, text in data["subsections"].items()
+                ])
+            if data["chat"]:
+                conn.execute(insert(chat_turns), [
+                    {"note_id": note_id, "name": name, "content": text,
+                     "tokens": _segment_tokens(name, text), "created_at": now}
+                    for name, text in data["chat"]
+                ])
+            if files:
+                conn.execute(insert(upload_rows), [{"note_id": note_id, "updated_at": now, **row} for row in files])
+            if data["meta"]:
+                conn.execute(insert(note_meta), [
+                    {"note_id": note_id, "key": key, "value": json.dumps(value)} for key, value in data["meta"].items()
+                ])
+            self._touch(conn, note_id)
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import os
+import shutil
+from pathlib import Path as PathlibPath
+
+import retrieval
+import uploads
+from atomic import atomic_batch, atomic_write, etag, file_etag, note_lock
+from chatlog import ChatLog, turn_record
+from context_cache import cache as context_cache, format_segment, start_watcher
+from manifest import Manifests
+from search import SearchIndexes
+from streaming import BufferedResponse, ProgressiveMarkdown
+
+NOTES_STORAGE = os.getenv("NOTES_STORAGE", "fs")  # "fs" or "sqlite"
+NOTES_DB_URL = os.getenv("NOTES_DB_URL", "sqlite:///notes.db")
+
+UPLOAD_DIR = "uploaded_files"
+# Metadata files that predate the store keep their names
+META_FILES = {"chat_summary": "chat_summary.json", "diagrams": ".diagrams.json"}
+
+
+class NoteStore:
+    # Everything the routes persist: notes, their subsections, chat turns,
+    # uploads and small JSON metadata documents (diagram store, chat summary).
+    # Every write is reported to subscribers as (user, note, kind, name) with
+    # kind one of "subsection", "chat" or "upload".
+
+    def __init__(self, base_dir: PathlibPath):
+        # Raw uploads and lock files always live in the directory tree
+        self.base_dir = PathlibPath(base_dir)
+        self._listeners = []
+        self.started = False
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def _emit(self, user: str, note: str, kind: str, name: str):
+        for listener in self._listeners:
+            listener(user, note, kind, name)
+
+    def start(self):
+        self.started = True
+
+    def close(self):
+        self.started = False
+
+    def upload_dir(self, user: str, note: str) -> PathlibPath:
+        return self.base_dir / user / note / UPLOAD_DIR
+
+    def lock(self, user: str, note: str):
+        # Held around read-check-write sequences such as ETag preconditions
+        return note_lock(self.base_dir / user / note)
+
+    def add_chat_turn(self, user: str, note: str, name: str, text: str):
+        raise NotImplementedError
+
+    def chat_turns(self, user: str, note: str, start: int = 0):
+        # (name, formatted segment, tokens) for turns from position `start`
+        # on, in the order they were added
+        raise NotImplementedError
+
+    def chat_page(self, user: str, note: str, before: int = None, limit: int = 20) -> dict:
+        # Up to `limit` turns preceding position `before` (default: the end),
+        # oldest first, with the cursor for the page before them
+        raise NotImplementedError
+
+    def note_listing(self, user: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        # One page of the user's notes, each with subsection count, size, last
+        # modification, chat turn count and content hash: {"items",
+        # "next_cursor", "total", "etag", "modified"}. Raises CursorError.
+        raise NotImplementedError
+
+    def subsection_listing(self, user: str, note: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        # Same shape for one note's subsections (size, modification, ETag)
+        raise NotImplementedError
+
+    def note_documents(self, user: str, note: str, include_uploads: bool = False, names=None) -> list:
+        # (segment name, text) of the note's subsections and, optionally, its
+        # extracted upload text, in the order note_context lays them out;
+        # names restricts it to those segments
+        raise NotImplementedError
+
+    def document_versions(self, user: str, note: str, include_uploads: bool = False) -> dict:
+        # Segment name -> version token for the same documents, in the same
+        # order, without reading their text
+        raise NotImplementedError
+
+    def write_subsections(self, user: str, note: str, contents: dict) -> dict:
+        # All or nothing; creates missing subsections; returns the new ETags
+        raise NotImplementedError
+
+    def export_note(self, user: str, note: str) -> dict:
+        raise NotImplementedError
+
+    def import_note(self, user: str, note: str, data: dict):
+        raise NotImplementedError
+
+    def search(self, user: str, query: str, limit: int = 20, note: str = None, kind: str = None) -> list:
+        # Ranked hits over subsections, chat turns and extracted upload text
+        raise NotImplementedError
+
+
+class FileStore(NoteStore):
+    # The original layout: users/<user>/<note>/*.md for subsections,
+    # chat.jsonl (see chatlog) for chat turns and uploaded_files/ with
+    # extracted text in uploaded_files/.text/. Reads go through the context cache and the
+    # retrieval indexes, which file_written keeps in sync.
+
+    def __init__(self, base_dir: PathlibPath):
+        super().__init__(base_dir)
+        self._watcher = None
+        self._compacting = set()
+        self.search_indexes = SearchIndexes(self)
+        # Listing index per user, kept current by this store's own events
+        # Listings only count turns; they must not import or compact logs
+        self.manifests = Manifests(self.base_dir, lambda user, note: ChatLog(self.note_dir(user, note)).peek_count())
+        self.subscribe(self.manifests.written)
+
+    def note_dir(self, user: str, note: str) -> PathlibPath:
+        return self.base_dir / user / note
+
+    def _meta_path(self, user: str, note: str, key: str) -> PathlibPath:
+        return self.note_dir(user, note) / META_FILES.get(key, f".{key}.json")
+
+    def file_written(self, path: PathlibPath):
+        # Single hook for every write path (and the file watcher) so derived
+        # state stays in sync with what is on disk
+        context_cache.invalidate(path)
+        try:
+            parts = path.relative_to(self.base_dir).parts
+        except ValueError:
+            return
+        if len(parts) < 3:
+            return
+        retrieval.indexes.notify(path, self.base_dir / parts[0] / parts[1])
+        name = parts[-1]
+        if name.startswith("."):
+            return
+        if len(parts) == 3 and name.endswith(".md"):
+            self._emit(parts[0], parts[1], "subsection", name)
+        elif parts[2] == UPLOAD_DIR:
+            self._emit(parts[0], parts[1], "upload", name.removesuffix(".txt") if len(parts) == 5 else name)
+
+    def start(self):
+        self._watcher = start_watcher(self.base_dir, self.file_written)
+        super().start()
+
+    def close(self):
+        super().close()
+        if self._watcher:
+            self._watcher.cancel()
+        self.manifests.close()
+
+    def list_users(self):
+        return [p.name for p in context_cache.list_files(self.base_dir, "*") if p.is_dir()]
+
+    def user_exists(self, user: str) -> bool:
+        return (self.base_dir / user).is_dir()
+
+    def list_notes(self, user: str):
+        return [p.name for p in context_cache.list_files(self.base_dir / user, "*") if p.is_dir()]
+
+    def note_exists(self, user: str, note: str) -> bool:
+        return self.note_dir(user, note).is_dir()
+
+    def list_subsections(self, user: str, note: str):
+        return [p.name for p in context_cache.list_files(self.note_dir(user, note), "*.md")]
+
+    def subsection_etags(self, user: str, note: str) -> dict:
+        # Stat-keyed, so validators never read unchanged files
+        return {p.name: file_etag(p) for p in context_cache.list_files(self.note_dir(user, note), "*.md")}
+
+    def read_subsection(self, user: str, note: str, name: str):
+        path = self.note_dir(user, note) / name
+        return path.read_text() if path.is_file() else None
+
+    def last_modified(self, user: str, note: str, names=()) -> float:
+        note_dir = self.note_dir(user, note)
+        return max([note_dir.stat().st_mtime] + [(note_dir / name).stat().st_mtime for name in names])
+
+    def write_subsections(self, user: str, note: str, contents: dict) -> dict:
+        note_dir = self.note_dir(user, note)
+        note_dir.mkdir(parents=True, exist_ok=True)
+        atomic_batch({note_dir / name: text for name, text in contents.items()})
+        for name in contents:
+            self.file_written(note_dir / name)
+        return {name: etag(text) for name, text in contents.items()}
+
+    def chat_log(self, user: str, note: str) -> ChatLog:
+        # Legacy chat/ directories are imported on first access; removing
+        # them (and any damaged records) is left to a background compaction
+        log = ChatLog(self.note_dir(user, note))
+        log.count()
+        if log.needs_compaction() and str(log.log) not in self._compacting:
+            self.schedule_compaction(log)
+        return log
+
+    def schedule_compaction(self, log: ChatLog):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return log.compact()
+        self._compacting.add(str(log.log))
+        task = loop.create_task(asyncio.to_thread(log.compact))
+        task.add_done_callback(lambda t: self._compacting.discard(str(log.log)) or t.cancelled() or t.exception())
+
+    def chat_turns(self, user: str, note: str, start: int = 0):
+        return [
+            (turn["name"], format_segment(turn["name"], turn["text"]), turn["tokens"])
+            for turn in self.chat_log(user, note).read(start)
+        ]
+
+    def chat_page(self, user: str, note: str, before: int = None, limit: int = 20) -> dict:
+        log = self.chat_log(user, note)
+        total = log.count()
+        stop = total if before is None else min(before, total)
+        start = max(stop - limit, 0)
+        return {
+            "turns": [
+                {"seq": start + i, "name": turn["name"], "content": turn["text"], "created": turn["created"]}
+                for i, turn in enumerate(log.read(start, stop))
+            ],
+            "total": total,
+            "next_cursor": start or None,
+        }
+
+    def add_chat_turn(self, user: str, note: str, name: str, text: str):
+        self.chat_log(user, note).append(turn_record(name, text))
+        self._emit(user, note, "chat", name)
+
+    def response_writer(self, user: str, note: str, kind: str, name: str, header: str = ""):
+        # Streamed subsections are written to disk as they arrive; a chat
+        # turn is one record, appended once the answer is complete
+        if kind == "chat":
+            return BufferedResponse(name, header, lambda text: self.add_chat_turn(user, note, name, text))
+        note_dir = self.note_dir(user, note)
+        note_dir.mkdir(parents=True, exist_ok=True)
+        return ProgressiveMarkdown(note_dir / name, header=header, on_finalize=self.file_written)
+
+    def get_meta(self, user: str, note: str, key: str):
+        try:
+            return json.loads(self._meta_path(user, note, key).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set_meta(self, user: str, note: str, key: str, value):
+        atomic_write(self._meta_path(user, note, key), json.dumps(value))
+
+    async def save_upload(self, user: str, note: str, file):
+        path, sha256, size, duplicate = await uploads.save_upload(file, self.upload_dir(user, note))
+        if not duplicate:
+            self.file_written(path)
+            uploads.schedule_extraction(path, self.file_written)
+        return path.name, sha256, size, duplicate
+
+    def note_context(self, user: str, note: str, query: str, token_budget: int, include_uploads: bool = False) -> str:
+        note_dir = self.note_dir(user, note)
+        sources = [(note_dir, "*.md")]
+        if include_uploads:
+            upload_dir = self.upload_dir(user, note)
+            uploads.sync_text(upload_dir, self.file_written)
+            sources.append((uploads.text_dir(upload_dir), "*.txt"))
+        return retrieval.select_context(note_dir, sources, query, token_budget=token_budget)
+
+    def note_listing(self, user: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        return self.manifests.get(user).list_notes(sort, descending, cursor, limit)
+
+    def subsection_listing(self, user: str, note: str, sort: str = "name", descending: bool = False, cursor: str = None, limit: int = 100) -> dict:
+        return self.manifests.get(user).list_subsections(note, sort, descending, cursor, limit)
+
+    def _document_paths(self, user: str, note: str, include_uploads: bool):
+        directories = [(self.note_dir(user, note), "*.md")]
+        if include_uploads:
+            directories.append((uploads.text_dir(self.upload_dir(user, note)), "*.txt"))
+        return [path for directory, pattern in directories for path in context_cache.list_files(directory, pattern)]
+
+    def note_documents(self, user: str, note: str, include_uploads: bool = False, names=None) -> list:
+        return [
+            (path.name, path.read_text())
+            for path in self._document_paths(user, note, include_uploads)
+            if names is None or path.name in names
+        ]
+
+    def document_versions(self, user: str, note: str, include_uploads: bool = False) -> dict:
+        # Stat-keyed ETags: unchanged files are not read
+        return {path.name: file_etag(path) for path in self._document_paths(user, note, include_uploads)}
+
+    def chat_documents(self, user: str, note: str, start: int = 0):
+        # Chat turns from position start on; names may repeat, positions don't
+        for seq, turn in enumerate(self.chat_log(user, note).read(start), start):
+            yield (note, "chat", turn["name"], seq), turn["text"]
+
+    def documents(self, user: str):
+        # ((note, kind, name, seq), text) of everything searchable for the
+        # user; seq is a chat turn's log position and None otherwise
+        for note in self.list_notes(user):
+            for name in self.list_subsections(user, note):
+                yield (note, "subsection", name, None), self.read_document(user, note, "subsection", name)
+            yield from self.chat_documents(user, note)
+            for path in context_cache.list_files(uploads.text_dir(self.upload_dir(user, note)), "*.txt"):
+                yield (note, "upload", path.name.removesuffix(".txt"), None), path.read_text()
+
+    def read_document(self, user: str, note: str, kind: str, name: str, seq: int = None):
+        if kind == "chat":
+            turns = self.chat_log(user, note).read(seq, seq + 1)
+            return turns[0]["text"] if turns and turns[0]["name"] == name else None
+        if kind == "upload":
+            path = uploads.text_dir(self.upload_dir(user, note)) / f"{name}.txt"
+        else:
+            path = self.note_dir(user, note) / name
+        try:
+            return path.read_text()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def search(self, user: str, query: str, limit: int = 20, note: str = None, kind: str = None) -> list:
+        return self.search_indexes.search(user, query, limit, note, kind)
+
+    def export_note(self, user: str, note: str) -> dict:
+        note_dir = self.note_dir(user, note)
+        upload_dir = self.upload_dir(user, note)
+        meta = {key: self.get_meta(user, note, key) for key in META_FILES}
+        for path in note_dir.glob(".*.json"):
+            key = path.name[1:-len(".json")]
+            meta.setdefault(key, self.get_meta(user, note, key))
+        text_files = {p.name.removesuffix(".txt"): p for p in context_cache.list_files(uploads.text_dir(upload_dir), "*.txt")}
+        return {
+            "subsections": {p.name: p.read_text() for p in context_cache.list_files(note_dir, "*.md")},
+            "chat": [(turn["name"], turn["text"]) for turn in self.chat_log(user, note).read()],
+            "uploads": [
+                (p.name, p, text_files[p.name].read_text() if p.name in text_files else None)
+                for p in context_cache.list_files(upload_dir, "*")
+                if p.is_file() and not p.name.startswith(".")
+            ],
+            "meta": {key: value for key, value in meta.items() if value is not None},
+        }
+
+    def import_note(self, user: str, note: str, data: dict):
+        if data["subsections"]:
+            self.write_subsections(user, note, data["subsections"])
+        else:
+            self.note_dir(user, note).mkdir(parents=True, exist_ok=True)
+        self.chat_log(user, note).replace([turn_record(name, text) for name, text in data["chat"]])
+        for name, _ in data["chat"]:
+            self._emit(user, note, "chat", name)
+        upload_dir = self.upload_dir(user, note)
+        for name, raw, text in data["uploads"]:
+            target = upload_dir / name
+            if raw is not None and PathlibPath(raw).resolve() != target.resolve():
+                upload_dir.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(raw, target)
+            if text is not None and target.exists():
+                self.file_written(uploads.write_text(target, text))
+        for key, value in data["meta"].items():
+            self.set_meta(user, note, key, value)
+
+
+def open_store(base_dir: PathlibPath, backend: str = NOTES_STORAGE, db_url: str = NOTES_DB_URL) -> NoteStore:
+    if backend == "fs":
+        return FileStore(base_dir)
+    if backend == "sqlite":
+        from sqlite_store import SqliteStore
+
+        return SqliteStore(base_dir, db_url)
+    raise ValueError(f"Unknown NOTES_STORAGE '{backend}', expected 'fs' or 'sqlite'")
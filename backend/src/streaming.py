@@ -0,0 +1,103 @@
+import json
+import os
+from pathlib import Path as PathlibPath
+
+import metrics
+
+
+def sse(event: str, data: dict) -> str:
+    # One Server-Sent Events frame
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ProgressiveMarkdown:
+    # Writes a response file chunk by chunk into a hidden ".part" file next to
+    # the target (so the "*.md" globs never pick it up half-written) and moves
+    # it into place with a single rename once the answer is complete. The
+    # ".part" file is only created by the first write, so a response that
+    # never starts streaming leaves nothing behind.
+
+    def __init__(self, target: PathlibPath, header: str = "", on_finalize=None):
+        self.target = target
+        self.name = target.name
+        self.on_finalize = on_finalize
+        self.part = target.with_name(f".{target.name}.part")
+        self._header = header
+        self._f = None
+
+    def _file(self):
+        if self._f is None:
+            self._f = self.part.open("w")
+            self._f.write(self._header)
+        return self._f
+
+    def write(self, text: str):
+        f = self._file()
+        f.write(text)
+        f.flush()
+
+    def finalize(self):
+        f = self._file()
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(self.part, self.target)
+        if self.on_finalize:
+            self.on_finalize(self.target)
+
+    def discard(self):
+        if self._f is None:
+            return
+        if not self._f.closed:
+            self._f.close()
+        self.part.unlink(missing_ok=True)
+
+
+class BufferedResponse:
+    # Same interface as ProgressiveMarkdown for stores that can only persist
+    # a complete answer: on_finalize receives the full text in one piece.
+
+    def __init__(self, name: str, header: str = "", on_finalize=None):
+        self.name = name
+        self.on_finalize = on_finalize
+        self._parts = [header]
+
+    def write(self, text: str):
+        self._parts.append(text)
+
+    def finalize(self):
+        if self.on_finalize:
+            self.on_finalize("".join(self._parts))
+
+    def discard(self):
+        self._parts = []
+
+
+async def stream_answer(tokens, writer, on_complete=None):
+    # Forwards tokens as "token" events while persisting them, then emits a
+    # single "done" event (extended with whatever on_complete returns).
+    chunks = []
+    finalized = False
+    try:
+        async for token in tokens:
+            chunks.append(token)
+            writer.write(token)
+            yield sse("token", {"token": token})
+        with metrics.span("write"):
+            writer.finalize()
+        finalized = True
+        answer = "".join(chunks)
+        extra = on_complete(answer) if on_complete else {}
+        yield sse("done", {"filename": writer.name, "answer": answer, **(extra or {})})
+    except Exception as e:
+        yield sse("error", {"detail": f"Error processing query: {str(e)}"})
+    finally:
+        # Client disconnects close the generator early; never leave a .part behind
+        if not finalized:
+            writer.discard()
+
+
+async def replay_answer(answer: str, extra: dict):
+    # Same event shape as stream_answer for answers that are already known
+    yield sse("token", {"token": answer})
+    yield sse("done", {"answer": answer, **extra})
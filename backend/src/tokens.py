@@ -0,0 +1,32 @@
+import os
+
+ENCODING_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+
+_encoding = None
+_unavailable = False
+
+
+def encoding():
+    global _encoding, _unavailable
+    if _encoding is None and not _unavailable:
+        try:
+            import tiktoken
+
+            try:
+                _encoding = tiktoken.encoding_for_model(ENCODING_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # tiktoken fetches its BPE file on first use; without network
+            # access we stay on the estimate below instead of retrying
+            _unavailable = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = encoding()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path as PathlibPath
+from xml.etree import ElementTree
+
+from fastapi import HTTPException, Request
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
+
+from atomic import note_lock
+from context_cache import cache as context_cache
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+EXTRACT_WORKERS = int(os.getenv("UPLOAD_EXTRACT_WORKERS", "2"))
+
+TEXT_DIR = ".text"
+HASH_INDEX = ".hashes.json"
+PLAIN_SUFFIXES = {".txt", ".md"}
+EXTRACTABLE_SUFFIXES = PLAIN_SUFFIXES | {".pdf", ".docx"}
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+_pool = None
+_pending = {}
+
+log = logging.getLogger("uploads")
+
+
+def text_dir(upload_dir: PathlibPath) -> PathlibPath:
+    # Normalized text lives beside the originals, one "<name>.txt" per upload
+    return upload_dir / TEXT_DIR
+
+
+def text_path(raw: PathlibPath) -> PathlibPath:
+    return text_dir(raw.parent) / f"{raw.name}.txt"
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip() + "\n"
+
+
+def _docx_text(path: str) -> str:
+    # A .docx is a zip; paragraphs are <w:p> elements with <w:t> runs
+    with zipfile.ZipFile(path) as z:
+        root = ElementTree.fromstring(z.read("word/document.xml"))
+    paragraphs = ("".join(t.text or "" for t in p.iter(f"{WORD_NS}t")) for p in root.iter(f"{WORD_NS}p"))
+    return "\n\n".join(p for p in paragraphs if p)
+
+
+def _pdf_text(path: str) -> str:
+    from pypdf import PdfReader
+
+    return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+
+def extract_text(path: str) -> str:
+    # Runs in the worker processes; must stay a picklable top-level function
+    suffix = PathlibPath(path).suffix.lower()
+    if suffix == ".pdf":
+        text = _pdf_text(path)
+    elif suffix == ".docx":
+        text = _docx_text(path)
+    else:
+        text = PathlibPath(path).read_bytes().decode("utf-8", errors="replace")
+    return normalize(text)
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def write_text(raw: PathlibPath, text: str) -> PathlibPath:
+    target = text_path(raw)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, target)
+    return target
+
+
+async def _extract(raw: PathlibPath, on_text):
+    try:
+        text = await asyncio.get_running_loop().run_in_executor(_executor(), extract_text, str(raw))
+        on_text(write_text(raw, text))
+    except Exception as e:
+        log.warning("Text extraction failed for '%s': %s", raw, e)
+    finally:
+        _pending.pop(str(raw), None)
+
+
+def schedule_extraction(raw: PathlibPath, on_text):
+    key = str(raw)
+    if key not in _pending and raw.suffix.lower() in EXTRACTABLE_SUFFIXES:
+        _pending[key] = asyncio.create_task(_extract(raw, on_text))
+    return _pending.get(key)
+
+
+def is_stale(raw: PathlibPath) -> bool:
+    try:
+        return text_path(raw).stat().st_mtime_ns < raw.stat().st_mtime_ns
+    except FileNotFoundError:
+        return True
+
+
+def sync_text(upload_dir: PathlibPath, on_text):
+    # Catches uploads that predate extraction or changed on disk. Plain text
+    # is normalized inline so it is in this request's context; PDFs and
+    # .docx files go to the pool and show up once extracted.
+    for raw in context_cache.list_files(upload_dir, "*"):
+        suffix = raw.suffix.lower()
+        if not raw.is_file() or suffix not in EXTRACTABLE_SUFFIXES or not is_stale(raw):
+            continue
+        if suffix in PLAIN_SUFFIXES:
+            on_text(write_text(raw, extract_text(str(raw))))
+        else:
+            schedule_extraction(raw, on_text)
+
+
+def _load_hashes(upload_dir: PathlibPath) -> dict:
+    try:
+        return json.loads((upload_dir / HASH_INDEX).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_hashes(upload_dir: PathlibPath, hashes: dict):
+    path = upload_dir / HASH_INDEX
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_text(json.dumps(hashes))
+    os.replace(tmp, path)
+
+
+class StreamedUpload:
+    # The file field of a multipart/form-data request, parsed while the body
+    # arrives. Starlette's UploadFile spools the whole body before the route
+    # runs, so a size cap checked there only applies after the fact.
+
+    def __init__(self, request: Request, field: str = "file", max_bytes: int = MAX_UPLOAD_BYTES):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > max_bytes + MULTIPART_OVERHEAD:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+        self.field = field
+        self.filename = None
+        self._body = request.stream()
+        self._headers, self._header_field, self._header_value = {}, b"", b""
+        self._data = []  # file bytes parsed but not yet consumed
+        self._in_file = self._file_done = False
+        self._parser = MultipartParser(params[b"boundary"], callbacks={
+            "on_part_begin": self._part_begin,
+            "on_header_field": self._header_field_data,
+            "on_header_value": self._header_value_data,
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        })
+
+    def _part_begin(self):
+        self._headers = {}
+
+    def _header_field_data(self, data, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _header_value_data(self, data, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if self.filename is None and options.get(b"name", b"").decode() == self.field and b"filename" in options:
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._in_file = True
+
+    def _part_data(self, data, start: int, end: int):
+        if self._in_file:
+            self._data.append(bytes(data[start:end]))
+
+    def _part_end(self):
+        if self._in_file:
+            self._in_file, self._file_done = False, True
+
+    async def _feed(self) -> bool:
+        chunk = await anext(self._body, None)
+        if chunk is None:
+            self._parser.finalize()
+            return False
+        self._parser.write(chunk)
+        return True
+
+    async def start(self):
+        # Reads up to the file part's headers
+        while self.filename is None:
+            if not await self._feed():
+                raise HTTPException(status_code=422, detail=f"Missing file field '{self.field}'")
+
+    async def chunks(self):
+        # The file's bytes, as they come off the connection
+        while True:
+            if self._data:
+                data, self._data = b"".join(self._data), []
+                yield data
+            if self._file_done or not await self._feed():
+                if self._data:
+                    yield b"".join(self._data)
+                return
+
+
+async def save_upload(upload: StreamedUpload, upload_dir: PathlibPath, max_bytes: int = MAX_UPLOAD_BYTES):
+    # Streams the body to a hidden .part file of its own, hashing as it goes,
+    # then either renames it into place or drops it as a duplicate.
+    await upload.start()
+    name = PathlibPath(upload.filename or "").name
+    if not name or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    target = upload_dir / name
+    part = upload_dir / f".{name}.{uuid.uuid4().hex}.part"
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with part.open("wb") as f:
+            async for chunk in upload.chunks():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    sha256 = digest.hexdigest()
+
+    # The hash index is read, checked and rewritten under the note's lock
+    async with note_lock(upload_dir.parent):
+        hashes = _load_hashes(upload_dir)
+        existing = hashes.get(sha256)
+        if existing and (upload_dir / existing).exists():
+            part.unlink()
+            return upload_dir / existing, sha256, size, True
+
+        os.replace(part, target)
+        # Drop the hash of whatever this filename held before
+        hashes = {h: n for h, n in hashes.items() if n != name}
+        hashes[sha256] = name
+        _save_hashes(upload_dir, hashes)
+    return target, sha256, size, False
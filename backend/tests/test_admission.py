@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path as PathlibPath
+
+from fastapi import HTTPException
+
+sys.path.insert(0, str(PathlibPath(__file__).resolve().parent.parent / "src"))
+
+from scheduler import Scheduler  # noqa: E402
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_cost_above_burst_is_refused(self):
+        scheduler = Scheduler(rate=1, burst=10)
+        with self.assertRaises(HTTPException) as raised:
+            scheduler.admit("u", cost=20)
+        self.assertEqual(raised.exception.status_code, 413)
+
+    def test_batch_cost_is_charged_in_full(self):
+        scheduler = Scheduler(rate=0.01, burst=10)
+        scheduler.admit("u", cost=8)
+        with self.assertRaises(HTTPException) as raised:
+            scheduler.admit("u", cost=8)
+        self.assertEqual(raised.exception.status_code, 429)
+        scheduler.admit("other", cost=8)
+
+    def test_no_rate_means_no_limit(self):
+        Scheduler(rate=0, burst=10).admit("u", cost=100)
+
+
+class BatchAdmissionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._cwd = os.getcwd()
+        cls._workdir = tempfile.TemporaryDirectory()
+        os.chdir(cls._workdir.name)
+        os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+        import main
+        import scheduler
+        from fastapi.testclient import TestClient
+
+        cls.store = main.store
+        cls.scheduler = scheduler.scheduler
+        cls.client = TestClient(main.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls._cwd)
+        cls._workdir.cleanup()
+
+    def setUp(self):
+        self.scheduler.rate, self.scheduler.burst = 0.01, 10
+        self.scheduler._buckets.clear()
+
+    def batch(self, user: str, size: int):
+        items = [{"query": f"question {i}", "contextLevel": 3} for i in range(size)]
+        return self.client.post(f"/users/{user}/notes/missing/ask/batch", json={"items": items})
+
+    def test_batch_larger_than_burst_is_refused(self):
+        self.assertEqual(self.batch("big", 12).status_code, 413)
+
+    def test_batches_are_charged_per_item(self):
+        # Admitted (then 404: the note does not exist), leaving 4 tokens
+        self.assertEqual(self.batch("busy", 6).status_code, 404)
+        response = self.batch("busy", 6)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_ask_on_missing_note_costs_nothing(self):
+        response = self.client.post("/users/lost/notes/missing/ask", json={"query": "q", "contextLevel": 3})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("lost", self.scheduler._buckets)
+
+    def diagrams(self, user: str, sections: int, **body):
+        self.store.write_subsections(user, "n", {f"s{i}.md": f"section {i}\n" for i in range(sections)})
+        return self.client.post(f"/users/{user}/notes/n/diagrams", json=body)
+
+    def test_diagram_job_larger_than_burst_is_refused(self):
+        self.assertEqual(self.diagrams("wide", 12).status_code, 413)
+
+    def test_diagram_jobs_are_charged_per_subsection(self):
+        # 8 tokens left: one model call per subsection does not fit
+        self.scheduler._buckets["charged"] = [8, time.monotonic()]
+        self.assertEqual(self.diagrams("charged", 9, force=True).status_code, 429)
+
+
+if __name__ == "__main__":
+    unittest.main()
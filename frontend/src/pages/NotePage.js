@@ -171,7 +171,8 @@ function NotePage() {
       const res = await axios.post("http://localhost:8000/users/user1/notes/note1/ask", { 
         query: content,
         contextLevel: contextLevel,
-        includeDiagram: includeDiagram
+        includeDiagram: includeDiagram,
+        includeContext: false
       });
       
       const updatedInputs = [...inputs];